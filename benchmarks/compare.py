@@ -0,0 +1,57 @@
+"""
+Compare two benchmark result files.
+
+Usage:
+    python -m benchmarks.compare BASELINE.json CURRENT.json [--threshold 1.1] [--fail]
+
+Prints the median time of every benchmark in both runs and flags those that got slower by more than `threshold`.
+"""
+import argparse
+import json
+import sys
+
+# Result fields that identify a measurement, as opposed to the measurement itself
+KEY_FIELDS = ("benchmark", "rows", "columns", "variant", "format")
+
+
+def result_key(result: dict) -> tuple:
+    return tuple(result.get(field) for field in KEY_FIELDS)
+
+
+def load(path: str) -> tuple[dict, dict]:
+    with open(path) as file:
+        report = json.load(file)
+    return report, {result_key(result): result for result in report["results"]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("baseline")
+    parser.add_argument("current")
+    parser.add_argument("--threshold", type=float, default=1.1, help="Slowdown ratio reported as a regression")
+    parser.add_argument("--fail", action="store_true", help="Exit with an error if any benchmark regressed")
+    args = parser.parse_args()
+
+    baseline_report, baseline = load(args.baseline)
+    current_report, current = load(args.current)
+    print(f"baseline: {baseline_report['git']['commit']}  current: {current_report['git']['commit']}")
+
+    regressions = 0
+    for key, result in current.items():
+        name = " ".join(str(value) for value in key if value is not None)
+        if key not in baseline:
+            print(f"{name:<50} {'-':>10} {result['median']:>10.4f}s  (new)")
+            continue
+        ratio = result["median"] / baseline[key]["median"] if baseline[key]["median"] else float("inf")
+        flag = ""
+        if ratio > args.threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        print(f"{name:<50} {baseline[key]['median']:>10.4f}s {result['median']:>10.4f}s  x{ratio:.2f}{flag}")
+
+    if args.fail and regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+import json
+
+from llmkernel.agent import KernelAgent
+from llmkernel.kernel import PythonLLMKernel
+from toolsets.schema_summary import estimate_tokens
+
+GENERATED_CODE = "```python\ndf['benchmark'] = df.iloc[:, 0]\n```"
+
+
+class FakeAgent(KernelAgent):
+    """
+    Deterministic stand-in for the LLM.
+
+    Requests mentioning "code" are routed to `generate_python_code`, and requests mentioning "info" to
+    `dataset_info`; anything else, and every observation, is answered right away. Prompts are built exactly as they
+    are for the real model, and their (estimated) token counts are recorded in the kernel metrics.
+    """
+
+    def complete(self, messages: list, kind: str, stream: bool = False) -> str:
+        if kind == "oneshot":
+            result = GENERATED_CODE
+        elif messages[-1]["role"] != "user":
+            result = json.dumps({"thought": "Done", "tool": "final_answer", "tool_input": "Done"})
+        elif "code" in messages[-1]["content"]:
+            result = json.dumps({"thought": "Generate code", "tool": "DatasetToolset.generate_python_code", "tool_input": messages[-1]["content"]})
+        elif "info" in messages[-1]["content"]:
+            result = json.dumps({"thought": "Inspect the dataset", "tool": "DatasetToolset.dataset_info", "tool_input": None})
+        else:
+            result = json.dumps({"thought": "Answer", "tool": "final_answer", "tool_input": "Done"})
+        if self.metrics is not None:
+            self.metrics.increment("llm_tokens_total", sum(estimate_tokens(message["content"]) for message in messages), kind=kind, type="prompt")
+            self.metrics.increment("llm_tokens_total", estimate_tokens(result), kind=kind, type="completion")
+        return result
+
+
+class BenchmarkKernel(PythonLLMKernel):
+    """PythonLLMKernel with its agent replaced by `FakeAgent`."""
+
+    def setup_instance(self, *args, **kwargs):
+        result = super().setup_instance(*args, **kwargs)
+        self.agent = FakeAgent(tools=[self.toolset], allow_ask_user=False, verbose=False, spinner=None, rich_print=False)
+        self.agent.metrics = self.metrics
+        self.toolset.agent = self.agent
+        return result
+
+
+if __name__ == '__main__':
+    from ipykernel.kernelapp import IPKernelApp
+    IPKernelApp.launch_instance(kernel_class=BenchmarkKernel)
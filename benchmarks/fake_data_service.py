@@ -0,0 +1,169 @@
+import json
+import os
+import re
+import shutil
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pandas as pd
+
+# Rows generated and written at a time, so datasets of any size can be generated in bounded memory
+GENERATE_BATCH_ROWS = 100_000
+CATEGORIES = np.array(["alpha", "beta", "gamma", "delta", "epsilon"])
+
+DATASET_ID = re.compile(r"^bench-(\d+)x(\d+)$")
+
+
+def dataset_id(rows: int, columns: int) -> str:
+    return f"bench-{rows}x{columns}"
+
+
+def generate_batch(start: int, rows: int, columns: int, seed: int = 0) -> pd.DataFrame:
+    """Rows `start` to `start + rows` of the benchmark dataset. Columns cycle through float, int, string and date."""
+    rng = np.random.default_rng(seed + start)
+    data = {}
+    for column in range(columns):
+        kind = column % 4
+        if kind == 0:
+            data[f"value_{column}"] = rng.random(rows)
+        elif kind == 1:
+            data[f"count_{column}"] = rng.integers(0, 1000, rows)
+        elif kind == 2:
+            data[f"label_{column}"] = CATEGORIES[rng.integers(0, len(CATEGORIES), rows)]
+        else:
+            data[f"date_{column}"] = pd.Timestamp("2020-01-01") + pd.to_timedelta(np.arange(start, start + rows) % 3650, unit="D")
+    return pd.DataFrame(data)
+
+
+def generate_dataset(path: str, rows: int, columns: int, seed: int = 0):
+    """Write a deterministic CSV dataset to `path`, unless it was already generated."""
+    if os.path.exists(path):
+        return
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as file:
+        for start in range(0, rows, GENERATE_BATCH_ROWS):
+            batch = generate_batch(start, min(GENERATE_BATCH_ROWS, rows - start), columns, seed)
+            batch.to_csv(file, index=False, header=(start == 0))
+    os.replace(temp_path, path)
+
+
+class FakeDataServiceHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, body, status=200):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self) -> int:
+        """Read and discard the request body, returning its size."""
+        size = 0
+        if self.headers.get("Transfer-Encoding") == "chunked":
+            while True:
+                chunk_size = int(self.rfile.readline().strip(), 16)
+                if chunk_size == 0:
+                    self.rfile.readline()
+                    return size
+                size += len(self.rfile.read(chunk_size))
+                self.rfile.readline()
+        remaining = int(self.headers.get("Content-Length", 0))
+        while remaining:
+            data = self.rfile.read(min(remaining, 1024 * 1024))
+            size += len(data)
+            remaining -= len(data)
+        return size
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = url.path.strip("/").split("/")
+        host = f"http://{self.headers['Host']}"
+        if parts[0] == "datasets" and len(parts) == 2:
+            match = DATASET_ID.match(parts[1])
+            if not match:
+                return self.send_json({})
+            return self.send_json({
+                "id": parts[1],
+                "name": f"Benchmark dataset {match.group(1)} x {match.group(2)}",
+                "description": "Generated dataset used for benchmarking",
+                "file_names": ["data.csv"],
+            })
+        if parts[0] == "datasets" and len(parts) == 3 and parts[2] in ("download-url", "upload-url"):
+            filename = parse_qs(url.query)["filename"][0]
+            route = "files" if parts[2] == "download-url" else "uploads"
+            return self.send_json({"url": f"{host}/{route}/{parts[1]}/{filename}"})
+        if parts[0] == "files" and len(parts) == 3:
+            return self.send_file(parts[1])
+        self.send_json({}, status=404)
+
+    def send_file(self, dataset_id: str):
+        match = DATASET_ID.match(dataset_id)
+        if not match:
+            return self.send_json({}, status=404)
+        path = self.server.dataset_path(int(match.group(1)), int(match.group(2)))
+        stat = os.stat(path)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/csv")
+        self.send_header("Content-Length", str(stat.st_size))
+        self.send_header("ETag", f'"{stat.st_size}-{int(stat.st_mtime)}"')
+        self.end_headers()
+        with open(path, "rb") as file:
+            shutil.copyfileobj(file, self.wfile, 1024 * 1024)
+
+    def do_POST(self):
+        self.read_body()
+        if urlparse(self.path).path == "/datasets":
+            with self.server.lock:
+                self.server.created += 1
+                return self.send_json({"id": f"saved-{self.server.created}"})
+        self.send_json({}, status=404)
+
+    def do_PUT(self):
+        size = self.read_body()
+        with self.server.lock:
+            self.server.uploaded_bytes += size
+        self.send_json({})
+
+
+class FakeDataService(ThreadingHTTPServer):
+    """
+    Local stand-in for the Terarium data service.
+
+    Dataset `bench-<rows>x<columns>` is generated on first use as a CSV file in `data_dir` and served from disk.
+    Created datasets are given new ids and uploads are read and discarded.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, data_dir: str, port: int = 0):
+        super().__init__(("127.0.0.1", port), FakeDataServiceHandler)
+        self.data_dir = data_dir
+        self.lock = threading.Lock()
+        self.created = 0
+        self.uploaded_bytes = 0
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def dataset_path(self, rows: int, columns: int) -> str:
+        os.makedirs(self.data_dir, exist_ok=True)
+        path = os.path.join(self.data_dir, f"{dataset_id(rows, columns)}.csv")
+        generate_dataset(path, rows, columns)
+        return path
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
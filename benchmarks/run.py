@@ -0,0 +1,305 @@
+"""
+Benchmark the kernel against a local fake data service and a deterministic fake LLM.
+
+Usage:
+    python -m benchmarks.run [--preset quick|full] [--sizes 10000x10,100000x100] [--repeat 3] [--output results.json]
+
+Results are written as JSON, and two result files can be compared with `python -m benchmarks.compare`.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import queue
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from jupyter_client import KernelManager
+
+from benchmarks.fake_data_service import FakeDataService, dataset_id
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# (rows, columns) of the datasets benchmarked by each preset
+PRESETS = {
+    "quick": [(10_000, 10), (10_000, 2_000), (100_000, 100)],
+    "full": [(10_000, 10), (10_000, 2_000), (100_000, 100), (100_000, 2_000), (1_000_000, 10), (1_000_000, 100),
+             (10_000_000, 10)],
+}
+BENCHMARKS = ["context_setup", "preview", "dataset_info", "generate_code", "download", "save"]
+DOWNLOAD_FORMATS = ["csv", "parquet"]
+# Chunks of a download the kernel may send ahead of the client's acknowledgements
+DOWNLOAD_WINDOW = 8
+# Seconds to wait for any single request to finish
+REQUEST_TIMEOUT = 3600
+
+
+class BenchmarkClient:
+    """Starts the benchmark kernel and sends it requests one at a time, timing each until it completes."""
+
+    def __init__(self, service_url: str, env: dict):
+        self.spec_dir = tempfile.TemporaryDirectory()
+        kernel_dir = os.path.join(self.spec_dir.name, "kernels", "llmkernel-benchmark")
+        os.makedirs(kernel_dir)
+        with open(os.path.join(kernel_dir, "kernel.json"), "w") as file:
+            json.dump({
+                "argv": [sys.executable, "-m", "benchmarks.fake_agent", "-f", "{connection_file}"],
+                "display_name": "Chatty LLM Agent (benchmark)",
+                "language": "chatty",
+                "interrupt_mode": "message",
+            }, file)
+        os.environ["JUPYTER_PATH"] = os.pathsep.join(filter(None, [self.spec_dir.name, os.environ.get("JUPYTER_PATH")]))
+
+        kernel_env = dict(
+            os.environ, DATA_SERVICE_URL=service_url, OPENAI_API_KEY="benchmark", PYTHONPATH=REPO_DIR,
+            PYDEVD_DISABLE_FILE_VALIDATION="1",
+        )
+        kernel_env.update(env)
+        self.manager = KernelManager(kernel_name="llmkernel-benchmark")
+        self.manager.start_kernel(cwd=REPO_DIR, env=kernel_env)
+        self.client = self.manager.client()
+        self.client.start_channels()
+        self.client.wait_for_ready(timeout=120)
+
+    def stop(self):
+        self.client.stop_channels()
+        self.manager.shutdown_kernel(now=True)
+        self.spec_dir.cleanup()
+
+    def request(self, msg_type: str, content: dict, done, timeout: float = REQUEST_TIMEOUT) -> tuple[float, dict]:
+        """
+        Send a custom message and wait for the iopub message that `done(msg)` accepts.
+
+        Returns the elapsed seconds and the accepted message. Errors reported on stderr are raised.
+        """
+        msg = self.client.session.msg(msg_type, content)
+        start = time.perf_counter()
+        self.client.shell_channel.send(msg)
+        return self.wait(msg["header"]["msg_id"], done, start, timeout)
+
+    def execute(self, code: str, timeout: float = REQUEST_TIMEOUT) -> float:
+        start = time.perf_counter()
+        msg_id = self.client.execute(code)
+        reply = self.client.get_shell_msg(timeout=timeout)
+        while reply["parent_header"].get("msg_id") != msg_id:
+            reply = self.client.get_shell_msg(timeout=timeout)
+        elapsed = time.perf_counter() - start
+        if reply["content"]["status"] != "ok":
+            raise RuntimeError(f"Cell failed: {reply['content'].get('evalue')}")
+        return elapsed
+
+    def wait(self, msg_id: str, done, start: float, timeout: float) -> tuple[float, dict]:
+        deadline = start + timeout
+        while True:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                raise TimeoutError(f"Request {msg_id} did not finish in {timeout} seconds")
+            try:
+                msg = self.client.get_iopub_msg(timeout=min(remaining, 1))
+            except queue.Empty:
+                continue
+            if msg["parent_header"].get("msg_id") != msg_id:
+                continue
+            if msg["msg_type"] == "stream" and msg["content"].get("name") == "stderr":
+                raise RuntimeError(msg["content"]["text"])
+            if done(msg):
+                return time.perf_counter() - start, msg
+
+    def download(self, data_format: str, window: int = DOWNLOAD_WINDOW, timeout: float = REQUEST_TIMEOUT) -> tuple[float, dict]:
+        """Download `df` as a frontend does, acknowledging chunks as they arrive. Returns as `request()` does."""
+        msg = self.client.session.msg("download_dataset_request", {"format": data_format, "window": window})
+        received = 0
+
+        def done(reply):
+            nonlocal received
+            if reply["msg_type"] == "download_chunk":
+                received += 1
+                self.client.shell_channel.send(self.client.session.msg("download_ack_request", {
+                    "download_id": reply["content"]["download_id"],
+                    "received": received,
+                }))
+            return reply["msg_type"] == "download_complete"
+
+        start = time.perf_counter()
+        self.client.shell_channel.send(msg)
+        return self.wait(msg["header"]["msg_id"], done, start, timeout)
+
+    def metrics(self) -> dict:
+        _, msg = self.request("metrics_request", {"deep": False}, lambda msg: msg["msg_type"] == "metrics_response")
+        return msg["content"]
+
+
+def is_idle(msg: dict) -> bool:
+    return msg["msg_type"] == "status" and msg["content"].get("execution_state") == "idle"
+
+
+def llm_done(msg: dict) -> bool:
+    return msg["msg_type"] == "llm_status" and msg["content"].get("state") in ("done", "error", "cancelled")
+
+
+def histogram(metrics: dict, name: str, **labels) -> dict:
+    for series in metrics["histograms"].get(name, []):
+        if all(series["labels"].get(label) == value for label, value in labels.items()):
+            return series
+    return {"count": 0, "sum": 0.0}
+
+
+def counter(metrics: dict, name: str, **labels) -> float:
+    for series in metrics["counters"].get(name, []):
+        if all(series["labels"].get(label) == value for label, value in labels.items()):
+            return series["value"]
+    return 0
+
+
+def mean_delta(before: dict, after: dict, name: str, **labels) -> float:
+    first = histogram(before, name, **labels)
+    last = histogram(after, name, **labels)
+    count = last["count"] - first["count"]
+    return (last["sum"] - first["sum"]) / count if count else 0.0
+
+
+def summarize(benchmark: str, rows: int, columns: int, seconds: list, **extra) -> dict:
+    result = {
+        "benchmark": benchmark,
+        "rows": rows,
+        "columns": columns,
+        "seconds": seconds,
+        "median": statistics.median(seconds),
+        "min": min(seconds),
+        "max": max(seconds),
+    }
+    result.update(extra)
+    print(f"{benchmark:>24} {rows:>10,} x {columns:<6,} median {result['median']:.4f}s  {json.dumps(extra)}", flush=True)
+    return result
+
+
+def run_size(client: BenchmarkClient, rows: int, columns: int, benchmarks: list, repeat: int) -> list:
+    results = []
+    context = {"context": "dataset", "context_info": {"id": dataset_id(rows, columns)}}
+
+    seconds = [client.request("context_setup_request", context, is_idle)[0] for _ in range(repeat)]
+    if "context_setup" in benchmarks:
+        results.append(summarize("context_setup", rows, columns, seconds))
+
+    if "preview" in benchmarks:
+        # Cells that leave the head of `df` alone only pay for the change check; cells that edit it send a delta
+        for variant, template in (("unchanged", "x = {}"), ("changed", "df.iat[0, 0] = {}")):
+            before = client.metrics()
+            seconds = [client.execute(template.format(idx)) for idx in range(repeat)]
+            after = client.metrics()
+            results.append(summarize(
+                "preview", rows, columns, seconds, variant=variant,
+                preview_seconds=mean_delta(before, after, "kernel_handler_seconds", handler="df_preview"),
+            ))
+
+    for benchmark, query in (("dataset_info", "Show me info about the dataset"), ("generate_code", "Write code to copy a column")):
+        if benchmark not in benchmarks:
+            continue
+        tool = "DatasetToolset.dataset_info" if benchmark == "dataset_info" else "DatasetToolset.generate_python_code"
+        before = client.metrics()
+        seconds = [client.request("llm_request", {"request": query, "cache": False}, llm_done)[0] for _ in range(repeat)]
+        after = client.metrics()
+        prompt_tokens = sum(
+            counter(after, "llm_tokens_total", kind=kind, type="prompt") - counter(before, "llm_tokens_total", kind=kind, type="prompt")
+            for kind in ("react", "oneshot")
+        )
+        results.append(summarize(
+            benchmark, rows, columns, seconds,
+            tool_seconds=mean_delta(before, after, "llm_tool_seconds", tool=tool),
+            prompt_tokens=prompt_tokens / repeat,
+        ))
+
+    if "download" in benchmarks:
+        for data_format in DOWNLOAD_FORMATS:
+            seconds = []
+            for _ in range(repeat):
+                elapsed, msg = client.download(data_format)
+                seconds.append(elapsed)
+            results.append(summarize("download", rows, columns, seconds, format=data_format, bytes=msg["content"]["size"]))
+
+    if "save" in benchmarks:
+        content = {"parent_dataset_id": dataset_id(rows, columns), "name": "Benchmark result"}
+        seconds = [
+            client.request("save_dataset_request", content, lambda msg: msg["msg_type"] == "save_dataset_response")[0]
+            for _ in range(repeat)
+        ]
+        results.append(summarize("save", rows, columns, seconds, format="csv"))
+
+    return results
+
+
+def git_info() -> dict:
+    def git(*args):
+        try:
+            return subprocess.run(["git", *args], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    return {"commit": git("rev-parse", "HEAD"), "dirty": bool(git("status", "--porcelain", "--untracked-files=no"))}
+
+
+def parse_sizes(sizes: str) -> list:
+    return [tuple(int(value) for value in size.lower().split("x")) for size in sizes.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--preset", choices=PRESETS, default="quick")
+    parser.add_argument("--sizes", help="Comma separated dataset sizes as ROWSxCOLUMNS, instead of a preset")
+    parser.add_argument("--benchmarks", default=",".join(BENCHMARKS), help="Comma separated benchmarks to run")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "jupyter-llm-benchmarks"),
+                        help="Where generated datasets are kept between runs")
+    parser.add_argument("--cache", action="store_true", help="Leave the dataset and code caches enabled")
+    parser.add_argument("--output", help="Result file (default: benchmarks/results/<commit>-<timestamp>.json)")
+    args = parser.parse_args()
+
+    sizes = parse_sizes(args.sizes) if args.sizes else PRESETS[args.preset]
+    benchmarks = args.benchmarks.split(",")
+    env = {}
+    if not args.cache:
+        env.update(DATASET_CACHE_MAX_BYTES="0", CODE_CACHE_TTL="0")
+
+    service = FakeDataService(args.data_dir)
+    service.start()
+    started = datetime.datetime.utcnow()
+    results = []
+    try:
+        for rows, columns in sizes:
+            print(f"Generating dataset {rows:,} x {columns:,}", flush=True)
+            service.dataset_path(rows, columns)
+            # Every size gets a fresh kernel, so memory use and caches don't carry over
+            client = BenchmarkClient(service.url, env)
+            try:
+                results.extend(run_size(client, rows, columns, benchmarks, args.repeat))
+            finally:
+                client.stop()
+    finally:
+        service.stop()
+
+    git = git_info()
+    report = {
+        "started": started.isoformat() + "Z",
+        "git": git,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "repeat": args.repeat,
+        "cache": args.cache,
+        "results": results,
+    }
+    output = args.output or os.path.join(
+        REPO_DIR, "benchmarks", "results", f"{(git['commit'] or 'unknown')[:12]}-{started.strftime('%Y%m%dT%H%M%S')}.json",
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as file:
+        json.dump(report, file, indent=2)
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
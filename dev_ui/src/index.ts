@@ -143,7 +143,18 @@ function createApp(manager: ServiceManager.IManager): void {
       notebook.model.cells.nbmodel.addCell({id: `${msg.id}-text`, cell_type: 'markdown', source: msg.content.text});
     }
     else if (msg.msg_type === "dataset") {
-      dataPreview.textContent = formatDataPreview(msg.content);
+      currentPreview = msg.content;
+      dataPreview.textContent = formatDataPreview(currentPreview);
+    }
+    else if (msg.msg_type === "dataset_delta") {
+      if (currentPreview && currentPreview.version === msg.content.base_version) {
+        currentPreview = applyPreviewDelta(currentPreview, msg.content);
+        dataPreview.textContent = formatDataPreview(currentPreview);
+      }
+      else {
+        // A version was missed, so the delta can't be applied; ask for the full preview again
+        requestPreview();
+      }
     }
     else if (msg.msg_type === "code_cell") {
       const code = msg.content.code;
@@ -171,6 +182,21 @@ function createApp(manager: ServiceManager.IManager): void {
   // Hide the widget when it first loads.
   completer.hide();
 
+  let currentPreview = null;
+
+  // Row positions in a delta are relative to the data rows, which follow the header row in `csv`.
+  const applyPreviewDelta = (preview, delta) => {
+    const csv = preview.csv.map((line) => [...line]);
+    for (const [pos, values] of delta.rows || []) {
+      csv[pos + 1] = values;
+    }
+    for (const [pos, name, values] of delta.columns || []) {
+      csv[0][pos] = name;
+      values.forEach((value, idx) => { csv[idx + 1][pos] = value; });
+    }
+    return {...preview, csv, headers: csv[0], version: delta.version};
+  };
+
   const formatDataPreview = (preview) => {
     const output = [];
     for (const line of preview.csv) {
@@ -179,13 +205,29 @@ function createApp(manager: ServiceManager.IManager): void {
     return output.join("\n");
   };
 
+  const requestPreview = () => {
+    const session = sessionContext.session;
+    const kernel = session?.kernel;
+    if (kernel) {
+      const message: JupyterMessage = createMessage({
+        session: session?.name || '',
+        channel: 'shell',
+        content: {},
+        msgType: 'preview_request',
+        msgId: `${kernel.id}-preview`
+      });
+      kernel.sendShellMessage(message);
+    }
+  };
+
   const setKernelContext = (context_info) => {
     const session = sessionContext.session;
     const kernel = session?.kernel;
     const messageBody = {
       session: session?.name || '',
       channel: 'shell',
-      content: context_info,
+      // This frontend applies preview deltas, so it asks for them
+      content: {...context_info, preview_deltas: true},
       msgType: 'context_setup_request',
       msgId: `${kernel.id}-setcontext`
     };
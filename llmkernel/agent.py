@@ -0,0 +1,358 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+from typing import Callable, Optional
+
+import openai
+from archytas.agent import ContextMessage, Message, Role, retry
+from archytas.react import FailedTaskError, ReActAgent
+
+from toolsets.schema_summary import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# Tokens the conversation history may take up before older requests are condensed into a summary, and the number of
+# most recent requests that are kept verbatim. A budget of 0 lets the history grow unbounded.
+LLM_CONTEXT_TOKEN_BUDGET = int(os.environ.get("LLM_CONTEXT_TOKEN_BUDGET", 6000))
+LLM_CONTEXT_KEEP_TURNS = int(os.environ.get("LLM_CONTEXT_KEEP_TURNS", 2))
+# Characters of each request and answer kept in its summary
+SUMMARY_TEXT_LENGTH = 300
+# The LLM broker of the Jupyter server this kernel was started by, which is set in its environment by main.py. LLM calls
+# go through it if it is set, and straight to the LLM provider if not or if it can't be reached. Calls are attributed
+# to LLM_BROKER_USER, or to this kernel if not set, unless the request says which user it is for.
+LLM_BROKER_URL = os.environ.get("LLM_BROKER_URL", None)
+LLM_BROKER_TOKEN = os.environ.get("LLM_BROKER_TOKEN", "")
+LLM_BROKER_USER = os.environ.get("LLM_BROKER_USER", None)
+
+
+class LLMRequestCancelled(Exception):
+    """Raised inside the ReAct loop when the request driving it has been cancelled."""
+
+
+class KernelAgent(ReActAgent):
+    """
+    ReActAgent that can be run off the kernel event loop.
+
+    The agent is driven from a worker thread by the kernel. A cancel event can be attached to each `react()` call and
+    is checked before every LLM call, so an interrupted request stops at the next ReAct step instead of running to
+    completion in the background.
+
+    If an `on_event` callback is passed to `react()`, completions are streamed and the callback is called from the
+    worker thread with:
+        ("token", step=int, text=str)                                    the completion text received so far
+        ("action", step=int, thought=str, tool=str, tool_input=object)   a parsed ReAct action
+        ("observation", step=int, tool=str, output=str)                  the output of a tool that was run
+
+    If `metrics` is set, the latency and token usage of every LLM call and the latency of every tool call are recorded
+    on it. Token counts of streamed completions are estimated, as streamed responses don't report usage.
+
+    The conversation history is kept within `context_budget` tokens: once it grows past that, all but the most recent
+    `keep_turns` requests are condensed into one-line summaries (see `compact_history`). Context messages are kept.
+
+    LLM calls are sent through the server's LLM broker when there is one, on behalf of `user` and with `priority`
+    ("interactive" while the kernel is answering an `llm_request`, "background" otherwise).
+    """
+
+    def __init__(self, *args, context_budget: int = LLM_CONTEXT_TOKEN_BUDGET, keep_turns: int = LLM_CONTEXT_KEEP_TURNS,
+                 **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cancel_event: Optional[threading.Event] = None
+        self.on_event: Optional[Callable] = None
+        self.metrics = None
+        self.tool_started = None
+        self.context_budget = context_budget
+        self.keep_turns = keep_turns
+        self.summary_lines = []
+        self.summary_context = None
+        self.user = LLM_BROKER_USER
+        self.priority = "background"
+
+    def check_cancelled(self):
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise LLMRequestCancelled("LLM request was cancelled.")
+
+    def emit(self, event, **data):
+        if self.on_event is not None:
+            try:
+                self.on_event(event, **data)
+            except Exception:
+                logger.exception("Error in agent event callback")
+
+    def react(self, query: str, cancel_event: Optional[threading.Event] = None, on_event: Optional[Callable] = None) -> str:
+        self.cancel_event = cancel_event
+        self.on_event = on_event
+        try:
+            result = super().react(query)
+            # Tools that end the loop (e.g. generate_python_code) are never observed
+            self.finish_tool("ok")
+            return result
+        finally:
+            self.finish_tool("error")
+            self.cancel_event = None
+            self.on_event = None
+
+    def extract_action(self, action: dict) -> tuple[str, str, str]:
+        thought, tool_name, tool_input = super().extract_action(action)
+        self.emit("action", step=self.steps, thought=thought, tool=tool_name, tool_input=tool_input)
+        if tool_name not in ("final_answer", "fail_task"):
+            self.tool_started = (tool_name, time.monotonic())
+        return thought, tool_name, tool_input
+
+    def finish_tool(self, status: str):
+        if self.tool_started is None:
+            return
+        tool_name, start = self.tool_started
+        self.tool_started = None
+        if self.metrics is not None:
+            self.metrics.observe("llm_tool_seconds", time.monotonic() - start, tool=tool_name, status=status)
+
+    def observe(self, observation: str) -> str:
+        self.finish_tool("ok")
+        self.emit("observation", step=self.steps, tool=self.last_tool_name, output=observation)
+        return super().observe(observation)
+
+    def error(self, mesg) -> str:
+        # Tool errors are reported back to the agent through here
+        self.finish_tool("error")
+        return super().error(mesg)
+
+    def execute(self) -> str:
+        self.check_cancelled()
+        self.steps += 1
+        if self.steps > self.max_react_steps:
+            raise FailedTaskError(f"Too many steps ({self.steps} > max_react_steps) during task.\nLast action should have been either final_answer or fail_task. Instead got: {self.last_tool_name}")
+        self.compact_history()
+        result = self.complete([self.system_message] + self.messages, kind="react", stream=self.on_event is not None)
+        self.messages.append(Message(role=Role.assistant, content=result))
+        self.update_timed_context()
+        return result
+
+    def history_tokens(self, messages: Optional[list] = None) -> int:
+        messages = self.messages if messages is None else messages
+        return sum(estimate_tokens(message["content"]) for message in [self.system_message] + messages)
+
+    def compact_history(self):
+        """
+        Condense the oldest requests in the history into a summary once it goes over `context_budget` tokens.
+
+        Every request (a user message and the steps that followed it) but the last `keep_turns` is replaced by a line
+        in a summary context message, and if that isn't enough, so are the more recent ones, up to the request in
+        progress, and then the oldest summary lines are dropped. Context messages, such as the dataset description,
+        are always kept, ahead of the summary.
+        """
+        if self.context_budget <= 0 or self.history_tokens() <= self.context_budget:
+            return
+        contexts = []
+        turns = []
+        for message in self.messages:
+            if isinstance(message, ContextMessage):
+                if message.id != self.summary_context:
+                    contexts.append(message)
+            elif message["role"] == Role.user or not turns:
+                turns.append([message])
+            else:
+                turns[-1].append(message)
+
+        def rebuild():
+            summary = []
+            if self.summary_lines:
+                content = "Summary of earlier requests in this conversation:\n" + "\n".join(self.summary_lines)
+                summary.append(ContextMessage(role=Role.system, content=content, id=self.summary_context))
+            return contexts + summary + [message for turn in turns for message in turn]
+
+        if self.summary_context is None:
+            self.summary_context = self.new_context_id()
+        condensed = 0
+        # The request in progress is never condensed, as the ReAct loop is still working on it
+        while len(turns) > 1 and (len(turns) > self.keep_turns + 1 or self.history_tokens(rebuild()) > self.context_budget):
+            self.summary_lines.append(summarize_turn(turns.pop(0)))
+            condensed += 1
+        while self.summary_lines and self.history_tokens(rebuild()) > self.context_budget:
+            self.summary_lines.pop(0)
+        self.messages = rebuild()
+        if self.metrics is not None and condensed:
+            self.metrics.increment("llm_context_compactions_total", condensed)
+
+    def clear_all_context(self):
+        super().clear_all_context()
+        self.summary_lines = []
+
+    def record_exchange(self, query: str, tool: str, tool_input):
+        """Add a request that was answered without calling the LLM to the history, as the call to `tool` it stands for."""
+        self.messages.append(Message(role=Role.user, content=query))
+        action = {"thought": "This request was answered before.", "tool": tool, "tool_input": tool_input}
+        self.messages.append(Message(role=Role.assistant, content=json.dumps(action)))
+
+    def oneshot(self, prompt: str, query: str) -> str:
+        self.check_cancelled()
+        messages = [Message(role=Role.system, content=prompt), Message(role=Role.user, content=query)]
+        return self.complete(messages, kind="oneshot")
+
+    @retry
+    def complete(self, messages: list, kind: str, stream: bool = False) -> str:
+        start = time.monotonic()
+        with self.spinner():
+            if stream:
+                result = self.stream_completion(messages)
+                usage = {
+                    "prompt_tokens": sum(estimate_tokens(message["content"]) for message in messages),
+                    "completion_tokens": estimate_tokens(result),
+                }
+            else:
+                completion = self.create_completion(model=self.model, messages=messages, temperature=0)
+                result = completion.choices[0].message.content
+                usage = completion.get("usage", {})
+        if self.metrics is not None:
+            self.metrics.observe("llm_completion_seconds", time.monotonic() - start, kind=kind)
+            for token_type in ("prompt", "completion"):
+                self.metrics.increment("llm_tokens_total", usage.get(f"{token_type}_tokens", 0), kind=kind, type=token_type)
+        return result
+
+    def create_completion(self, **params):
+        if LLM_BROKER_URL:
+            headers = {"X-LLM-User": self.user or "", "X-LLM-Priority": self.priority}
+            try:
+                return openai.ChatCompletion.create(
+                    api_base=LLM_BROKER_URL, api_key=LLM_BROKER_TOKEN, headers=headers, **params
+                )
+            except openai.error.APIConnectionError:
+                logger.warning("Unable to reach the LLM broker at %s, calling the LLM provider directly", LLM_BROKER_URL)
+        return openai.ChatCompletion.create(**params)
+
+    def stream_completion(self, messages: list) -> str:
+        step = self.steps
+        chunks = []
+        for chunk in self.create_completion(model=self.model, messages=messages, temperature=0, stream=True):
+            self.check_cancelled()
+            delta = chunk.choices[0].delta.get("content", None)
+            if delta:
+                chunks.append(delta)
+                self.emit("token", step=step, text="".join(chunks))
+        return "".join(chunks)
+
+
+def shorten(text: str, length: int = SUMMARY_TEXT_LENGTH) -> str:
+    text = " ".join(str(text).split())
+    return text if len(text) <= length else text[:length - 3] + "..."
+
+
+def summarize_turn(turn: list) -> str:
+    """One line describing a request from the history: what was asked, which tools were used, and the answer."""
+    query = turn[0]["content"] if turn[0]["role"] == Role.user else ""
+    tools = []
+    answer = None
+    for message in turn[1:]:
+        if message["role"] != Role.assistant:
+            continue
+        try:
+            action = json.loads(message["content"])
+            tool, tool_input = action["tool"], action.get("tool_input")
+        except (ValueError, KeyError, TypeError):
+            continue
+        if tool == "final_answer":
+            answer = tool_input
+        elif tool not in tools:
+            tools.append(tool)
+    line = f"- The user asked: {shorten(query)}"
+    if tools:
+        line += f" | Tools used: {', '.join(tools)}"
+    if answer is not None:
+        line += f" | You answered: {shorten(answer)}"
+    return line
+
+
+def partial_json_string(text: str, key: str) -> Optional[str]:
+    """
+    Return the (possibly incomplete) string value of `key` from a partially received JSON object, or None if the value
+    has not started yet.
+    """
+    match = re.search(r'"%s"\s*:\s*"' % re.escape(key), text)
+    if not match:
+        return None
+    raw = []
+    idx = match.end()
+    while idx < len(text):
+        char = text[idx]
+        if char == "\\":
+            # Stop before escape sequences that have not been fully received yet
+            width = 6 if text[idx + 1:idx + 2] == "u" else 2
+            if idx + width > len(text):
+                break
+            raw.append(text[idx:idx + width])
+            idx += width
+            continue
+        if char == '"':
+            break
+        raw.append(char)
+        idx += 1
+    try:
+        return json.loads('"' + "".join(raw) + '"')
+    except ValueError:
+        return None
+
+
+class ReActStreamRelay:
+    """
+    Translates KernelAgent events into incremental messages.
+
+    The "thought" of each step is relayed as `llm_event` thought chunks as it is generated, the `tool_input` of a
+    `final_answer` action is relayed as partial `llm_response` chunks, and every tool call and result is relayed as
+    an `llm_event`. `send` is called with (msg_type, content).
+    """
+
+    def __init__(self, request_id: str, send: Callable[[str, dict], None]):
+        self.request_id = request_id
+        self.send = send
+        self.step = None
+        self.sent = {}
+
+    def __call__(self, event, **data):
+        step = data.get("step")
+        if step != self.step:
+            self.step = step
+            self.sent = {}
+        match event:
+            case "token":
+                text = data["text"]
+                self.relay_field(text, "thought", "llm_event", {"event": "thought"})
+                if re.search(r'"tool"\s*:\s*"final_answer"', text):
+                    self.relay_field(text, "tool_input", "llm_response", {"name": "response_text"})
+            case "action":
+                if data["tool"] in ("final_answer", "fail_task"):
+                    return
+                self.send("llm_event", {
+                    "request_id": self.request_id,
+                    "step": step,
+                    "event": "tool_call",
+                    "thought": data["thought"],
+                    "tool": data["tool"],
+                    "tool_input": data["tool_input"],
+                })
+            case "observation":
+                self.send("llm_event", {
+                    "request_id": self.request_id,
+                    "step": step,
+                    "event": "tool_result",
+                    "tool": data["tool"],
+                    "output": data["output"],
+                })
+
+    def relay_field(self, text, key, msg_type, content):
+        value = partial_json_string(text, key)
+        if not value:
+            return
+        sent = self.sent.get(key, "")
+        # A retried completion starts over; only relay text that extends what was already sent
+        if not value.startswith(sent) or len(value) == len(sent):
+            return
+        self.sent[key] = value
+        self.send(msg_type, {
+            **content,
+            "request_id": self.request_id,
+            "step": self.step,
+            "text": value[len(sent):],
+            "partial": True,
+        })
@@ -0,0 +1,342 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict, deque
+from typing import Callable, Optional
+
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+
+from toolsets.schema_summary import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# Limits the broker keeps LLM calls from all kernels within, combined: requests and tokens per minute (0 for no limit)
+# and calls in flight at once.
+LLM_BROKER_REQUESTS_PER_MINUTE = float(os.environ.get("LLM_BROKER_REQUESTS_PER_MINUTE", 500))
+LLM_BROKER_TOKENS_PER_MINUTE = float(os.environ.get("LLM_BROKER_TOKENS_PER_MINUTE", 0))
+LLM_BROKER_MAX_CONCURRENCY = int(os.environ.get("LLM_BROKER_MAX_CONCURRENCY", 16))
+# Times a call rejected by the provider with a 429 is retried by the broker before the error is passed on
+LLM_BROKER_MAX_RETRIES = int(os.environ.get("LLM_BROKER_MAX_RETRIES", 5))
+LLM_BROKER_TIMEOUT = float(os.environ.get("LLM_BROKER_TIMEOUT", 600))
+LLM_BROKER_UPSTREAM_URL = os.environ.get(
+    "LLM_BROKER_UPSTREAM_URL", os.environ.get("OPENAI_API_BASE", "https://api.openai.com/v1")
+)
+
+# Calls are served by priority first, then round robin between users
+PRIORITIES = ("interactive", "background")
+# Seconds to back off for after a 429 that doesn't say how long to wait, doubled on each retry
+RETRY_BACKOFF = 1.0
+RETRY_MAX_BACKOFF = 60.0
+
+
+class TokenBucket:
+    """Allows `rate` units per second on average, in bursts of up to `capacity` units."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.level = capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until `amount` units are available. Amounts beyond the capacity only need a full bucket."""
+        self.refill()
+        missing = min(amount, self.capacity) - self.level
+        return max(missing / self.rate, 0.0)
+
+    def take(self, amount: float):
+        self.refill()
+        self.level -= min(amount, self.capacity)
+
+    def give(self, amount: float):
+        """Return (or, if negative, take) units once the actual cost of a call is known. The level may go negative."""
+        self.refill()
+        self.level = min(self.capacity, self.level + amount)
+
+
+def minute_bucket(per_minute: float) -> Optional[TokenBucket]:
+    return TokenBucket(per_minute / 60, per_minute) if per_minute > 0 else None
+
+
+def estimate_cost(body: dict) -> int:
+    """Tokens a call is expected to use: its prompt, and its completion if it is bounded."""
+    prompt = sum(estimate_tokens(str(message.get("content") or "")) for message in body.get("messages", []))
+    return prompt + int(body.get("max_tokens") or 0)
+
+
+def broker_url(serverapp) -> Optional[str]:
+    """
+    URL the kernels of `serverapp` reach its broker at: with the scheme the server serves, on the interface it listens
+    on (the loopback one if it listens on all of them). None if the server only listens on a Unix socket, which the
+    kernels' HTTP client can't connect to.
+    """
+    if getattr(serverapp, "sock", ""):
+        return None
+    scheme = "https" if serverapp.certfile else "http"
+    host = serverapp.ip
+    if host in ("", "*", "0.0.0.0"):
+        host = "127.0.0.1"
+    elif host == "::":
+        host = "::1"
+    if ":" in host:
+        host = f"[{host}]"
+    path = "/".join(part for part in (serverapp.base_url.strip("/"), "llm-broker") if part)
+    return f"{scheme}://{host}:{serverapp.port}/{path}"
+
+
+def coalesce_key(body: dict) -> str:
+    return hashlib.sha256(json.dumps(body, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def retry_after(headers) -> Optional[float]:
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+class Ticket:
+    """A call waiting for its turn. `granted` is resolved once it may be sent."""
+
+    def __init__(self, user: str, priority: str, cost: int):
+        self.user = user
+        self.priority = priority
+        self.cost = cost
+        self.queued = time.monotonic()
+        self.granted = asyncio.get_running_loop().create_future()
+
+
+class LLMBroker:
+    """
+    Sends the chat completion calls of every kernel on this server to the LLM provider, within shared limits.
+
+    Calls wait in a queue per priority and user. Whenever a slot is free and the request and token buckets allow it,
+    the next call is taken from the highest priority that has any, going round robin between its users, so a user
+    with many calls queued can't hold up everyone else, and interactive calls never wait behind background work.
+    Token costs are estimated up front and corrected with the usage the provider reports.
+
+    Identical calls that aren't streamed are merged while one of them is in flight: they all get the result of a
+    single call. A 429 from the provider pauses all calls for as long as it asks (or an exponential backoff) and the
+    call is retried, so kernels don't each hammer the provider with their own retries.
+    """
+
+    def __init__(self, upstream_url: str = LLM_BROKER_UPSTREAM_URL, api_key: Optional[str] = None,
+                 requests_per_minute: float = LLM_BROKER_REQUESTS_PER_MINUTE,
+                 tokens_per_minute: float = LLM_BROKER_TOKENS_PER_MINUTE,
+                 max_concurrency: int = LLM_BROKER_MAX_CONCURRENCY, max_retries: int = LLM_BROKER_MAX_RETRIES,
+                 timeout: float = LLM_BROKER_TIMEOUT):
+        self.url = upstream_url.rstrip("/") + "/chat/completions"
+        self.api_key = api_key if api_key is not None else os.environ.get("OPENAI_API_KEY", "")
+        self.requests = minute_bucket(requests_per_minute)
+        self.tokens = minute_bucket(tokens_per_minute)
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.http = None
+        # Priority -> user -> queued tickets. Users are moved to the end once served, which makes the round robin.
+        self.queues = {priority: OrderedDict() for priority in PRIORITIES}
+        self.active = 0
+        self.paused_until = 0.0
+        self.timer = None
+        # Coalescing key -> task of the call in flight
+        self.inflight = {}
+        self.counts = {"requests": 0, "coalesced": 0, "upstream_calls": 0, "rate_limited": 0, "errors": 0}
+
+    # Scheduling
+
+    async def acquire(self, user: str, priority: str, cost: int) -> Ticket:
+        """Wait for the turn of a call, which must then be passed to `release` once done."""
+        ticket = Ticket(user, priority, cost)
+        self.queues[priority].setdefault(user, deque()).append(ticket)
+        self.schedule()
+        try:
+            await ticket.granted
+        except asyncio.CancelledError:
+            if ticket.granted.done() and not ticket.granted.cancelled():
+                self.release(ticket)
+            else:
+                self.dequeue(ticket)
+            raise
+        return ticket
+
+    def release(self, ticket: Ticket, tokens_used: Optional[int] = None):
+        self.active -= 1
+        if self.tokens is not None and tokens_used is not None:
+            self.tokens.give(min(ticket.cost, self.tokens.capacity) - tokens_used)
+        self.schedule()
+
+    def dequeue(self, ticket: Ticket):
+        queue = self.queues[ticket.priority].get(ticket.user)
+        if queue is not None and ticket in queue:
+            queue.remove(ticket)
+            if not queue:
+                del self.queues[ticket.priority][ticket.user]
+
+    def next_ticket(self) -> Optional[Ticket]:
+        for priority in PRIORITIES:
+            for queue in self.queues[priority].values():
+                return queue[0]
+        return None
+
+    def wait_time(self, ticket: Ticket) -> float:
+        wait = self.paused_until - time.monotonic()
+        if self.requests is not None:
+            wait = max(wait, self.requests.wait_time(1))
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.wait_time(ticket.cost))
+        return wait
+
+    def schedule(self):
+        """Grant the turn of as many queued calls as the limits allow, and wake up again when more can go."""
+        while self.active < self.max_concurrency:
+            ticket = self.next_ticket()
+            if ticket is None:
+                return
+            wait = self.wait_time(ticket)
+            if wait > 0:
+                if self.timer is None:
+                    self.timer = asyncio.get_running_loop().call_later(wait, self.wake_up)
+                return
+            users = self.queues[ticket.priority]
+            users[ticket.user].popleft()
+            if users[ticket.user]:
+                users.move_to_end(ticket.user)
+            else:
+                del users[ticket.user]
+            if self.requests is not None:
+                self.requests.take(1)
+            if self.tokens is not None:
+                self.tokens.take(ticket.cost)
+            self.active += 1
+            ticket.granted.set_result(None)
+
+    def wake_up(self):
+        self.timer = None
+        self.schedule()
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    # Calls
+
+    def client(self) -> AsyncHTTPClient:
+        if self.http is None:
+            self.http = AsyncHTTPClient(force_instance=True, max_clients=max(self.max_concurrency, 10))
+        return self.http
+
+    def upstream_request(self, body: dict, **kwargs) -> HTTPRequest:
+        return HTTPRequest(
+            self.url,
+            method="POST",
+            headers={"Content-Type": "application/json", "Authorization": f"Bearer {self.api_key}"},
+            body=json.dumps(body),
+            request_timeout=self.timeout,
+            **kwargs,
+        )
+
+    async def complete(self, body: dict, user: str, priority: str) -> tuple[int, bytes]:
+        """Make a call that isn't streamed, merged with any identical one in flight. Returns (status, body)."""
+        self.counts["requests"] += 1
+        key = coalesce_key(body)
+        task = self.inflight.get(key)
+        if task is not None:
+            self.counts["coalesced"] += 1
+        else:
+            # Run on its own, so the call still completes for the others if the kernel that started it goes away
+            task = asyncio.ensure_future(self.call(body, user, priority))
+            self.inflight[key] = task
+            task.add_done_callback(lambda _: self.inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def call(self, body: dict, user: str, priority: str) -> tuple[int, bytes]:
+        for attempt in range(self.max_retries + 1):
+            ticket = await self.acquire(user, priority, estimate_cost(body))
+            tokens_used = None
+            try:
+                self.counts["upstream_calls"] += 1
+                response = await self.client().fetch(self.upstream_request(body), raise_error=False)
+                if response.code == 200:
+                    try:
+                        tokens_used = json.loads(response.body).get("usage", {}).get("total_tokens") or None
+                    except ValueError:
+                        pass
+            finally:
+                self.release(ticket, tokens_used)
+            if response.code != 429 or attempt == self.max_retries:
+                break
+            self.rate_limited(response.headers, attempt)
+        if response.code != 200:
+            self.counts["errors"] += 1
+        return response.code, self.response_body(response)
+
+    async def stream(self, body: dict, user: str, priority: str, write: Callable[[bytes], None]) -> tuple[int, bytes]:
+        """
+        Make a streamed call, passing the chunks of a successful response to `write` as they arrive. Returns the
+        status and, unless it succeeded, the body of the error.
+        """
+        self.counts["requests"] += 1
+        for attempt in range(self.max_retries + 1):
+            ticket = await self.acquire(user, priority, estimate_cost(body))
+            status = {}
+            error = []
+
+            def on_header(line: str):
+                if line.startswith("HTTP/"):
+                    status["code"] = int(line.split(" ", 2)[1])
+
+            def on_chunk(chunk: bytes):
+                if status.get("code") == 200:
+                    write(chunk)
+                else:
+                    error.append(chunk)
+
+            try:
+                self.counts["upstream_calls"] += 1
+                response = await self.client().fetch(
+                    self.upstream_request(body, header_callback=on_header, streaming_callback=on_chunk),
+                    raise_error=False,
+                )
+            finally:
+                self.release(ticket)
+            if response.code != 429 or attempt == self.max_retries:
+                break
+            self.rate_limited(response.headers, attempt)
+        if response.code != 200:
+            self.counts["errors"] += 1
+            return response.code, b"".join(error) or self.response_body(response)
+        return response.code, b""
+
+    def rate_limited(self, headers, attempt: int):
+        self.counts["rate_limited"] += 1
+        delay = retry_after(headers)
+        if delay is None:
+            delay = min(RETRY_BACKOFF * 2 ** attempt, RETRY_MAX_BACKOFF)
+        logger.warning("LLM provider is rate limiting calls, pausing for %.1fs", delay)
+        self.pause(delay)
+
+    @staticmethod
+    def response_body(response) -> bytes:
+        if response.body:
+            return response.body
+        # Connection errors and timeouts have no response, so are reported as an OpenAI style error
+        message = str(response.error) if response.error is not None else "No response from the LLM provider"
+        return json.dumps({"error": {"message": message, "type": "broker_error"}}).encode()
+
+    def stats(self) -> dict:
+        return {
+            **self.counts,
+            "active": self.active,
+            "queued": {
+                priority: sum(len(queue) for queue in users.values()) for priority, users in self.queues.items()
+            },
+            "inflight": len(self.inflight),
+            "paused_seconds": max(self.paused_until - time.monotonic(), 0.0),
+        }
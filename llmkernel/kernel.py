@@ -1,22 +1,66 @@
+import asyncio
 import copy
 import datetime
-import io
 import json
 import logging
 import os
-import requests
-import tempfile
+import re
 import time
+import threading
 import traceback
 import pandas as pd
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from tornado.ioloop import PeriodicCallback
 
 from ipykernel.kernelbase import Kernel
 from ipykernel.ipkernel import IPythonKernel
+from toolsets.data_service import data_service
+from toolsets.dataset_profile import frame_fingerprint
 from toolsets.dataset_toolset import DatasetToolset
-from archytas.react import ReActAgent
+from toolsets.code_cache import generated_code
+from toolsets.code_lint import CODE_LINT, check_mode as check_lint_mode
+from toolsets.dry_run import CODE_DRY_RUN, check_mode as check_dry_run_mode
+from toolsets.dtype_optimizer import DATASET_OPTIMIZE_DTYPES
+from toolsets.lazy_dataset import DATASET_BACKEND, is_relation
+from toolsets.profile_sidecar import DATASET_PROFILE_SIDECAR, SIDECAR_MIMETYPE, profile_bytes, sidecar_name
+from llmkernel.agent import KernelAgent, LLMRequestCancelled, ReActStreamRelay
+from llmkernel.metrics import KernelMetrics, max_rss_bytes, write_textfile
+from llmkernel.paging import PageRequest, PreviewPager
+from llmkernel.preview import PreviewTracker
+from llmkernel.serialization import CHUNK_SIZE, FORMATS, iter_dataframe_bytes
+from llmkernel.snapshots import SnapshotHistory, may_change
+from llmkernel.upload import iter_file, put_bytes, put_file, put_resumable, put_stream, spool
 
 logger = logging.getLogger(__name__)
 
+# Maximum number of LLM requests that may be running or waiting to run at once. Requests beyond this are rejected.
+LLM_MAX_INFLIGHT_REQUESTS = int(os.environ.get("LLM_MAX_INFLIGHT_REQUESTS", 4))
+# Whether llm_requests stream partial responses and ReAct steps by default. Can be overridden per request.
+LLM_STREAM_RESPONSES = os.environ.get("LLM_STREAM_RESPONSES", "false").lower() in ("1", "true", "yes")
+# Whether datasets are loaded progressively by default, and how many rows are loaded up front when they are.
+DATASET_PROGRESSIVE_LOAD = os.environ.get("DATASET_PROGRESSIVE_LOAD", "false").lower() in ("1", "true", "yes")
+DATASET_PREVIEW_ROWS = int(os.environ.get("DATASET_PREVIEW_ROWS", 10_000))
+# If set, every kernel periodically writes its metrics in the Prometheus text format to a file in this directory, for
+# a node exporter textfile collector (or similar) to pick up.
+KERNEL_METRICS_EXPORT_DIR = os.environ.get("KERNEL_METRICS_EXPORT_DIR", None)
+KERNEL_METRICS_EXPORT_INTERVAL = float(os.environ.get("KERNEL_METRICS_EXPORT_INTERVAL", 15))
+# Seconds a worker thread waits for the kernel thread to run something for it, e.g. while a cell is running
+KERNEL_CALL_TIMEOUT = float(os.environ.get("KERNEL_CALL_TIMEOUT", 10))
+# Chunks of a download that may be sent ahead of the frontend's acknowledgements, and how long after the last chunk
+# was sent to wait for one before the download is abandoned. A window of 0 sends every chunk without waiting for
+# acknowledgements. Frontends that acknowledge chunks ask for a window with each download.
+DOWNLOAD_WINDOW_CHUNKS = int(os.environ.get("DOWNLOAD_WINDOW_CHUNKS", 0))
+DOWNLOAD_ACK_TIMEOUT = float(os.environ.get("DOWNLOAD_ACK_TIMEOUT", 60))
+
+
+def save_format(content: dict) -> str:
+    """The format a `save_dataset_request` asks for the dataframe to be saved in."""
+    data_format = content.get("format", "csv")
+    if data_format == "csv" and content.get("compression") == "gzip":
+        data_format = "csv.gz"
+    return data_format
+
+
 class PythonLLMKernel(IPythonKernel):
     implementation = "askem-chatty-py"
     implementation_version = "0.1"
@@ -32,61 +76,507 @@ class PythonLLMKernel(IPythonKernel):
     def setup_instance(self, *args, **kwargs):
         # Init LLM agent
         self.toolset = DatasetToolset()
-        self.agent = ReActAgent(tools=[self.toolset], allow_ask_user=False, verbose=True, spinner=None, rich_print=False)
+        self.agent = KernelAgent(tools=[self.toolset], allow_ask_user=False, verbose=True, spinner=None, rich_print=False)
         self.toolset.agent = self.agent
+        self.toolset.call_on_kernel = self.call_on_kernel_thread
+        self.metrics = KernelMetrics()
+        self.agent.metrics = self.metrics
         if getattr(self, 'context', None) is not None:
             self.agent.clear_all_context()
         self.context = None
+        self.context_key = None
+        # The code generated for the latest request that generated any, which the next one may follow up on
+        self.previous_code = ""
+        self.kernel_thread = None
+        self.preview = PreviewTracker()
+        self.snapshots = SnapshotHistory()
+        self.pager = PreviewPager()
+        # The agent keeps a single conversation history, so requests are run one at a time on a dedicated worker
+        # thread, keeping the kernel event loop free to handle cells, interrupts and other messages meanwhile.
+        self.llm_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="llm-request")
+        self.llm_requests = {}
+        # Blocking network work, such as dataset uploads, runs here so it doesn't hold up the kernel
+        self.io_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="kernel-io")
+        self.background_tasks = set()
+        self.dataset_saves = set()
+        # Download id -> (number of chunks acknowledged by the frontend, event set on every acknowledgement)
+        self.downloads = {}
+        self.dataset_load = None
+        self.dataset_load_wait = True
         self.msg_types.append("context_setup_request")
         self.msg_types.append("llm_request")
         self.msg_types.append("download_dataset_request")
+        self.msg_types.append("download_ack_request")
         self.msg_types.append("save_dataset_request")
+        self.msg_types.append("metrics_request")
+        self.msg_types.append("undo_request")
+        self.msg_types.append("list_snapshots_request")
+        self.msg_types.append("preview_page_request")
+        self.msg_types.append("preview_request")
         return super().setup_instance(*args, **kwargs)
 
 
+    def start(self):
+        super().start()
+        # The shell's namespace and the dataframes in it are only touched from this thread
+        self.kernel_thread = threading.current_thread()
+        # LLM calls are shared out fairly between users by the broker; without a user, each kernel gets its own share
+        self.agent.user = self.agent.user or self.ident
+        if KERNEL_METRICS_EXPORT_DIR:
+            os.makedirs(KERNEL_METRICS_EXPORT_DIR, exist_ok=True)
+            self.metrics_export = PeriodicCallback(self.export_metrics, KERNEL_METRICS_EXPORT_INTERVAL * 1000)
+            self.metrics_export.start()
+
+
+    def call_on_kernel_thread(self, func, timeout=KERNEL_CALL_TIMEOUT, cancel_event=None):
+        # Runs `func` on the event loop thread, between cells, and waits for its result. Raises a TimeoutError if the
+        # kernel doesn't get to it within `timeout` seconds, in which case it is never run. Without a timeout, it waits
+        # for as long as the running cell takes, unless `cancel_event` is set meanwhile.
+        if threading.current_thread() is self.kernel_thread:
+            return func()
+        future = Future()
+
+        def run():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                future.set_result(func())
+            except BaseException as err:
+                future.set_exception(err)
+
+        self.io_loop.add_callback(run)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = 0.1 if deadline is None else min(deadline - time.monotonic(), 0.1)
+            try:
+                return future.result(max(wait, 0))
+            except FutureTimeoutError:
+                cancelled = cancel_event is not None and cancel_event.is_set()
+                if (cancelled or (deadline is not None and time.monotonic() >= deadline)) and future.cancel():
+                    if cancelled:
+                        raise LLMRequestCancelled("LLM request was cancelled.")
+                    raise
+
+
     def set_context(self, context, context_info):
         match context:
             case "dataset":
                 dataset_id = context_info["id"]
                 print(f"Processing dataset w/id {dataset_id}")
-                self.toolset.set_dataset(dataset_id)
+                # Progressive loads push the first rows right away and finish loading the full frame in the background
+                progressive = context_info.get("progressive", DATASET_PROGRESSIVE_LOAD)
+                nrows = int(context_info.get("preview_rows", DATASET_PREVIEW_ROWS)) if progressive else None
+                backend = context_info.get("backend", DATASET_BACKEND)
+                optimize_dtypes = context_info.get("optimize_dtypes", DATASET_OPTIMIZE_DTYPES)
+                self.toolset.set_dataset(
+                    dataset_id, nrows=nrows, backend=backend, optimize_dtypes=optimize_dtypes,
+                    on_sidecar=self.sidecar_context,
+                )
+                report = self.toolset.dtype_report
+                if report is not None:
+                    print(
+                        f"Optimized dtypes in {report['seconds']:.2f}s: {report['memory_before'] / 1024 ** 2:,.1f} MB -> "
+                        f"{report['memory_after'] / 1024 ** 2:,.1f} MB"
+                    )
                 self.toolset.kernel = self.shell
-                self.context = self.agent.add_context(self.toolset.context())
                 self.shell.ex("""import pandas as pd; import numpy as np; import scipy;""")
+                # Pushed before building the context, as `dataset_info` reads `df` back from the shell
                 self.shell.push({
                     "df": self.toolset.df
                 })
-                self.send_df_preview_message()
+                if self.toolset.lazy_dataset is not None:
+                    # `df` is a DuckDB relation; `con` runs SQL against the same database
+                    self.shell.push({"con": self.toolset.lazy_dataset.connection})
+                self.dataset_changed()
+                if not self.toolset.df_complete:
+                    self.dataset_load_wait = context_info.get("wait_for_load", True)
+                    self.dataset_load = asyncio.ensure_future(self.load_full_dataset(
+                        self.get_parent("shell"), dataset_id, self.toolset.df, frame_fingerprint(self.toolset.df),
+                    ))
+            case "datasets":
+                # Several datasets, loaded concurrently, each into a dataframe of its own. `df` is the first of them.
+                dataset_ids = context_info["ids"]
+                print(f"Processing datasets w/ids {', '.join(str(dataset_id) for dataset_id in dataset_ids)}")
+                start = time.monotonic()
+                optimize_dtypes = context_info.get("optimize_dtypes", DATASET_OPTIMIZE_DTYPES)
+                self.dataset_load = None
+                self.toolset.set_datasets(
+                    dataset_ids, variables=context_info.get("variables", None), optimize_dtypes=optimize_dtypes,
+                )
+                print(f"Loaded {len(dataset_ids)} datasets in {time.monotonic() - start:.2f}s")
+                self.toolset.kernel = self.shell
+                self.shell.ex("""import pandas as pd; import numpy as np; import scipy;""")
+                self.shell.push({entry["variable"]: entry["df"] for entry in self.toolset.datasets})
+                self.shell.push({"df": self.toolset.df})
+                for entry in self.toolset.datasets:
+                    rows, columns = entry["df"].shape
+                    print(f"{entry['variable']}: {entry['dataset'].get('name')} ({rows:,} rows x {columns:,} columns)")
+                self.dataset_changed()
+
+
+    def dataset_changed(self):
+        # `df` was replaced by a newly loaded dataset, so everything derived from the previous one starts over
+        self.refresh_context()
+        self.preview.reset()
+        self.snapshots.reset()
+        self.pager.reset()
+        self.send_df_preview_message()
 
 
-    def send_df_preview_message(self):
-        df = self.shell.ev("df")
-        if isinstance(df, pd.DataFrame):
-            split_df = json.loads(df.head(30).to_json(orient="split"))
-            payload = {
-                "name": "Temp dataset (not saved)",
-                "headers": split_df["columns"],
-                "csv": [split_df["columns"]] + split_df["data"],
-            }
-            self.send_response(
-                stream=self.iopub_socket,
-                msg_or_type="dataset",
-                content=payload,
+    def send_dataset_load_status(self, parent, dataset_id, state, **extra):
+        content = {"dataset_id": dataset_id, "state": state}
+        content.update(extra)
+        self.send_iopub_message(parent, "dataset_load_status", content)
+
+
+    async def load_full_dataset(self, parent, dataset_id, partial_df, partial_fingerprint):
+        self.send_dataset_load_status(parent, dataset_id, "partial", rows=len(partial_df))
+
+        def send_progress(bytes_read, total_bytes):
+            self.io_loop.add_callback(
+                self.send_dataset_load_status, parent, dataset_id, "loading", bytes_read=bytes_read, total_bytes=total_bytes,
             )
 
+        # The dataset is passed in, as the context may be set up again while the load runs on another thread
+        dataset = self.toolset.dataset
+        loop = asyncio.get_running_loop()
+        try:
+            fetched = await loop.run_in_executor(
+                self.io_executor, lambda: self.toolset.fetch_dataframe(
+                    on_progress=send_progress, dataset_id=dataset_id, dataset=dataset,
+                ),
+            )
+        except Exception as err:
+            self.send_iopub_message(parent, "stream", {"name": "stderr", "text": f"Error loading full dataset: {err}"})
+            self.send_dataset_load_status(parent, dataset_id, "error")
+            return
+        if asyncio.current_task() is not self.dataset_load or self.toolset.dataset_id != dataset_id:
+            # The context was set up again while this load was running
+            return
+
+        df = fetched.df
+        self.toolset.df = df
+        self.toolset.df_complete = True
+        self.toolset.dtype_report = fetched.dtype_report
+        # The fingerprint taken when the first rows were loaded tells whether they were changed in place since
+        unchanged = partial_fingerprint is not None and frame_fingerprint(partial_df) == partial_fingerprint
+        if self.shell.user_ns.get("df", None) is partial_df and unchanged:
+            self.shell.push({"df": df})
+            self.snapshots.reset()
+            target = "df"
+            # The profile now describes the full frame, as it was loaded
+            self.toolset.profile_sidecar = self.toolset.bind_sidecar(self.toolset.profile_sidecar, df)
+        else:
+            # `df` was rebound or changed while the rest of the dataset loaded; don't clobber the user's work
+            self.shell.push({"df_full": df})
+            target = "df_full"
+        self.refresh_context()
+        self.send_dataset_load_status(parent, dataset_id, "complete", rows=len(df), variable=target)
+
+
+    def update_context(self, force=False, cancel_event=None):
+        # The dataset description is replaced, rather than added to, whenever the structure of `df` has changed since
+        # it was written, so the agent never sees a stale one.
+        # Runs on the LLM worker thread, so the conversation is only ever changed between requests or by the request
+        # running, and reads the shell's namespace on the kernel thread.
+        previous = self.context_key
+
+        def describe():
+            if self.toolset.dataset_id is None:
+                return None, None
+            key = self.toolset.context_key()
+            if not force and key == previous:
+                return key, None
+            return key, self.toolset.context()
+
+        key, context = self.call_on_kernel_thread(describe, timeout=None, cancel_event=cancel_event)
+        if context is None:
+            return
+        if self.context is not None:
+            self.agent.clear_context(self.context)
+        self.context = self.agent.add_context(context)
+        self.context_key = key
+
+
+    def sidecar_context(self, sidecar):
+        # The profile saved with the dataset is in while its data file is still downloading, so the agent is given a
+        # description built from the profile alone, which `dataset_changed` replaces once the dataframe is loaded
+        try:
+            context = self.toolset.sidecar_context(sidecar)
+        except Exception:
+            logger.exception("Unable to describe the dataset from its profile")
+            return
+        dataset_id = self.toolset.dataset_id
+
+        def describe():
+            if self.toolset.dataset_id != dataset_id:
+                return
+            if self.context is not None:
+                self.agent.clear_context(self.context)
+            self.context = self.agent.add_context(context)
+            self.context_key = None
+
+        self.llm_executor.submit(describe)
+
+
+    def refresh_context(self):
+        # Queues a rewrite of the dataset description behind any LLM request already running
+        def refresh():
+            try:
+                self.update_context(force=True)
+            except Exception:
+                logger.exception("Unable to update the dataset context")
+
+        self.llm_executor.submit(refresh)
+
+
+    async def wait_for_dataset_load(self, code):
+        # Cells that use `df` while the full dataset is still loading wait for it unless asked not to
+        load = self.dataset_load
+        if load is None or load.done() or not self.dataset_load_wait or not re.search(r"\bdf\b", code):
+            return
+        try:
+            await asyncio.shield(load)
+        except Exception:
+            pass
+
+
+    def resource_metrics(self, deep=False):
+        """
+        Point-in-time gauges, and counters kept outside of `self.metrics`, as (gauges, counters).
+
+        Measuring the memory of `df` with `deep` counts the contents of object (e.g. string) columns, which means
+        visiting every value.
+        """
+        gauges = {
+            "process_max_resident_memory_bytes": max_rss_bytes(),
+            "llm_requests_inflight": len(self.llm_requests),
+        }
+        df = self.shell.user_ns.get("df", None)
+        if isinstance(df, pd.DataFrame):
+            gauges["dataframe_memory_bytes"] = int(df.memory_usage(index=True, deep=deep).sum())
+            gauges["dataframe_rows"] = len(df)
+            gauges["dataframe_columns"] = df.shape[1]
+        gauges["dataframe_snapshots"] = len(self.snapshots.snapshots)
+        gauges["dataframe_snapshot_memory_bytes"] = self.snapshots.total_bytes()
+
+        cache_stats = {
+            "dataset": self.toolset.dataset_cache.stats(),
+            "code": self.toolset.code_cache.stats(),
+            "profile": self.toolset.profile_cache.stats(),
+        }
+        counters = {
+            "cache_lookups_total": [
+                ({"cache": cache, "result": result}, stats[key])
+                for cache, stats in cache_stats.items() for result, key in (("hit", "hits"), ("miss", "misses"))
+            ],
+        }
+        service_stats = data_service.stats()
+        for name, stat in (("requests_total", "count"), ("request_errors_total", "errors"), ("request_seconds_total", "total_seconds")):
+            counters[f"data_service_{name}"] = [
+                ({"endpoint": endpoint}, stats[stat]) for endpoint, stats in service_stats.items()
+            ]
+        gauges["data_service_request_max_seconds"] = [
+            ({"endpoint": endpoint}, stats["max_seconds"]) for endpoint, stats in service_stats.items()
+        ]
+        return gauges, counters
+
+
+    def export_metrics(self):
+        gauges, counters = self.resource_metrics()
+        path = os.path.join(KERNEL_METRICS_EXPORT_DIR, f"kernel-{os.getpid()}.prom")
+        try:
+            write_textfile(path, self.metrics.prometheus(gauges, counters))
+        except OSError:
+            logger.exception("Unable to export metrics")
+
+
+    async def metrics_request(self, queue, message_id, message, **kwargs):
+        content = message.get("content", {})
+        loop = asyncio.get_running_loop()
+        gauges, counters = await loop.run_in_executor(None, self.resource_metrics, content.get("deep", True))
+        if content.get("format", "json") == "prometheus":
+            response = {"format": "prometheus", "text": self.metrics.prometheus(gauges, counters)}
+        else:
+            response = dict(format="json", gauges=gauges, external_counters=counters, **self.metrics.snapshot())
+        self.send_response(
+            stream=self.iopub_socket,
+            msg_or_type="metrics_response",
+            content=response,
+        )
+
+
+    def send_df_preview_message(self, resync=False):
+        # Only sends a preview (or a delta against the last one) if the head of `df` changed since it was last sent,
+        # unless the frontend asked for the full preview again.
+        df = self.shell.user_ns.get("df", None)
+        if is_relation(df):
+            # Relations are immutable, so one isn't queried again until `df` is bound to another. Only the rows shown
+            # in the preview are read from it.
+            if df is self.preview.relation and not resync:
+                return
+            head = df.limit(self.preview.rows).df()
+            self.preview.relation = df
+            df = head
+        else:
+            self.preview.relation = None
+        if isinstance(df, pd.DataFrame):
+            message = self.preview.resync(df) if resync else self.preview.update(df)
+            if message is not None:
+                msg_type, payload = message
+                self.send_response(
+                    stream=self.iopub_socket,
+                    msg_or_type=msg_type,
+                    content=payload,
+                )
+
+
+    async def preview_request(self, queue, message_id, message, **kwargs):
+        # Sent by frontends that missed a preview version, and can't apply the deltas that follow it
+        self.send_df_preview_message(resync=True)
+
+
+    async def preview_page_request(self, queue, message_id, message, **kwargs):
+        # Any window of `df`, optionally filtered and sorted, sent as an Arrow IPC stream in the message buffers, so
+        # the frontend can page through frames of any size without them ever being encoded as JSON.
+        content = message.get("content", {})
+        df = self.shell.user_ns.get("df", None)
+        buffers = None
+        with self.metrics.timer("kernel_handler_seconds", handler="preview_page_request"):
+            try:
+                if not (isinstance(df, pd.DataFrame) or is_relation(df)):
+                    raise ValueError("There is no dataframe to preview.")
+                request = PageRequest(content)
+                loop = asyncio.get_running_loop()
+                # Filtering and sorting a large frame can take a while, so it is done off the event loop
+                description, data = await loop.run_in_executor(
+                    None, lambda: self.pager.page(self.bind_relation(df), request, generation=self.execution_count),
+                )
+                response = dict(status="ok", format="arrow", **description)
+                buffers = [data]
+            except Exception as err:
+                response = {"status": "error", "error": str(err)}
+        self.send_response(
+            stream=self.iopub_socket,
+            msg_or_type="preview_page_response",
+            content=response,
+            buffers=buffers,
+        )
+
 
     # def send_response(self, stream, msg_or_type, content=None, ident=None, buffers=None, track=False, header=None, metadata=None, channel="shell"):
     #     # Parse response as needed
     #     return super().send_response(stream, msg_or_type, content, ident, buffers, track, header, metadata, channel)
 
 
+    def send_iopub_message(self, parent, msg_type, content, buffers=None):
+        # Used by work that outlives its shell handler, where the kernel's current parent may already belong to a
+        # different request.
+        return self.session.send(
+            self.iopub_socket,
+            msg_type,
+            content,
+            parent=parent,
+            ident=self._topic(msg_type),
+            buffers=buffers,
+        )
+
+
+    def send_llm_status(self, parent, state, **extra):
+        content = {
+            "request_id": parent["header"]["msg_id"],
+            "state": state,
+            "inflight": len(self.llm_requests),
+        }
+        content.update(extra)
+        self.send_iopub_message(parent, "llm_status", content)
+
+
     async def llm_request(self, queue, message_id, message, **kwargs):
         # Send "code" to LLM Agent. The "code" is actually the LLM query
         request = message.get("content", {}).get("request", None)
         if not request:
             return
+        if len(self.llm_requests) >= LLM_MAX_INFLIGHT_REQUESTS:
+            self.send_llm_status(message, "rejected")
+            stream_content = {
+                "name": "stderr",
+                "text": f"LLM Error:\nToo many LLM requests in progress (limit {LLM_MAX_INFLIGHT_REQUESTS}). Please wait for one to finish.",
+            }
+            self.send_response(self.iopub_socket, "stream", stream_content)
+            return
+
+        # The request is run as a task so that this handler returns right away and the kernel keeps processing
+        # messages while the agent works.
+        request_id = message["header"]["msg_id"]
+        stream = message.get("content", {}).get("stream", LLM_STREAM_RESPONSES)
+        use_cache = message.get("content", {}).get("cache", True)
+        user = message.get("content", {}).get("user", None)
+        # Generated code is linted ("off", "flag" or "fix") and can be tried out on a sample of the data first ("off",
+        # "flag" or "revise")
+        lint = message.get("content", {}).get("lint", CODE_LINT)
+        dry_run = message.get("content", {}).get("dry_run", CODE_DRY_RUN)
+        cancel_event = threading.Event()
+        task = asyncio.ensure_future(self.run_llm_request(
+            message, request, cancel_event, stream=stream, use_cache=use_cache, user=user, lint=lint, dry_run=dry_run
+        ))
+        self.llm_requests[request_id] = (task, cancel_event)
+        task.add_done_callback(lambda _: self.llm_requests.pop(request_id, None))
+        self.send_llm_status(message, "queued")
+
+
+    async def run_llm_request(self, parent, request, cancel_event, stream=False, use_cache=True, user=None,
+                              lint=CODE_LINT, dry_run=CODE_DRY_RUN):
+        request_id = parent["header"]["msg_id"]
+        on_event = None
+        if stream:
+            # Agent events are raised on the worker thread, so hand the messages over to the kernel loop to be sent.
+            on_event = ReActStreamRelay(
+                request_id,
+                lambda msg_type, content: self.io_loop.add_callback(self.send_iopub_message, parent, msg_type, content),
+            )
+
+        def react():
+            if cancel_event.is_set():
+                raise LLMRequestCancelled("LLM request was cancelled.")
+            self.io_loop.add_callback(self.send_llm_status, parent, "running")
+            # Requests run one at a time, so the toolset can carry the cache, lint and dry run settings for the duration of
+            # this one, and the agent who its LLM calls are for. They take priority over background calls at the LLM broker.
+            self.toolset.use_code_cache = use_cache
+            default_user = self.agent.user
+            self.agent.user = user or default_user
+            self.agent.priority = "interactive"
+            try:
+                self.toolset.lint_mode = check_lint_mode(lint)
+                self.toolset.dry_run_mode = check_dry_run_mode(dry_run)
+                self.update_context(cancel_event=cancel_event)
+                # A request that generated code before against the same schema, following the same code if it is a
+                # follow-up, is answered without calling the LLM
+                previous_code = self.previous_code
+                result = self.toolset.cached_code(request, previous_code)
+                if result is not None:
+                    # Follow-up requests still need to know what this one was
+                    self.agent.record_exchange(request, f"{type(self.toolset).__name__}.generate_python_code", request)
+                else:
+                    result = self.agent.react(request, cancel_event=cancel_event, on_event=on_event)
+                    self.toolset.cache_code(request, result, previous_code)
+                self.previous_code = generated_code(result) or self.previous_code
+                return result
+            finally:
+                self.toolset.use_code_cache = True
+                self.toolset.lint_mode = CODE_LINT
+                self.toolset.dry_run_mode = CODE_DRY_RUN
+                self.agent.user = default_user
+                self.agent.priority = "background"
+
+        loop = asyncio.get_running_loop()
+        start = time.monotonic()
         try:
-            result = self.agent.react(request)
+            result = await loop.run_in_executor(self.llm_executor, react)
+            status = "done"
+        except (asyncio.CancelledError, LLMRequestCancelled):
+            cancel_event.set()
+            status = "cancelled"
         except Exception as err:
             error_text = f"""LLM Error:
 {err}
@@ -94,29 +584,41 @@ class PythonLLMKernel(IPythonKernel):
 {traceback.format_exc()}
 """
             stream_content = {"name": "stderr", "text": error_text}
-            self.send_response(self.iopub_socket, "stream", stream_content)
-            return {
-                "status": "error",
-                "execution_count": self.execution_count,
-                "payload": [],
-                'user_expressions': {},
-            }
-
-        try:
-            data = json.loads(result)
-            if isinstance(data, dict) and data.get("action") == "code_cell":
-                stream_content = {"language": data.get("language"), "code": data.get("content")}
-                self.send_response(self.iopub_socket, "code_cell", stream_content)
-        except json.JSONDecodeError:  # If response is not a json, it's just text so treat it like text
-            stream_content = {"name": "response_text", "text": f"{result}"}
-            self.send_response(self.iopub_socket, "llm_response", stream_content)
-
-        return {
-            "status": "ok",
-            "execution_count": self.execution_count,
-            "payload": [],
-            'user_expressions': {},
-        }
+            self.send_iopub_message(parent, "stream", stream_content)
+            status = "error"
+        else:
+            try:
+                data = json.loads(result)
+                if isinstance(data, dict) and data.get("action") == "code_cell":
+                    stream_content = {"language": data.get("language"), "code": data.get("content")}
+                    for key in ("lint", "estimate"):
+                        if key in data:
+                            stream_content[key] = data[key]
+                    self.send_iopub_message(parent, "code_cell", stream_content)
+            except json.JSONDecodeError:  # If response is not a json, it's just text so treat it like text
+                stream_content = {"name": "response_text", "text": f"{result}"}
+                if stream:
+                    stream_content["partial"] = False
+                self.send_iopub_message(parent, "llm_response", stream_content)
+
+        self.metrics.observe("kernel_handler_seconds", time.monotonic() - start, handler="llm_request")
+        self.metrics.increment("llm_requests_total", status=status)
+        if stream:
+            # Flush after any partial chunks still queued on the loop so this is always the last message of the stream.
+            self.io_loop.add_callback(self.send_iopub_message, parent, "llm_stream_end", {"request_id": request_id, "status": status})
+        self.io_loop.add_callback(self.send_llm_status, parent, status)
+
+
+    def cancel_llm_requests(self):
+        for task, cancel_event in list(self.llm_requests.values()):
+            cancel_event.set()
+            task.cancel()
+
+
+    async def interrupt_request(self, stream, ident, parent):
+        # Interrupts are handled on the control thread, so cancellation of LLM requests is handed to the shell loop.
+        self.io_loop.add_callback(self.cancel_llm_requests)
+        return await super().interrupt_request(stream, ident, parent)
 
 
     async def context_setup_request(self, queue, message_id, message, **kwargs):
@@ -126,9 +628,13 @@ class PythonLLMKernel(IPythonKernel):
         content = message.get('content', {})
         context = content.get('context')
         context_info = content.get('context_info', {})
+        # Frontends that can apply `dataset_delta` messages opt in to them; others only ever get full previews
+        if "preview_deltas" in content:
+            self.preview.deltas = bool(content["preview_deltas"])
 
         if content:
-            self.set_context(context, context_info)
+            with self.metrics.timer("kernel_handler_seconds", handler="context_setup_request"):
+                self.set_context(context, context_info)
 
         self.send_response(
             stream=self.iopub_socket,
@@ -148,25 +654,90 @@ class PythonLLMKernel(IPythonKernel):
         return await super().execute_request(stream, ident, parent)
 
     async def download_dataset_request(self, queue, message_id, message, **kwargs):
+        # The dataframe is streamed as a sequence of `download_chunk` messages carrying the raw bytes as message
+        # buffers, followed by a `download_complete` message, so it is never serialized in memory all at once.
+        # Messages past the iopub high-water mark are dropped, so frontends can ask for a `window`: then at most that
+        # many chunks are sent ahead of their `download_ack_request`s, which say how many chunks they have received.
         content = message.get('content', {})
-        # TODO: Collect any options that might be needed, if they ever are
+        data_format = content.get("format", "csv")
 
-        df = self.shell.ev("df")
-        if isinstance(df, pd.DataFrame):
-            output_buff = io.BytesIO()
-            df.to_csv(output_buff, index=False, header=True)
-            output_buff.seek(0)
-            self.send_response(
-                stream=self.iopub_socket,
-                msg_or_type="download_response",
-                content={"data": output_buff},
-            )
-        else:
+        df = self.shell.user_ns.get("df", None)
+        if not (isinstance(df, pd.DataFrame) or is_relation(df)) or data_format not in FORMATS:
             self.send_response(
                 stream=self.iopub_socket,
                 msg_or_type="stream",
                 content={"name": "stderr", "text": "The dataframe is not able to be downloaded."},
             )
+            return
+
+        # The download runs as a task, so the kernel keeps handling messages, acknowledgements included, meanwhile
+        task = asyncio.ensure_future(self.run_download(message, df, content))
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+
+
+    async def run_download(self, parent, df, content):
+        data_format = content.get("format", "csv")
+        chunk_size = int(content.get("chunk_size", CHUNK_SIZE))
+        window = int(content.get("window", DOWNLOAD_WINDOW_CHUNKS))
+        download_id = parent["header"]["msg_id"]
+        acked = asyncio.Event()
+        self.downloads[download_id] = (0, acked)
+
+        start = time.monotonic()
+        last_sent = start
+        seq = 0
+        size = 0
+        status = "ok"
+        try:
+            for chunk in iter_dataframe_bytes(df, data_format, chunk_size=chunk_size):
+                while window > 0 and seq - self.downloads[download_id][0] >= window:
+                    acked.clear()
+                    remaining = last_sent + DOWNLOAD_ACK_TIMEOUT - time.monotonic()
+                    try:
+                        if remaining <= 0:
+                            raise asyncio.TimeoutError()
+                        await asyncio.wait_for(acked.wait(), remaining)
+                    except asyncio.TimeoutError:
+                        raise TimeoutError(
+                            f"No acknowledgement of chunk {self.downloads[download_id][0]} in {DOWNLOAD_ACK_TIMEOUT:g}s"
+                        )
+                self.send_iopub_message(
+                    parent, "download_chunk", {"download_id": download_id, "seq": seq, "size": len(chunk)},
+                    buffers=[chunk],
+                )
+                last_sent = time.monotonic()
+                seq += 1
+                size += len(chunk)
+                # Let the loop breathe between chunks
+                await asyncio.sleep(0)
+        except Exception as err:
+            status = "error"
+            self.send_iopub_message(parent, "stream", {"name": "stderr", "text": f"Error downloading dataframe: {err}"})
+        finally:
+            self.downloads.pop(download_id, None)
+
+        self.send_iopub_message(parent, "download_complete", {
+            "download_id": download_id,
+            "status": status,
+            "format": data_format,
+            "mimetype": FORMATS[data_format]["mimetype"],
+            "filename": f"dataset{FORMATS[data_format]['extension']}",
+            "chunks": seq,
+            "size": size,
+        })
+        self.metrics.observe("kernel_handler_seconds", time.monotonic() - start, handler="download_dataset_request")
+
+
+    async def download_ack_request(self, queue, message_id, message, **kwargs):
+        # `received` is the number of chunks of the download the frontend has received so far
+        content = message.get("content", {})
+        download = self.downloads.get(content.get("download_id"))
+        if download is None:
+            return
+        received, acked = download
+        self.downloads[content["download_id"]] = (max(received, int(content.get("received", 0))), acked)
+        acked.set()
 
 
     async def save_dataset_request(self, queue, message_id, message, **kwargs):
@@ -179,64 +750,190 @@ class PythonLLMKernel(IPythonKernel):
             channel="iopub",
         )
         df = self.shell.ev('df')
+        if isinstance(df, pd.DataFrame):
+            # Serialized on another thread, so cells that rebind `df` or its columns meanwhile don't affect what is
+            # saved. Cells that use `df` wait for it to be serialized (see `wait_for_dataset_saves`), as in-place
+            # changes to its values would still show through, but not for it to be uploaded.
+            df = df.copy(deep=False)
         content = message.get('content', {})
+        data_format = save_format(content)
+        profile = content.get("profile", DATASET_PROFILE_SIDECAR)
+
+        loop = asyncio.get_running_loop()
+        serialized = loop.run_in_executor(self.io_executor, self.serialize_dataset, df, data_format, profile)
+        self.dataset_saves.add(serialized)
+        serialized.add_done_callback(self.dataset_saves.discard)
+        # The upload runs as a task so the kernel can keep handling messages while the dataframe is sent.
+        task = asyncio.ensure_future(self.run_save_dataset(message, serialized, content))
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+
+
+    def bind_relation(self, df):
+        # DuckDB relations over the lazy dataset are bound to a cursor of the calling thread before they are queried
+        # off the kernel thread
+        if is_relation(df) and self.toolset.lazy_dataset is not None:
+            return self.toolset.lazy_dataset.bind(df)
+        return df
+
+
+    async def wait_for_dataset_saves(self, code):
+        # Cells that use `df` wait for a dataframe being saved to be serialized, so the saved file is never torn by a
+        # change halfway through
+        saves = [serialized for serialized in self.dataset_saves if not serialized.done()]
+        if not saves or not re.search(r"\bdf\b", code):
+            return
+        await asyncio.wait(saves)
 
+
+    def serialize_dataset(self, df, data_format, profile):
+        # The dataframe as a file in `data_format` (see `spool`), and its profile sidecar, if asked for and it could be
+        # profiled. Nothing reads `df` once this is done.
+        data = spool(iter_dataframe_bytes(self.bind_relation(df), data_format))
+        profile_data = None
+        if profile:
+            try:
+                profile_data = profile_bytes(self.bind_relation(df))
+            except Exception as err:
+                logger.warning("Unable to profile the dataframe being saved: %s", err)
+        return data, profile_data
+
+
+    async def run_save_dataset(self, parent, serialized, content):
         parent_dataset_id = content.get("parent_dataset_id")
         new_name = content.get("name")
         filename = content.get("filename", None)
-
+        data_format = save_format(content)
+        resumable = content.get("resumable", False)
+        # Only for upload URLs that accept bodies without a Content-Length
+        chunked = content.get("chunked", False)
 
         if filename is None:
-            filename = "dataset.csv"
-        parent_url = f"{os.environ['DATA_SERVICE_URL']}/datasets/{parent_dataset_id}"
-        parent_dataset = requests.get(parent_url).json()
-        if not parent_dataset:
-            raise Exception(f"Unable to locate parent dataset '{parent_dataset_id}'")
-        
-        new_dataset = copy.deepcopy(parent_dataset)
-        del new_dataset["id"]
-        new_dataset["name"] = new_name
-        new_dataset["description"] += f"\nTransformed from dataset '{parent_dataset['name']}' ({parent_dataset['id']}) at {datetime.datetime.utcnow().strftime('%c %Z')}"
-        new_dataset["file_names"] = [filename]
-
-        create_req = requests.post(f"{os.environ['DATA_SERVICE_URL']}/datasets", json=new_dataset)
-        new_dataset_id = create_req.json()["id"]
-
-        new_dataset["id"] = new_dataset_id
-        new_dataset_url = f"{os.environ['DATA_SERVICE_URL']}/datasets/{new_dataset_id}"
-        data_url_req = requests.get(f'{new_dataset_url}/upload-url?filename={filename}')
-        data_url = data_url_req.json().get('url', None)
-
-        # Saving as a temporary file instead of a buffer to save memory
-        with tempfile.TemporaryFile() as temp_csv_file:
-            df.to_csv(temp_csv_file, index=False, header=True)
-            temp_csv_file.seek(0)
-            upload_response = requests.put(data_url, data=temp_csv_file)
-        if upload_response.status_code != 200:
-            raise Exception(f"Error uploading dataframe: {upload_response.content}")
+            filename = f"dataset{FORMATS[data_format]['extension']}"
+        profile_filename = None
 
-        self.send_response(
-            stream=self.iopub_socket,
-            msg_or_type="save_dataset_response",
-            content={
+        def send_progress(bytes_sent):
+            self.io_loop.add_callback(self.send_iopub_message, parent, "save_dataset_progress", {
+                "filename": filename,
+                "bytes_sent": bytes_sent,
+            })
+
+        # The parent dataset lookup runs while the dataframe is serialized
+        parent_request = data_service.submit(data_service.get_dataset, parent_dataset_id)
+
+        def save(data, profile_data):
+            nonlocal profile_filename
+            # A dataframe that couldn't be profiled is saved without a sidecar
+            if profile_data is not None:
+                profile_filename = sidecar_name(filename)
+
+            parent_dataset = parent_request.result()
+            if not parent_dataset:
+                raise Exception(f"Unable to locate parent dataset '{parent_dataset_id}'")
+
+            new_dataset = copy.deepcopy(parent_dataset)
+            del new_dataset["id"]
+            new_dataset["name"] = new_name
+            new_dataset["description"] += f"\nTransformed from dataset '{parent_dataset['name']}' ({parent_dataset['id']}) at {datetime.datetime.utcnow().strftime('%c %Z')}"
+            new_dataset["file_names"] = [filename] if profile_filename is None else [filename, profile_filename]
+
+            new_dataset_id = data_service.create_dataset(new_dataset)["id"]
+
+            new_dataset["id"] = new_dataset_id
+            upload_info = data_service.upload_url(new_dataset_id, filename)
+            data_url = upload_info.get('url', None)
+
+            headers = {"Content-Type": FORMATS[data_format]["mimetype"]}
+            if resumable or upload_info.get("resumable", False):
+                put_resumable(data_url, iter_file(data), headers=headers, on_progress=send_progress, put=data_service.put)
+            elif chunked or upload_info.get("chunked", False):
+                put_stream(
+                    data_url, iter_file(data), headers=headers, on_progress=send_progress, put=data_service.put,
+                    chunked=True,
+                )
+            else:
+                put_file(data_url, data, headers=headers, on_progress=send_progress, put=data_service.put)
+
+            if profile_data is not None:
+                # The data is saved by now; without its sidecar the dataset is just profiled from the data when opened
+                try:
+                    profile_url = data_service.upload_url(new_dataset_id, profile_filename).get('url', None)
+                    put_bytes(profile_url, profile_data, headers={"Content-Type": SIDECAR_MIMETYPE}, put=data_service.put)
+                except Exception as err:
+                    logger.warning("Unable to upload the profile of dataset '%s': %s", new_dataset_id, err)
+                    profile_filename = None
+            return new_dataset_id
+
+        loop = asyncio.get_running_loop()
+        try:
+            with self.metrics.timer("kernel_handler_seconds", handler="save_dataset_request"):
+                data, profile_data = await serialized
+                with data:
+                    new_dataset_id = await loop.run_in_executor(self.io_executor, save, data, profile_data)
+        except Exception as err:
+            self.send_iopub_message(parent, "stream", {"name": "stderr", "text": f"Error saving dataset: {err}"})
+        else:
+            self.send_iopub_message(parent, "save_dataset_response", {
                 "dataset_id": new_dataset_id,
                 "filename": filename,
+                "profile_filename": profile_filename,
                 "parent_dataset_id": parent_dataset_id
-            },
-            channel="iopub",
+            })
+        self.send_iopub_message(parent, "status", {
+            "execution_state": "idle",
+        })
+
+
+    def take_snapshot(self, code):
+        # Cells that may change `df` get the current version recorded first, which cells with IPython syntax such as
+        # magics are assumed to. Versions that match the latest snapshot aren't recorded again.
+        if not re.search(r"\bdf\b", code) or not may_change(code):
+            return
+        df = self.shell.user_ns.get("df", None)
+        with self.metrics.timer("kernel_handler_seconds", handler="snapshot"):
+            try:
+                self.snapshots.take(df, label=code)
+            except Exception:
+                logger.exception("Unable to take a snapshot of df")
+
+
+    async def undo_request(self, queue, message_id, message, **kwargs):
+        content = message.get("content", {})
+        snapshot_id = content.get("snapshot_id", None)
+        df = self.shell.user_ns.get("df", None)
+        snapshot = self.snapshots.undo(df, snapshot_id=snapshot_id)
+        if snapshot is not None:
+            self.shell.push({"df": snapshot.restore()})
+            self.pager.reset()
+            self.send_df_preview_message()
+        response = {
+            "status": "ok" if snapshot is not None else "error",
+            "snapshot_id": snapshot.id if snapshot is not None else snapshot_id,
+        }
+        response.update(self.snapshots.describe())
+        self.send_response(
+            stream=self.iopub_socket,
+            msg_or_type="undo_response",
+            content=response,
         )
+
+
+    async def list_snapshots_request(self, queue, message_id, message, **kwargs):
         self.send_response(
             stream=self.iopub_socket,
-            msg_or_type="status",
-            content={
-                "execution_state": "idle",
-            },
-            channel="iopub",
+            msg_or_type="list_snapshots_response",
+            content=self.snapshots.describe(),
         )
-         
+
+
     async def do_execute(self, code, silent, store_history=True, user_expressions=None, allow_stdin=False, *, cell_id=None):
-        result = await super().do_execute(code, silent, store_history, user_expressions, allow_stdin, cell_id=cell_id)
-        self.send_df_preview_message()
+        await self.wait_for_dataset_load(code)
+        await self.wait_for_dataset_saves(code)
+        self.take_snapshot(code)
+        with self.metrics.timer("kernel_handler_seconds", handler="execute_request"):
+            result = await super().do_execute(code, silent, store_history, user_expressions, allow_stdin, cell_id=cell_id)
+        with self.metrics.timer("kernel_handler_seconds", handler="df_preview"):
+            self.send_df_preview_message()
         return result
 
 if __name__ == '__main__':
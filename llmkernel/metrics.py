@@ -0,0 +1,157 @@
+import bisect
+import contextlib
+import os
+import resource
+import sys
+import threading
+import time
+from typing import Iterator, Optional
+
+# Upper bounds (in seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+DESCRIPTIONS = {
+    "kernel_handler_seconds": "Time spent handling kernel messages, by handler.",
+    "llm_completion_seconds": "Time spent waiting on LLM completions, by kind of call.",
+    "llm_tool_seconds": "Time spent running agent tools, by tool.",
+    "llm_tokens_total": "LLM tokens used, by kind of call and token type.",
+    "llm_requests_total": "LLM requests handled, by final status.",
+    "llm_context_compactions_total": "Requests condensed out of the agent conversation history into its summary.",
+    "code_lint_findings_total": "Slow patterns found in generated code, by rule and whether they were rewritten.",
+    "code_dry_run_seconds": "Time spent trying out generated code on samples of the data, by outcome.",
+}
+
+
+def label_key(labels: dict) -> tuple:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def format_labels(labels: tuple, **extra) -> str:
+    items = list(labels) + [(name, str(value)) for name, value in extra.items()]
+    if not items:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in items)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(items, escaped)) + "}"
+
+
+class Histogram:
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "max": self.max,
+            "buckets": dict(zip([str(bound) for bound in self.buckets] + ["+Inf"], self.counts)),
+        }
+
+
+class KernelMetrics:
+    """
+    In-process registry of the kernel's latency histograms and counters.
+
+    Histograms and counters are keyed by metric name and a set of labels, e.g.
+    `observe("kernel_handler_seconds", 0.2, handler="llm_request")`. Recording is thread safe, as the agent and the
+    dataset uploads run on worker threads.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+
+    def observe(self, name: str, value: float, **labels):
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            key = label_key(labels)
+            if key not in series:
+                series[key] = Histogram()
+            series[key].observe(value)
+
+    def increment(self, name: str, value: float = 1, **labels):
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            key = label_key(labels)
+            series[key] = series.get(key, 0) + value
+
+    @contextlib.contextmanager
+    def timer(self, name: str, **labels) -> Iterator[dict]:
+        """Time the body of the `with` block. Labels can be added or changed through the yielded dict."""
+        start = time.monotonic()
+        try:
+            yield labels
+        finally:
+            self.observe(name, time.monotonic() - start, **labels)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                "histograms": {
+                    name: [dict(labels=dict(key), **histogram.snapshot()) for key, histogram in series.items()]
+                    for name, series in self.histograms.items()
+                },
+                "counters": {
+                    name: [{"labels": dict(key), "value": value} for key, value in series.items()]
+                    for name, series in self.counters.items()
+                },
+            }
+
+    def prometheus(self, gauges: Optional[dict] = None, counters: Optional[dict] = None) -> str:
+        """
+        The metrics in the Prometheus text exposition format.
+
+        `gauges` and `counters` map metric names to either a value or a list of (labels, value) pairs, for values
+        that are kept elsewhere or computed on request (such as memory use) rather than recorded here.
+        """
+        lines = []
+        with self.lock:
+            for name, series in sorted(self.histograms.items()):
+                lines.extend(self.header(name, "histogram"))
+                for key, histogram in series.items():
+                    cumulative = 0
+                    for bound, count in zip(list(histogram.buckets) + ["+Inf"], histogram.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{format_labels(key, le=bound)} {cumulative}")
+                    lines.append(f"{name}_sum{format_labels(key)} {histogram.sum}")
+                    lines.append(f"{name}_count{format_labels(key)} {histogram.count}")
+            counters = dict(counters or {}, **{
+                name: [(dict(key), value) for key, value in series.items()] for name, series in self.counters.items()
+            })
+        for metric_type, metrics in (("counter", counters), ("gauge", gauges or {})):
+            for name, values in sorted(metrics.items()):
+                lines.extend(self.header(name, metric_type))
+                if not isinstance(values, list):
+                    values = [({}, values)]
+                for labels, value in values:
+                    lines.append(f"{name}{format_labels(label_key(labels))} {value}")
+        return "\n".join(lines) + "\n"
+
+    def header(self, name: str, metric_type: str) -> list:
+        lines = [f"# HELP {name} {DESCRIPTIONS[name]}"] if name in DESCRIPTIONS else []
+        return lines + [f"# TYPE {name} {metric_type}"]
+
+
+def max_rss_bytes() -> int:
+    """Peak resident memory of the kernel process."""
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS and in kilobytes elsewhere
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def write_textfile(path: str, text: str):
+    """Atomically write metrics for a textfile collector to pick up."""
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "w") as file:
+        file.write(text)
+    os.replace(temp_path, path)
@@ -0,0 +1,249 @@
+import json
+import operator
+import os
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+from toolsets.lazy_dataset import arrow_table, is_relation, relation_rows, sql_identifier, sql_literal
+
+# Rows returned by default, and at most, in a single preview page
+PREVIEW_PAGE_ROWS = int(os.environ.get("PREVIEW_PAGE_ROWS", 100))
+PREVIEW_PAGE_MAX_ROWS = int(os.environ.get("PREVIEW_PAGE_MAX_ROWS", 10_000))
+
+COMPARISONS = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+OPERATORS = tuple(COMPARISONS) + ("contains", "in", "isnull", "notnull")
+
+
+class PageRequest:
+    """
+    A window of `df` asked for by the frontend: rows `offset` to `offset + limit` of the frame after filtering and
+    sorting it, restricted to some of its columns.
+
+    `filters` is a list of {"column", "op", "value"} conditions that must all hold, where `op` is one of `OPERATORS`,
+    and `sort` a list of {"column", "ascending"} keys. `columns` is a list of column names, or else the window of
+    `column_limit` columns starting at `column_offset` is returned.
+    """
+
+    def __init__(self, content: dict):
+        self.offset = max(int(content.get("offset", 0)), 0)
+        self.limit = min(max(int(content.get("limit", PREVIEW_PAGE_ROWS)), 0), PREVIEW_PAGE_MAX_ROWS)
+        self.columns = content.get("columns", None)
+        self.column_offset = max(int(content.get("column_offset", 0)), 0)
+        column_limit = content.get("column_limit", None)
+        self.column_limit = int(column_limit) if column_limit is not None else None
+        self.filters = content.get("filters", None) or []
+        self.sort = content.get("sort", None) or []
+        for condition in self.filters:
+            if condition.get("op") not in OPERATORS:
+                raise ValueError(f"Unsupported filter '{condition.get('op')}'. Supported filters are: {', '.join(OPERATORS)}")
+            if "column" not in condition:
+                raise ValueError("Every filter needs a column")
+        for key in self.sort:
+            if "column" not in key:
+                raise ValueError("Every sort key needs a column")
+
+    def view_key(self) -> str:
+        """Identifies the rows selected by the filters and their order, regardless of the window."""
+        return json.dumps([self.filters, self.sort], sort_keys=True, default=str)
+
+    def column_positions(self, columns: pd.Index) -> list:
+        if self.columns is not None:
+            positions = []
+            for name in self.columns:
+                matches = np.flatnonzero(columns == name)
+                if not len(matches):
+                    raise ValueError(f"Column '{name}' does not exist")
+                positions.extend(int(pos) for pos in matches)
+            return positions
+        stop = len(columns) if self.column_limit is None else self.column_offset + self.column_limit
+        return list(range(min(self.column_offset, len(columns)), min(stop, len(columns))))
+
+
+def column(df: pd.DataFrame, name) -> pd.Series:
+    if name not in df.columns:
+        raise ValueError(f"Column '{name}' does not exist")
+    series = df[name]
+    # Duplicate column names select a frame; go by the first of them
+    return series.iloc[:, 0] if isinstance(series, pd.DataFrame) else series
+
+
+def filter_mask(df: pd.DataFrame, condition: dict) -> np.ndarray:
+    series = column(df, condition["column"])
+    op = condition["op"]
+    value = condition.get("value", None)
+    if op == "isnull":
+        mask = series.isna()
+    elif op == "notnull":
+        mask = series.notna()
+    elif op == "contains":
+        mask = series.astype(str).str.contains(str(value), case=False, regex=False, na=False)
+    elif op == "in":
+        mask = series.isin(value if isinstance(value, list) else [value])
+    else:
+        try:
+            mask = COMPARISONS[op](series, value)
+        except TypeError as err:
+            raise ValueError(f"Unable to compare column '{condition['column']}' with {value!r}: {err}")
+    return np.asarray(mask.fillna(False) if hasattr(mask, "fillna") else mask, dtype=bool)
+
+
+def view_positions(df: pd.DataFrame, request: PageRequest) -> Optional[np.ndarray]:
+    """Positions of the rows of `df` that pass the filters, in sorted order, or None if there are neither."""
+    if not request.filters and not request.sort:
+        return None
+    positions = np.arange(len(df))
+    if request.filters:
+        mask = np.ones(len(df), dtype=bool)
+        for condition in request.filters:
+            mask &= filter_mask(df, condition)
+        positions = np.flatnonzero(mask)
+    if request.sort:
+        keys = pd.DataFrame({
+            idx: column(df, key["column"]).iloc[positions].reset_index(drop=True) for idx, key in enumerate(request.sort)
+        })
+        order = keys.sort_values(
+            by=list(keys.columns),
+            ascending=[bool(key.get("ascending", True)) for key in request.sort],
+            kind="stable",
+            na_position="last",
+        ).index.to_numpy()
+        positions = positions[order]
+    return positions
+
+
+def unique_names(names: list) -> list:
+    """Column names as strings, with duplicates suffixed, as Arrow tables need distinct names."""
+    seen = {}
+    result = []
+    for name in names:
+        name = str(name)
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        result.append(name)
+    return result
+
+
+def arrow_ipc(table) -> memoryview:
+    import pyarrow as pa
+
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return memoryview(sink.getvalue())
+
+
+def frame_table(page: pd.DataFrame):
+    import pyarrow as pa
+
+    page = page.copy(deep=False)
+    page.columns = unique_names(list(page.columns))
+    try:
+        return pa.Table.from_pandas(page)
+    except (pa.ArrowTypeError, pa.ArrowInvalid):
+        # Columns holding a mix of types are shown as text
+        for name in page.columns:
+            if page[name].dtype == object:
+                page[name] = page[name].map(lambda value: value if value is None or pd.isna(value) else str(value))
+        return pa.Table.from_pandas(page)
+
+
+class PreviewPager:
+    """
+    Serves windows of `df` to the frontend as Arrow IPC streams.
+
+    Filtering and sorting a large frame is the expensive part of a page, so the row order of the last filter and
+    sort is kept for as long as `df` and the kernel `generation` (which changes whenever a cell runs) stay the same,
+    and scrolling through a sorted view only slices it.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # (view key, row positions), replaced as a whole, as pages may be served from several threads at once
+        self.view = None
+
+    def page(self, df, request: PageRequest, generation=None) -> tuple[dict, memoryview]:
+        """The page of `df` asked for by `request`, as (description, Arrow IPC stream)."""
+        if is_relation(df):
+            return self.relation_page(df, request)
+
+        key = (id(df), len(df), df.shape[1], generation, request.view_key())
+        view = self.view
+        if view is None or view[0] != key:
+            view = (key, view_positions(df, request))
+            self.view = view
+        positions = view[1]
+        total_rows = len(df) if positions is None else len(positions)
+        stop = min(request.offset + request.limit, total_rows)
+        rows = slice(request.offset, stop) if positions is None else positions[request.offset:stop]
+        column_positions = request.column_positions(df.columns)
+        page = df.iloc[rows, column_positions]
+        description = {
+            "offset": request.offset,
+            "rows": len(page),
+            "total_rows": total_rows,
+            "columns": [str(name) for name in page.columns],
+            "column_positions": column_positions,
+            "total_columns": df.shape[1],
+        }
+        return description, arrow_ipc(frame_table(page))
+
+    def relation_page(self, relation, request: PageRequest) -> tuple[dict, memoryview]:
+        """Pages of DuckDB relations are filtered, sorted and sliced by DuckDB, reading only what it needs to."""
+        if request.filters:
+            relation = relation.filter(" AND ".join(sql_condition(condition) for condition in request.filters))
+        if request.sort:
+            relation = relation.order(", ".join(
+                f"{sql_identifier(key['column'])} {'ASC' if key.get('ascending', True) else 'DESC'} NULLS LAST"
+                for key in request.sort
+            ))
+        columns = pd.Index(relation.columns)
+        column_positions = request.column_positions(columns)
+        names = [columns[pos] for pos in column_positions]
+        total_rows = relation_rows(relation)
+        if names:
+            table = arrow_table(relation.project(", ".join(sql_identifier(name) for name in names)).limit(
+                request.limit, request.offset,
+            ))
+        else:
+            # Rows without any columns, as pages of dataframes are
+            rows = max(min(request.limit, total_rows - request.offset), 0)
+            table = frame_table(pd.DataFrame(index=pd.RangeIndex(request.offset, request.offset + rows)))
+        description = {
+            "offset": request.offset,
+            "rows": table.num_rows,
+            "total_rows": total_rows,
+            "columns": names,
+            "column_positions": column_positions,
+            "total_columns": len(columns),
+        }
+        return description, arrow_ipc(table)
+
+
+def sql_condition(condition: dict) -> str:
+    name = sql_identifier(condition["column"])
+    op = condition["op"]
+    value = condition.get("value", None)
+    if op == "isnull":
+        return f"{name} IS NULL"
+    if op == "notnull":
+        return f"{name} IS NOT NULL"
+    if op == "contains":
+        return f"contains(lower(CAST({name} AS VARCHAR)), lower({sql_literal(str(value))}))"
+    if op == "in":
+        values = value if isinstance(value, list) else [value]
+        return f"{name} IN ({', '.join(sql_literal(item) for item in values)})" if values else "FALSE"
+    return f"{name} {'=' if op == '==' else op} {sql_literal(value)}"
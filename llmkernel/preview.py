@@ -0,0 +1,114 @@
+import json
+from typing import Optional
+
+import pandas as pd
+
+PREVIEW_ROWS = 30
+# Deltas touching more than this fraction of the preview's cells are sent as a full preview instead.
+MAX_DELTA_FRACTION = 0.5
+
+
+def split_rows(df: pd.DataFrame) -> tuple[list, list]:
+    """Columns and rows of `df`, serialized the same way the preview always has been."""
+    split_df = json.loads(df.to_json(orient="split"))
+    return split_df["columns"], split_df["data"]
+
+
+def changed_cells(old: pd.DataFrame, new: pd.DataFrame) -> Optional[pd.DataFrame]:
+    """
+    Boolean frame of the cells that differ between two previews with the same columns and length, or None if the
+    previews can't be compared cell by cell.
+    """
+    if list(old.columns) != list(new.columns) or len(old) != len(new):
+        return None
+    old = old.reset_index(drop=True)
+    new = new.reset_index(drop=True)
+    try:
+        same = ((old == new) | (old.isna() & new.isna())).fillna(False).astype(bool)
+    except (TypeError, ValueError):
+        return None
+    changed = ~same
+    # A change of dtype alters how every value in the column is rendered
+    for column, old_dtype, new_dtype in zip(new.columns, old.dtypes, new.dtypes):
+        if old_dtype != new_dtype:
+            changed[column] = True
+    return changed
+
+
+class PreviewTracker:
+    """
+    Keeps track of the dataset preview last sent to the frontend.
+
+    `update()` compares the head of the current dataframe against the previous preview and returns the message that
+    brings the frontend up to date: nothing when the preview is unchanged, a `dataset_delta` when only a few rows or
+    columns changed, or a full `dataset` preview otherwise. Each message carries the preview `version` so the
+    frontend can verify that a delta applies to the preview it is showing.
+
+    Deltas are only sent once a frontend has said it can apply them, by setting `deltas`; until then every change
+    is sent as a full preview. A frontend that misses a version asks for the full preview again with `resync()`.
+    """
+
+    def __init__(self, name="Temp dataset (not saved)", rows=PREVIEW_ROWS, deltas=False):
+        self.name = name
+        self.rows = rows
+        self.deltas = deltas
+        self.reset()
+
+    def reset(self):
+        self.head: Optional[pd.DataFrame] = None
+        self.version = 0
+        # The DuckDB relation the preview was last taken from, if it was one
+        self.relation = None
+
+    def update(self, df: pd.DataFrame) -> Optional[tuple[str, dict]]:
+        # Copied, as the head can be a view that in-place changes to `df` would also update
+        head = df.head(self.rows).copy()
+        changed = changed_cells(self.head, head) if self.head is not None else None
+        if changed is not None and not changed.values.any():
+            return None
+
+        self.version += 1
+        self.head = head
+        message = None
+        if changed is not None and self.deltas:
+            message = self.delta(head, changed)
+        return message or self.full()
+
+    def resync(self, df: pd.DataFrame) -> tuple[str, dict]:
+        """The full preview of `df`, for a frontend that lost track of it. Sent even if it is unchanged."""
+        return self.update(df) or self.full()
+
+    def full(self) -> tuple[str, dict]:
+        columns, data = split_rows(self.head)
+        return ("dataset", {
+            "name": self.name,
+            "headers": columns,
+            "csv": [columns] + data,
+            "version": self.version,
+        })
+
+    def delta(self, head: pd.DataFrame, changed: pd.DataFrame) -> Optional[tuple[str, dict]]:
+        row_mask = changed.any(axis=1).values
+        column_mask = changed.any(axis=0).values
+        rows = [int(pos) for pos in row_mask.nonzero()[0]]
+        columns = [int(pos) for pos in column_mask.nonzero()[0]]
+        row_cells = len(rows) * head.shape[1]
+        column_cells = len(columns) * head.shape[0]
+        if min(row_cells, column_cells) > MAX_DELTA_FRACTION * head.size:
+            return None
+
+        content = {
+            "name": self.name,
+            "base_version": self.version - 1,
+            "version": self.version,
+        }
+        if row_cells <= column_cells:
+            _, data = split_rows(head.iloc[rows])
+            content["rows"] = [[pos, values] for pos, values in zip(rows, data)]
+        else:
+            names, data = split_rows(head.iloc[:, columns])
+            content["columns"] = [
+                [pos, name, [row[idx] for row in data]]
+                for idx, (pos, name) in enumerate(zip(columns, names))
+            ]
+        return ("dataset_delta", content)
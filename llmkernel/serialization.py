@@ -0,0 +1,120 @@
+import io
+import zlib
+from typing import Iterator
+
+import pandas as pd
+
+from toolsets.lazy_dataset import arrow_batches, is_relation, iter_relation_frames
+
+# Bytes per chunk handed to the caller, and rows serialized at a time. Together these bound how much of the
+# serialized frame is held in memory at once.
+CHUNK_SIZE = 1024 * 1024
+BATCH_ROWS = 50_000
+
+FORMATS = {
+    "csv": {"extension": ".csv", "mimetype": "text/csv"},
+    "csv.gz": {"extension": ".csv.gz", "mimetype": "application/gzip"},
+    "parquet": {"extension": ".parquet", "mimetype": "application/vnd.apache.parquet"},
+    "arrow": {"extension": ".arrow", "mimetype": "application/vnd.apache.arrow.stream"},
+}
+
+
+class ChunkBuffer(io.RawIOBase):
+    """Write-only sink that collects serialized bytes until they are drained off in chunks."""
+
+    def __init__(self):
+        super().__init__()
+        self.buffer = bytearray()
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer.extend(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self, chunk_size: int, final: bool = False) -> Iterator[bytes]:
+        while len(self.buffer) >= chunk_size or (final and self.buffer):
+            chunk = bytes(self.buffer[:chunk_size])
+            del self.buffer[:chunk_size]
+            yield chunk
+
+
+def iter_row_batches(df: pd.DataFrame, batch_rows: int = BATCH_ROWS) -> Iterator[pd.DataFrame]:
+    for start in range(0, len(df), batch_rows):
+        yield df.iloc[start:start + batch_rows]
+
+
+def arrow_schema(df: pd.DataFrame, sample_rows: int = BATCH_ROWS):
+    """Arrow schema for `df`, inferred from a sample of rows rather than by converting the whole frame."""
+    import pyarrow as pa
+
+    schema = pa.Schema.from_pandas(df.head(sample_rows), preserve_index=False)
+    for idx, field in enumerate(schema):
+        if pa.types.is_null(field.type) and field.name in df.columns:
+            # Column is empty in the sample; infer from its first values further down
+            values = df[field.name].dropna().head(sample_rows)
+            if len(values):
+                schema = schema.set(idx, field.with_type(pa.array(values).type))
+    return schema
+
+
+def iter_dataframe_bytes(df: pd.DataFrame, format: str = "csv", chunk_size: int = CHUNK_SIZE,
+                         batch_rows: int = BATCH_ROWS) -> Iterator[bytes]:
+    """
+    Serialize `df` in one of `FORMATS`, yielding the output in chunks of `chunk_size` bytes (the last may be shorter).
+
+    Rows are serialized `batch_rows` at a time, so the full serialized frame is never held in memory. `df` may also
+    be a DuckDB relation, whose rows are streamed out of DuckDB in batches of the same size.
+    """
+    if format not in FORMATS:
+        raise ValueError(f"Unsupported format '{format}'. Supported formats are: {', '.join(FORMATS)}")
+    sink = ChunkBuffer()
+
+    if format in ("csv", "csv.gz"):
+        # wbits=31 produces a gzip container rather than a bare zlib stream
+        compressor = zlib.compressobj(wbits=31) if format == "csv.gz" else None
+        if is_relation(df):
+            batches = iter_relation_frames(df, batch_rows)
+        else:
+            batches = iter_row_batches(df, batch_rows) if len(df) else [df]
+        header = True
+        for batch in batches:
+            data = batch.to_csv(index=False, header=header).encode()
+            sink.write(compressor.compress(data) if compressor else data)
+            header = False
+            yield from sink.drain(chunk_size)
+        if header:
+            # Empty relations produce no batches, but still get a header row
+            data = pd.DataFrame(columns=df.columns).to_csv(index=False).encode()
+            sink.write(compressor.compress(data) if compressor else data)
+        if compressor:
+            sink.write(compressor.flush())
+    else:
+        import pyarrow as pa
+
+        if is_relation(df):
+            batches = arrow_batches(df, batch_rows)
+            schema = batches.schema
+        else:
+            schema = arrow_schema(df, batch_rows)
+            batches = (
+                pa.Table.from_pandas(batch, schema=schema, preserve_index=False)
+                for batch in iter_row_batches(df, batch_rows)
+            )
+        if format == "parquet":
+            import pyarrow.parquet as pq
+            writer = pq.ParquetWriter(sink, schema)
+        else:
+            writer = pa.ipc.new_stream(sink, schema)
+        with writer:
+            for batch in batches:
+                writer.write(batch)
+                yield from sink.drain(chunk_size)
+
+    yield from sink.drain(chunk_size, final=True)
@@ -0,0 +1,270 @@
+import ast
+import datetime
+import itertools
+import os
+from typing import Optional
+
+import pandas as pd
+
+from toolsets.dataset_profile import buffer_key, column_checksum
+from toolsets.lazy_dataset import is_relation
+
+# Number of versions of `df` kept, and the memory they may take up together before the oldest are evicted.
+# A max size of 0 disables snapshots.
+DF_SNAPSHOT_MAX_COUNT = int(os.environ.get("DF_SNAPSHOT_MAX_COUNT", 20))
+DF_SNAPSHOT_MAX_BYTES = int(os.environ.get("DF_SNAPSHOT_MAX_BYTES", 1024 ** 3))
+LABEL_LENGTH = 80
+# Methods that change a dataframe in place without an `inplace` argument, and functions that only ever read the
+# dataframes passed to them
+MUTATING_METHODS = ("insert", "pop", "update", "__setitem__", "__delitem__", "__setattr__")
+READ_ONLY_FUNCTIONS = ("print", "display", "len", "repr", "str", "type", "id", "isinstance")
+
+
+def root_name(node: ast.AST) -> Optional[str]:
+    """The variable an expression such as `df["a"].loc[0]` or `df.fillna(0).sum` starts from, if any."""
+    while isinstance(node, (ast.Attribute, ast.Subscript, ast.Call)):
+        node = node.func if isinstance(node, ast.Call) else node.value
+    return node.id if isinstance(node, ast.Name) else None
+
+
+def refers_to(node: ast.AST, name: str) -> bool:
+    return any(isinstance(child, ast.Name) and child.id == name for child in ast.walk(node))
+
+
+def may_change(code: str, name: str = "df") -> bool:
+    """
+    Whether running `code` may rebind or change the dataframe `name` in place: by assigning to or deleting it or
+    any part of it, calling one of its methods with `inplace` or one that always changes it, or passing it to any
+    function but a few that only read it. Code that can't be parsed may change it.
+    """
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return True
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and node.id == name and isinstance(node.ctx, (ast.Store, ast.Del)):
+            return True
+        if isinstance(node, (ast.Assign, ast.Delete)):
+            targets = node.targets
+        elif isinstance(node, (ast.AugAssign, ast.AnnAssign)):
+            targets = [node.target]
+        else:
+            targets = []
+        if any(refers_to(target, name) for target in targets):
+            return True
+        if not isinstance(node, ast.Call):
+            continue
+        if isinstance(node.func, ast.Attribute) and root_name(node.func) == name:
+            inplace = any(
+                keyword.arg == "inplace" and not (isinstance(keyword.value, ast.Constant) and not keyword.value.value)
+                for keyword in node.keywords
+            )
+            if inplace or node.func.attr in MUTATING_METHODS:
+                return True
+        elif not (isinstance(node.func, ast.Name) and node.func.id in READ_ONLY_FUNCTIONS):
+            arguments = node.args + [keyword.value for keyword in node.keywords]
+            if any(refers_to(argument, name) for argument in arguments):
+                return True
+    return False
+
+
+def column_source(series: pd.Series):
+    """
+    Where the values of `series` are stored (see `buffer_key`) and a checksum of a sample of them (see
+    `column_checksum`), or None if its storage can't be told.
+    """
+    key = buffer_key(series)
+    checksum = column_checksum(series) if key is not None else None
+    if checksum is None:
+        return None
+    return key, checksum
+
+
+def column_bytes(series: pd.Series) -> int:
+    return int(series.memory_usage(index=False, deep=True))
+
+
+class Snapshot:
+    """
+    One version of `df`: its index and a list of (name, column) pairs.
+
+    Columns are private copies that are never handed out or modified, so they can be shared between snapshots. The
+    index is immutable and shared with the frame the snapshot was taken from. DuckDB relations are immutable too, and
+    are kept as they are. `sources` holds the `column_source` of each column of the frame the snapshot was taken from.
+    """
+
+    def __init__(self, snapshot_id: int, label: str, index=None, columns=None, relation=None, sources=None):
+        self.id = snapshot_id
+        self.label = label
+        self.created = datetime.datetime.utcnow()
+        self.index = index
+        self.columns = columns or []
+        self.relation = relation
+        self.sources = sources or {}
+
+    def restore(self):
+        """A new frame with this snapshot's contents, which can be modified without affecting the snapshot."""
+        if self.relation is not None:
+            return self.relation
+        if not self.columns:
+            return pd.DataFrame(index=self.index)
+        df = pd.concat([series.copy() for _, series in self.columns], axis=1)
+        df.columns = pd.Index([name for name, _ in self.columns])
+        return df
+
+    def describe(self) -> dict:
+        if self.relation is not None:
+            rows, columns = None, len(self.relation.columns)
+        else:
+            rows, columns = len(self.index), len(self.columns)
+        return {
+            "snapshot_id": self.id,
+            "label": self.label,
+            "created": self.created.isoformat() + "Z",
+            "rows": rows,
+            "columns": columns,
+        }
+
+
+class SnapshotHistory:
+    """
+    Bounded history of the versions of `df`, so a cell that breaks it can be undone without reloading the dataset.
+
+    `take()` records the current frame, copying only the columns that differ from the previous snapshot and sharing
+    the rest, and records nothing at all if the frame hasn't changed. Columns are told apart by where their values
+    are stored and a checksum of a sample of them (see `column_source`), without reading them all; a column stored
+    in the same place as before, with the same sampled values, is taken to be unchanged. Only columns whose storage
+    can't be told (extension dtypes) are compared value by value. Memory is counted once per distinct column, and the
+    oldest snapshots are evicted once the history holds more than `max_count` snapshots or `max_bytes` of columns.
+    Frames larger than `max_bytes` are never copied.
+    """
+
+    def __init__(self, max_count: int = DF_SNAPSHOT_MAX_COUNT, max_bytes: int = DF_SNAPSHOT_MAX_BYTES):
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.ids = itertools.count(1)
+        self.reset()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0 and self.max_count > 0
+
+    def reset(self):
+        self.snapshots: list[Snapshot] = []
+        # Memory of each distinct stored column, by id, so it is only measured once
+        self.sizes = {}
+
+    def latest(self) -> Optional[Snapshot]:
+        return self.snapshots[-1] if self.snapshots else None
+
+    def matches(self, snapshot: Snapshot, df) -> bool:
+        """Whether `df` holds the same data as `snapshot`."""
+        if is_relation(df) or snapshot.relation is not None:
+            return df is snapshot.relation
+        if not isinstance(df, pd.DataFrame) or df.shape[1] != len(snapshot.columns):
+            return False
+        if not df.index.equals(snapshot.index):
+            return False
+        return all(
+            name == column and self.same_column(series, df.iloc[:, idx])
+            for idx, (column, (name, series)) in enumerate(zip(df.columns, snapshot.columns))
+        )
+
+    @staticmethod
+    def same_column(stored: pd.Series, series: pd.Series) -> bool:
+        return stored.dtype == series.dtype and stored.equals(series)
+
+    def take(self, df, label: str = "") -> Optional[Snapshot]:
+        """Record `df` unless it is unchanged since the latest snapshot. Returns the new snapshot, if any."""
+        if not self.enabled:
+            return None
+        label = label.strip().splitlines()[0][:LABEL_LENGTH] if label.strip() else ""
+        previous = self.latest()
+        if is_relation(df):
+            if previous is not None and previous.relation is df:
+                return None
+            snapshot = Snapshot(next(self.ids), label, relation=df)
+        elif isinstance(df, pd.DataFrame):
+            if int(df.memory_usage(index=False, deep=False).sum()) > self.max_bytes:
+                # It would be evicted straight away, after copying all of it
+                return None
+            if previous is not None and previous.relation is None and df.index.equals(previous.index):
+                # Columns are matched by name, so columns that were added, dropped or reordered are still shared
+                stored = {name: series for name, series in previous.columns}
+                sources = previous.sources
+                index = previous.index
+            else:
+                stored = {}
+                sources = {}
+                index = df.index
+            columns = []
+            keys = {}
+            changed = False
+            for idx, name in enumerate(df.columns):
+                series = df.iloc[:, idx]
+                source = keys[name] = column_source(series)
+                match = stored.get(name)
+                if source is not None:
+                    unchanged = match is not None and source == sources.get(name)
+                else:
+                    unchanged = match is not None and self.same_column(match, series)
+                if unchanged:
+                    columns.append((name, match))
+                else:
+                    copy = series.copy(deep=True)
+                    self.sizes[id(copy)] = column_bytes(copy)
+                    columns.append((name, copy))
+                    changed = True
+            if previous is not None and not changed and index is previous.index \
+                    and [name for name, _ in columns] == [name for name, _ in previous.columns]:
+                return None
+            snapshot = Snapshot(next(self.ids), label, index=index, columns=columns, sources=keys)
+        else:
+            return None
+
+        self.snapshots.append(snapshot)
+        self.evict()
+        return snapshot if snapshot in self.snapshots else None
+
+    def stored_columns(self) -> dict:
+        return {id(series): series for snapshot in self.snapshots for _, series in snapshot.columns}
+
+    def total_bytes(self) -> int:
+        return sum(self.sizes.get(key, 0) for key in self.stored_columns())
+
+    def evict(self):
+        while len(self.snapshots) > self.max_count:
+            self.snapshots.pop(0)
+        while self.snapshots and self.total_bytes() > self.max_bytes:
+            self.snapshots.pop(0)
+        stored = self.stored_columns()
+        self.sizes = {key: size for key, size in self.sizes.items() if key in stored}
+
+    def find(self, snapshot_id: int) -> Optional[Snapshot]:
+        for snapshot in self.snapshots:
+            if snapshot.id == snapshot_id:
+                return snapshot
+        return None
+
+    def undo(self, df, snapshot_id: Optional[int] = None) -> Optional[Snapshot]:
+        """
+        The snapshot to go back to: `snapshot_id` if given, otherwise the latest snapshot that differs from `df`.
+
+        That snapshot and every later one are dropped from the history, as `df` is about to be replaced by it.
+        """
+        if snapshot_id is not None:
+            snapshot = self.find(snapshot_id)
+        else:
+            snapshot = next((snapshot for snapshot in reversed(self.snapshots) if not self.matches(snapshot, df)), None)
+        if snapshot is not None:
+            del self.snapshots[self.snapshots.index(snapshot):]
+            self.evict()
+        return snapshot
+
+    def describe(self) -> dict:
+        return {
+            "snapshots": [snapshot.describe() for snapshot in self.snapshots],
+            "total_bytes": self.total_bytes(),
+            "max_bytes": self.max_bytes,
+            "max_count": self.max_count,
+        }
@@ -0,0 +1,172 @@
+import logging
+import tempfile
+import time
+from typing import Callable, Iterable, Iterator, Optional
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+# Parts of a resumable upload must be a multiple of 256KiB (except the last one).
+PART_SIZE = 8 * 1024 * 1024
+PART_RETRIES = 3
+# Bytes of a stream with no known length that are spooled in memory while it is measured, before moving to a temporary
+# file
+SPOOL_MEMORY_BYTES = 64 * 1024 * 1024
+CHUNK_READ_SIZE = 1024 * 1024
+
+
+class UploadError(Exception):
+    pass
+
+
+def iter_parts(chunks: Iterable[bytes], part_size: int) -> Iterator[tuple[bytes, bool]]:
+    """Regroup `chunks` into parts of exactly `part_size` bytes, flagging the last part."""
+    buffer = bytearray()
+    pending = None
+    for chunk in chunks:
+        buffer.extend(chunk)
+        while len(buffer) >= part_size:
+            if pending is not None:
+                yield pending, False
+            pending = bytes(buffer[:part_size])
+            del buffer[:part_size]
+    if buffer:
+        if pending is not None:
+            yield pending, False
+        yield bytes(buffer), True
+    elif pending is not None:
+        yield pending, True
+
+
+class SizedReader:
+    """Reads a file of known size as a request body, so it is sent with a Content-Length, reporting the bytes read."""
+
+    def __init__(self, file, size: int, on_progress: Optional[Callable[[int], None]] = None):
+        self.file = file
+        self.size = size
+        self.on_progress = on_progress
+        self.sent = 0
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return iter_file(self)
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.sent += len(data)
+        if data and self.on_progress:
+            self.on_progress(self.sent)
+        return data
+
+
+def check_response(response: requests.Response) -> requests.Response:
+    if response.status_code not in (200, 201):
+        raise UploadError(f"Error uploading dataframe: {response.content}")
+    return response
+
+
+def put_bytes(url: str, data: bytes, headers: Optional[dict] = None, put=requests.put) -> requests.Response:
+    """PUT `data`, whose length is known, to `url`."""
+    return check_response(put(url, data=data, headers=headers))
+
+
+def spool(chunks: Iterable[bytes]) -> tempfile.SpooledTemporaryFile:
+    """
+    The concatenated `chunks` in a file, kept in memory up to `SPOOL_MEMORY_BYTES` and moved to disk beyond that,
+    rewound to the start. The caller closes it.
+    """
+    file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_BYTES)
+    try:
+        for chunk in chunks:
+            file.write(chunk)
+    except BaseException:
+        file.close()
+        raise
+    file.seek(0)
+    return file
+
+
+def iter_file(file, chunk_size: int = CHUNK_READ_SIZE) -> Iterator[bytes]:
+    return iter(lambda: file.read(chunk_size), b"")
+
+
+def put_file(url: str, file, headers: Optional[dict] = None, on_progress: Optional[Callable[[int], None]] = None,
+             put=requests.put) -> requests.Response:
+    """PUT the rest of `file`, from its current position, to `url` with a Content-Length."""
+    start = file.tell()
+    size = file.seek(0, 2) - start
+    file.seek(start)
+    return check_response(put(url, data=SizedReader(file, size, on_progress), headers=headers))
+
+
+def put_stream(url: str, chunks: Iterable[bytes], headers: Optional[dict] = None,
+               on_progress: Optional[Callable[[int], None]] = None, put=requests.put,
+               chunked: bool = False) -> requests.Response:
+    """
+    PUT the concatenated `chunks` to `url`.
+
+    Presigned storage URLs (e.g. S3) reject bodies without a Content-Length, so by default the chunks are spooled
+    (see `spool`) until their length is known, and then sent. With `chunked`, they are sent as a chunked-encoding body
+    as they are produced instead, for servers that accept that.
+    """
+    if chunked:
+        def body():
+            sent = 0
+            for chunk in chunks:
+                yield chunk
+                sent += len(chunk)
+                if on_progress:
+                    on_progress(sent)
+
+        return check_response(put(url, data=body(), headers=headers))
+
+    with spool(chunks) as file:
+        return put_file(url, file, headers=headers, on_progress=on_progress, put=put)
+
+
+def put_resumable(url: str, chunks: Iterable[bytes], headers: Optional[dict] = None, part_size: int = PART_SIZE,
+                  on_progress: Optional[Callable[[int], None]] = None, retries: int = PART_RETRIES,
+                  put=requests.put) -> requests.Response:
+    """
+    Upload the concatenated `chunks` to a resumable upload URL as a sequence of `Content-Range` PUTs.
+
+    Each part is retried on its own if it fails, so a dropped connection only costs the part that was in flight.
+    The server must acknowledge intermediate parts with 308 and the final part with 200/201, as resumable uploads to
+    Google Cloud Storage do. A 200/201 before the final part means the URL doesn't support resumable uploads, and that
+    each part replaced the last, so it is an error.
+    """
+    offset = 0
+    response = None
+    for part, last in iter_parts(chunks, part_size):
+        end = offset + len(part) - 1
+        total = offset + len(part) if last else "*"
+        part_headers = dict(headers or {}, **{"Content-Range": f"bytes {offset}-{end}/{total}"})
+        for attempt in range(retries):
+            try:
+                response = put(url, data=part, headers=part_headers)
+            except requests.RequestException as err:
+                logger.warning(f"Error uploading part at offset {offset}: {err}")
+                response = None
+            if response is not None and response.status_code in (200, 201, 308):
+                break
+            if attempt < retries - 1:
+                time.sleep(2 ** attempt)
+        else:
+            content = response.content if response is not None else "no response"
+            raise UploadError(f"Error uploading dataframe part at offset {offset}: {content}")
+        if not last and response.status_code != 308:
+            raise UploadError(
+                f"Upload URL completed the upload at offset {offset}, before the final part; it doesn't support "
+                f"resumable uploads"
+            )
+        offset += len(part)
+        if on_progress:
+            on_progress(offset)
+
+    if response is None:
+        # Nothing was serialized; finalize an empty upload
+        response = put(url, data=b"", headers=dict(headers or {}, **{"Content-Range": "bytes */0"}))
+    return check_response(response)
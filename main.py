@@ -1,19 +1,230 @@
+import asyncio
+import json
 import os
+import secrets
+import uuid
 
+from jupyter_server._tz import utcnow
 from jupyter_server.base.handlers import JupyterHandler
 from jupyter_server.extension.handler import ExtensionHandlerJinjaMixin, ExtensionHandlerMixin
-from jupyter_server.utils import url_path_join as ujoin
+from jupyter_server.services.kernels.kernelmanager import AsyncMappingKernelManager
 from jupyterlab_server import LabServerApp
+from tornado import iostream, web
+from traitlets import Bool, Float, Integer, Unicode
+
+from llmkernel.broker import PRIORITIES, LLMBroker, broker_url
 
 
 HERE = os.path.dirname(__file__)
 
 version = "0.0.1"
 
+# Number of warm kernels kept ready to be handed to new sessions, and which kernel they run. A pool size of 0 disables
+# the pool.
+KERNEL_POOL_SIZE = int(os.environ.get("KERNEL_POOL_SIZE", 2))
+KERNEL_POOL_KERNEL_NAME = os.environ.get("KERNEL_POOL_KERNEL_NAME", "llmkernel")
+KERNEL_POOL_WARMUP_TIMEOUT = float(os.environ.get("KERNEL_POOL_WARMUP_TIMEOUT", 120))
+# Run in every pooled kernel ahead of time, so the imports done on context setup are already loaded
+KERNEL_POOL_WARMUP_CODE = "import pandas as pd; import numpy as np; import scipy"
+# Environment variables that differ between sessions, which are set in a pooled kernel when it is handed out. Sessions
+# that differ from the pool in any other variable get a kernel of their own, as the kernel reads its settings on start.
+KERNEL_POOL_SESSION_ENV = ("JPY_SESSION_NAME",)
+# Whether the server hosts the LLM broker that kernels send their LLM calls through (see llmkernel/broker.py), and the
+# URL kernels reach it at, if not the one the server listens on (e.g. when its TLS certificate is for another name).
+LLM_BROKER_ENABLED = os.environ.get("LLM_BROKER_ENABLED", "true").lower() in ("1", "true", "yes")
+LLM_BROKER_KERNEL_URL = os.environ.get("LLM_BROKER_KERNEL_URL", "")
+
+
+def session_env(env: dict) -> dict:
+    """`env` without the variables that differ between sessions."""
+    return {name: value for name, value in env.items() if name not in KERNEL_POOL_SESSION_ENV}
+
+
 def _jupyter_server_extension_points():
     return [{"module": __name__, "app": AskemJupyterApp}]
 
 
+class PooledKernelManager(AsyncMappingKernelManager):
+    """
+    Kernel manager that keeps a pool of warm kernels to hand out to new sessions.
+
+    Pooled kernels have been started, have built their agent and have run `KERNEL_POOL_WARMUP_CODE`, so a session that
+    is given one can run its first cell right away. A kernel taken from the pool is moved to the session's directory,
+    and the pool is refilled in the background. Pooled kernels are not listed or culled until they are handed out.
+    Kernels started with a specific id, with a different kernel name, or with another environment than the pooled
+    kernels were started in (other than `KERNEL_POOL_SESSION_ENV`) or any other options, are started as usual.
+    """
+
+    pool_size = Integer(KERNEL_POOL_SIZE, config=True, help="Number of warm kernels to keep ready.")
+    pool_kernel_name = Unicode(KERNEL_POOL_KERNEL_NAME, config=True, help="Name of the kernel spec to keep warm.")
+    pool_warmup_timeout = Float(KERNEL_POOL_WARMUP_TIMEOUT, config=True, help="Seconds to wait for a kernel to warm up.")
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # Warm kernels ready to be handed out, oldest first
+        self.pool = []
+        # Ids of every kernel started for the pool that hasn't been handed out yet, warm or still starting
+        self.pool_ids = set()
+        # Kernel id -> environment each pooled kernel was started in
+        self.pool_envs = {}
+
+    def fill_pool(self):
+        while len(self.pool_ids) < self.pool_size:
+            kernel_id = str(uuid.uuid4())
+            self.pool_ids.add(kernel_id)
+            asyncio.ensure_future(self.start_pooled_kernel(kernel_id))
+
+    async def start_pooled_kernel(self, kernel_id):
+        env = dict(os.environ)
+        self.pool_envs[kernel_id] = env
+        try:
+            await super().start_kernel(kernel_id=kernel_id, kernel_name=self.pool_kernel_name, env=env)
+            await self.run_code(kernel_id, KERNEL_POOL_WARMUP_CODE)
+        except Exception:
+            self.log.exception("Unable to start a pooled kernel")
+            self.pool_ids.discard(kernel_id)
+            self.pool_envs.pop(kernel_id, None)
+            if kernel_id in self:
+                await self.shutdown_kernel(kernel_id, now=True)
+            return
+        self.pool.append(kernel_id)
+        self.log.info("Pooled kernel ready: %s", kernel_id)
+
+    async def run_code(self, kernel_id, code, wait_for_ready=True):
+        """Silently run `code` in a kernel and wait for it to finish."""
+        client = self.get_kernel(kernel_id).client()
+        client.start_channels()
+        try:
+            # Only the shell channel is used, so a kernel that is known to be up needn't be waited on
+            if wait_for_ready:
+                await client.wait_for_ready(timeout=self.pool_warmup_timeout)
+            msg_id = client.execute(code, silent=True, store_history=False)
+            while True:
+                reply = await client.get_shell_msg(timeout=self.pool_warmup_timeout)
+                if reply["parent_header"].get("msg_id") == msg_id:
+                    break
+            if reply["content"]["status"] != "ok":
+                raise RuntimeError(f"Error running code in kernel {kernel_id}: {reply['content'].get('evalue')}")
+        finally:
+            client.stop_channels()
+
+    def take_pooled_kernel(self, env):
+        """The oldest pooled kernel started in `env`, but for `KERNEL_POOL_SESSION_ENV`, if there is one."""
+        env = session_env(env)
+        server_env = session_env(os.environ)
+        for kernel_id in list(self.pool):
+            pool_env = session_env(self.pool_envs[kernel_id])
+            # Pooled kernels that died while waiting have already been removed
+            alive = kernel_id in self
+            if alive and pool_env != env and pool_env == server_env:
+                # Left for a session started in the server's environment
+                continue
+            self.pool.remove(kernel_id)
+            self.pool_ids.discard(kernel_id)
+            self.pool_envs.pop(kernel_id)
+            if not alive:
+                continue
+            if pool_env == env:
+                return kernel_id
+            # Started before the server's environment changed, so sessions would never be given it
+            asyncio.ensure_future(self.shutdown_kernel(kernel_id, now=True))
+        return None
+
+    async def start_kernel(self, *, kernel_id=None, path=None, **kwargs):
+        kernel_name = kwargs.get("kernel_name") or self.default_kernel_name
+        env = kwargs.get("env") or dict(os.environ)
+        options = set(kwargs) - {"kernel_name", "env"}
+        if kernel_id is None and kernel_name == self.pool_kernel_name and self.pool_size > 0 and not options:
+            pooled_kernel_id = self.take_pooled_kernel(env)
+            self.fill_pool()
+            if pooled_kernel_id is not None:
+                code = ""
+                if path is not None:
+                    code += f"__import__('os').chdir({self.cwd_for_path(path)!r});"
+                session = {name: env[name] for name in KERNEL_POOL_SESSION_ENV if name in env}
+                if session:
+                    code += f"__import__('os').environ.update({session!r});"
+                if code:
+                    await self.run_code(pooled_kernel_id, code, wait_for_ready=False)
+                # Don't let the culler count the time spent waiting in the pool as idle time
+                self.get_kernel(pooled_kernel_id).last_activity = utcnow()
+                self.log.info("Using pooled kernel: %s", pooled_kernel_id)
+                return pooled_kernel_id
+        return await super().start_kernel(kernel_id=kernel_id, path=path, **kwargs)
+
+    def list_kernels(self):
+        kernels = []
+        for kernel_id in self.list_kernel_ids():
+            if kernel_id in self.pool_ids:
+                continue
+            try:
+                kernels.append(self.kernel_model(kernel_id))
+            except (web.HTTPError, KeyError):
+                pass
+        return kernels
+
+    async def cull_kernel_if_idle(self, kernel_id):
+        if kernel_id in self.pool_ids:
+            return
+        return await super().cull_kernel_if_idle(kernel_id)
+
+
+class LLMBrokerHandler(web.RequestHandler):
+    """
+    OpenAI compatible chat completions endpoint for the kernels of this server, backed by the `LLMBroker`.
+
+    Kernels authenticate with the broker token as their API key, and say who the call is for and how urgent it is
+    with the `X-LLM-User` and `X-LLM-Priority` headers.
+    """
+
+    def initialize(self, broker: LLMBroker, token: str):
+        self.broker = broker
+        self.token = token
+
+    def check_xsrf_cookie(self):
+        # Kernels aren't browsers, and are authenticated by the token instead
+        pass
+
+    def prepare(self):
+        if not secrets.compare_digest(self.request.headers.get("Authorization", ""), f"Bearer {self.token}"):
+            raise web.HTTPError(403)
+
+    async def post(self):
+        try:
+            body = json.loads(self.request.body)
+        except ValueError:
+            raise web.HTTPError(400, "Invalid JSON body")
+        user = self.request.headers.get("X-LLM-User", "") or "anonymous"
+        priority = self.request.headers.get("X-LLM-Priority", "")
+        if priority not in PRIORITIES:
+            priority = PRIORITIES[-1]
+
+        if body.get("stream"):
+            self.set_header("Content-Type", "text/event-stream")
+            status, error = await self.broker.stream(body, user, priority, self.write_chunk)
+        else:
+            status, error = await self.broker.complete(body, user, priority)
+        # Tornado reports connection failures as 599, which isn't a real HTTP status
+        self.set_status(502 if status == 599 else status)
+        if error:
+            self.set_header("Content-Type", "application/json")
+            self.finish(error)
+
+    def write_chunk(self, chunk: bytes):
+        try:
+            self.write(chunk)
+            self.flush()
+        except iostream.StreamClosedError:
+            pass
+
+
+class LLMBrokerStatsHandler(LLMBrokerHandler):
+    SUPPORTED_METHODS = ("GET",)
+
+    def get(self):
+        self.write(self.broker.stats())
+
+
 class AskemJupyterApp(LabServerApp):
 
     name = __name__
@@ -21,16 +232,46 @@ class AskemJupyterApp(LabServerApp):
     app_name = "Askem Jupyter App"
     app_version = version
     allow_origin = "*"
+    serverapp_config = {
+        "kernel_manager_class": PooledKernelManager,
+    }
+
+    llm_broker_enabled = Bool(LLM_BROKER_ENABLED, config=True, help="Send the LLM calls of kernels through the broker.")
+    llm_broker_url = Unicode(
+        LLM_BROKER_KERNEL_URL, config=True, help="URL kernels reach the broker at, if not the one the server listens on.",
+    )
 
     def initialize_handlers(self):
-        """Bypass initializing the default handler since we don't need to use the webserver, just the websockets."""
-        pass
-        
+        """
+        Bypass initializing the default handler since we don't need to use the webserver, just the websockets. The only
+        handlers are those of the LLM broker.
+        """
+        if self.llm_broker_enabled:
+            self.llm_broker = LLMBroker()
+            self.llm_broker_token = secrets.token_hex(32)
+            handler_kwargs = {"broker": self.llm_broker, "token": self.llm_broker_token}
+            self.handlers.append((r"/llm-broker/chat/completions", LLMBrokerHandler, handler_kwargs))
+            self.handlers.append((r"/llm-broker/stats", LLMBrokerStatsHandler, handler_kwargs))
+
 
     def initialize_settings(self):
         # Override to allow cross domain websockets
         self.settings['allow_origin'] = '*'
 
+    async def _start_jupyter_server_extension(self, serverapp):
+        # Warm up the kernel pool as soon as the server is running, rather than on the first session
+        if self.llm_broker_enabled:
+            # Kernels inherit the server's environment, so this is how they find the broker
+            url = self.llm_broker_url or broker_url(serverapp)
+            if url:
+                os.environ["LLM_BROKER_URL"] = url
+                os.environ["LLM_BROKER_TOKEN"] = self.llm_broker_token
+            else:
+                self.log.warning("The server only listens on a Unix socket; kernels will call the LLM provider directly")
+        kernel_manager = serverapp.kernel_manager
+        if isinstance(kernel_manager, PooledKernelManager):
+            kernel_manager.fill_pool()
+
 if __name__ == "__main__":
     AskemJupyterApp.launch_instance()
 
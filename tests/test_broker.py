@@ -0,0 +1,156 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+from tornado import httpserver, netutil, web
+
+from llmkernel.broker import LLMBroker, broker_url
+
+
+class FakeCompletions(web.RequestHandler):
+    """
+    Stand-in for an LLM provider's chat completions endpoint. Answers every call after `delay` seconds with the last
+    message echoed back, rejecting the first `rate_limits` calls with a 429.
+    """
+
+    def initialize(self, provider):
+        self.provider = provider
+
+    async def post(self):
+        provider = self.provider
+        body = json.loads(self.request.body)
+        provider.calls.append((dict(self.request.headers), body))
+        if provider.rate_limits:
+            provider.rate_limits -= 1
+            self.set_status(429)
+            self.set_header("Retry-After", "0")
+            self.finish({"error": {"message": "Rate limited"}})
+            return
+        await asyncio.sleep(provider.delay)
+        content = body["messages"][-1]["content"]
+        if body.get("stream"):
+            for word in content.split():
+                self.write(f"data: {json.dumps({'choices': [{'delta': {'content': word}}]})}\n\n")
+                await self.flush()
+            self.finish("data: [DONE]\n\n")
+            return
+        self.finish({"choices": [{"message": {"role": "assistant", "content": content}}], "usage": {"total_tokens": 5}})
+
+
+class FakeProvider:
+
+    def __init__(self, delay=0.0, rate_limits=0):
+        self.delay = delay
+        self.rate_limits = rate_limits
+        self.calls = []
+        sockets = netutil.bind_sockets(0, "127.0.0.1")
+        self.url = f"http://127.0.0.1:{sockets[0].getsockname()[1]}/v1"
+        self.server = httpserver.HTTPServer(web.Application([(r"/v1/chat/completions", FakeCompletions, {"provider": self})]))
+        self.server.add_sockets(sockets)
+
+
+def run_with_provider(test, **kwargs):
+    async def main():
+        provider = FakeProvider(**kwargs)
+        broker = LLMBroker(upstream_url=provider.url, api_key="secret")
+        try:
+            await test(broker, provider)
+        finally:
+            provider.server.stop()
+            broker.client().close()
+
+    asyncio.run(main())
+
+
+def request(content, **kwargs):
+    return {"model": "gpt-4", "messages": [{"role": "user", "content": content}], **kwargs}
+
+
+def test_complete():
+    async def test(broker, provider):
+        status, body = await broker.complete(request("hello"), "alice", "interactive")
+        assert status == 200
+        assert json.loads(body)["choices"][0]["message"]["content"] == "hello"
+        headers, sent = provider.calls[0]
+        assert headers["Authorization"] == "Bearer secret"
+        assert sent == request("hello")
+
+    run_with_provider(test)
+
+
+def test_identical_calls_are_coalesced():
+    async def test(broker, provider):
+        results = await asyncio.gather(*(broker.complete(request("hello"), user, "interactive") for user in "abc"))
+        assert [status for status, _ in results] == [200, 200, 200]
+        assert len(provider.calls) == 1
+        assert broker.stats()["coalesced"] == 2
+
+    run_with_provider(test, delay=0.1)
+
+
+def test_rate_limited_calls_are_retried():
+    async def test(broker, provider):
+        status, _ = await broker.complete(request("hello"), "alice", "interactive")
+        assert status == 200
+        assert len(provider.calls) == 2
+        assert broker.stats()["rate_limited"] == 1
+
+    run_with_provider(test, rate_limits=1)
+
+
+def test_rate_limit_is_passed_on_after_retries():
+    async def test(broker, provider):
+        broker.max_retries = 1
+        status, body = await broker.complete(request("hello"), "alice", "interactive")
+        assert status == 429
+        assert json.loads(body)["error"]["message"] == "Rate limited"
+        assert len(provider.calls) == 2
+
+    run_with_provider(test, rate_limits=5)
+
+
+def test_stream():
+    async def test(broker, provider):
+        chunks = []
+        status, error = await broker.stream(request("hello there", stream=True), "alice", "interactive", chunks.append)
+        assert (status, error) == (200, b"")
+        streamed = b"".join(chunks).decode()
+        assert '"hello"' in streamed and '"there"' in streamed and streamed.endswith("data: [DONE]\n\n")
+
+    run_with_provider(test)
+
+
+def test_interactive_calls_go_first():
+    async def test(broker, provider):
+        broker.max_concurrency = 1
+        order = []
+
+        async def call(content, priority):
+            await broker.complete(request(content), "alice", priority)
+            order.append(content)
+
+        first = asyncio.ensure_future(call("first", "background"))
+        await asyncio.sleep(0.05)
+        await asyncio.gather(first, call("background", "background"), call("interactive", "interactive"))
+        assert order == ["first", "interactive", "background"]
+
+    run_with_provider(test, delay=0.1)
+
+
+def server(**kwargs):
+    settings = {"ip": "localhost", "port": 8888, "base_url": "/", "certfile": "", "sock": ""}
+    settings.update(kwargs)
+    return SimpleNamespace(**settings)
+
+
+@pytest.mark.parametrize("settings, url", [
+    ({}, "http://localhost:8888/llm-broker"),
+    ({"ip": "0.0.0.0", "port": 9000}, "http://127.0.0.1:9000/llm-broker"),
+    ({"ip": "", "base_url": "/jupyter/"}, "http://127.0.0.1:8888/jupyter/llm-broker"),
+    ({"ip": "::"}, "http://[::1]:8888/llm-broker"),
+    ({"ip": "10.0.0.5", "certfile": "/etc/ssl/server.pem"}, "https://10.0.0.5:8888/llm-broker"),
+    ({"sock": "/run/jupyter.sock"}, None),
+])
+def test_broker_url(settings, url):
+    assert broker_url(server(**settings)) == url
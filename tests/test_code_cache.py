@@ -0,0 +1,128 @@
+import json
+import time
+
+import pandas as pd
+import pytest
+
+from toolsets.code_cache import CodeCache, generated_code, schema_fingerprint
+
+CODE = json.dumps({"action": "code_cell", "language": "python", "content": "df.head()"})
+
+
+def frame(**dtypes):
+    return pd.DataFrame({name: pd.Series([1, 2, 3], dtype=dtype) for name, dtype in (dtypes or {"age": "int64"}).items()})
+
+
+def test_key_ignores_phrasing():
+    cache = CodeCache()
+    fingerprint = schema_fingerprint(frame())
+    assert cache.key("Plot the ages.", fingerprint) == cache.key("  plot the   AGES", fingerprint)
+
+
+@pytest.mark.parametrize("change", [
+    {"query": "plot the heights"},
+    {"fingerprint": schema_fingerprint(frame(age="float64"))},
+    {"model": "gpt-4o"},
+    {"lint_mode": "fix"},
+    {"previous_code": "df.plot()"},
+])
+def test_key_changes(change):
+    cache = CodeCache()
+    args = {"query": "plot the ages", "fingerprint": schema_fingerprint(frame()), "model": "gpt-4", "lint_mode": "flag"}
+    assert cache.key(**args) != cache.key(**dict(args, **change))
+
+
+def test_hit_and_miss(tmp_path):
+    cache = CodeCache(str(tmp_path))
+    key = cache.key("plot the ages", schema_fingerprint(frame()))
+    assert cache.get(key) is None
+    cache.put(key, CODE, query="plot the ages")
+    assert cache.get(key) == CODE
+    assert cache.stats() == {"hits": 1, "misses": 1, "entries": 1}
+
+
+def test_entries_survive_restarts(tmp_path):
+    key = CodeCache(str(tmp_path)).key("plot the ages", schema_fingerprint(frame()))
+    CodeCache(str(tmp_path)).put(key, CODE)
+    assert CodeCache(str(tmp_path)).get(key) == CODE
+
+
+def test_expired_entries_are_removed(tmp_path):
+    cache = CodeCache(str(tmp_path), ttl=60)
+    key = cache.key("plot the ages", schema_fingerprint(frame()))
+    cache.put(key, CODE)
+    cache.entries[key]["created"] = time.time() - 120
+    assert cache.get(key) is None
+    assert not (tmp_path / f"{key}.json").exists()
+
+
+def test_generated_code():
+    assert generated_code(CODE) == "df.head()"
+    assert generated_code("The dataset has 3 rows.") is None
+    assert generated_code(json.dumps({"action": "answer"})) is None
+
+
+class StubAgent:
+    """Answers every one-shot call with the same code block, counting the calls."""
+
+    model = "stub"
+
+    def __init__(self):
+        self.calls = 0
+
+    def oneshot(self, prompt, query):
+        self.calls += 1
+        return "```\ndf['age'].plot()\n```"
+
+
+class StubLoop:
+    STOP_SUCCESS = "success"
+
+    def set_state(self, state):
+        self.state = state
+
+
+@pytest.fixture
+def toolset(tmp_path):
+    pytest.importorskip("archytas")
+    from toolsets.dataset_toolset import DatasetToolset
+
+    toolset = DatasetToolset()
+    toolset.code_cache = CodeCache(str(tmp_path))
+    toolset.agent = StubAgent()
+    toolset.kernel = None
+    toolset.dataset_id = 1
+    toolset.dataset = {"name": "People", "description": "Ages of people"}
+    toolset.df = frame()
+    return toolset
+
+
+def test_generated_code_is_reused(toolset):
+    agent = toolset.agent
+    first = toolset.generate_python_code("plot the ages", agent, StubLoop())
+    second = toolset.generate_python_code("Plot the ages.", agent, StubLoop())
+    assert agent.calls == 1
+    assert json.loads(second)["content"] == json.loads(first)["content"] == "df['age'].plot()"
+
+
+def test_changed_schema_misses(toolset):
+    agent = toolset.agent
+    toolset.generate_python_code("plot the ages", agent, StubLoop())
+    toolset.df = frame(age="float64")
+    toolset.generate_python_code("plot the ages", agent, StubLoop())
+    assert agent.calls == 2
+
+
+def test_cache_can_be_skipped(toolset):
+    agent = toolset.agent
+    toolset.use_code_cache = False
+    toolset.generate_python_code("plot the ages", agent, StubLoop())
+    toolset.generate_python_code("plot the ages", agent, StubLoop())
+    assert agent.calls == 2
+
+
+def test_follow_ups_are_keyed_by_the_previous_code(toolset):
+    toolset.cache_code("same but as a bar chart", CODE, previous_code="df['age'].plot()")
+    assert toolset.cached_code("same but as a bar chart", previous_code="df['age'].plot()") == CODE
+    assert toolset.cached_code("same but as a bar chart", previous_code="df['height'].plot()") is None
+    assert toolset.cached_code("same but as a bar chart") is None
@@ -0,0 +1,119 @@
+import ast
+
+import pytest
+
+from toolsets.code_lint import lint_code, lint_feedback
+
+
+def rules(report) -> list:
+    return [finding.rule for finding in report.findings]
+
+
+@pytest.mark.parametrize("code, rule, line", [
+    ("total = 0\nfor idx, row in df.iterrows():\n    total += row['a']\n", "row_loop", 2),
+    ("names = [row.name for row in df.itertuples()]\n", "row_loop", 1),
+    ("total = 0\nfor i in range(len(df)):\n    total += df.iloc[i]['a']\n", "index_loop", 2),
+    ("df['c'] = df.apply(lambda row: row['a'] + row['b'], axis=1)\n", "row_apply", 1),
+    ("df['c'] = df.apply(combine, axis='columns')\n", "row_apply", 1),
+    ("out = df.head(0)\nfor key in keys:\n    out = pd.concat([out, df[df['k'] == key]])\n    print(len(out))\n",
+     "concat_in_loop", 3),
+    ("df[df['a'] > 0]['b'] = 1\n", "chained_assignment", 1),
+    ("df.loc[df['a'] > 0]['b'] += 1\n", "chained_assignment", 1),
+    ("for key in keys:\n    part = df.copy()\n    part['k'] = key\n", "copy_in_loop", 2),
+])
+def test_flagged(code, rule, line):
+    report = lint_code(code, fix=False)
+    assert rules(report) == [rule]
+    finding = report.findings[0]
+    assert finding.line == line
+    assert not finding.fixed
+    assert report.code == code
+
+
+@pytest.mark.parametrize("code", [
+    "df['c'] = df['a'] + df['b']\n",
+    "df['c'] = df['a'].apply(str)\n",
+    "df['c'] = df.apply(sum, axis=0)\n",
+    "for i in range(len(df)):\n    print(i)\n",
+    "d = {}\nd['a']['b'] = 1\n",
+    "df.loc[df['a'] > 0, 'b'] = 1\n",
+    "parts = [df[df['k'] == key] for key in keys]\nout = pd.concat(parts)\n",
+    "for key in keys:\n    def select(part):\n        return part.copy()\n",
+    "for row in df.iterrows(:\n",
+])
+def test_not_flagged(code):
+    assert lint_code(code, fix=False).findings == []
+
+
+def test_concat_rewrite():
+    code = (
+        "out = df.head(0)\n"
+        "for key in keys:\n"
+        "    out = pd.concat([out, df[df['k'] == key]], ignore_index=True)\n"
+        "print(out)\n"
+    )
+    report = lint_code(code)
+    assert report.code == (
+        "out = df.head(0)\n"
+        "out_pieces = [out]\n"
+        "for key in keys:\n"
+        "    out_pieces.append(df[df['k'] == key])\n"
+        "out = pd.concat(out_pieces, ignore_index=True)\n"
+        "print(out)\n"
+    )
+    assert [(finding.rule, finding.fixed) for finding in report.findings] == [("concat_in_loop", True)]
+    assert report.regenerable == []
+
+
+@pytest.mark.parametrize("code", [
+    "out = df.head(0)\nfor key in keys:\n    out = pd.concat([out, df[df['k'] == key]])",
+    "out = df.head(0)\nfor key in keys:\n    out = pd.concat([out, df[df['k'] == key]])\n",
+    "def combine(df, keys):\n    out = df.head(0)\n    for key in keys:\n        out = pd.concat([out, df[df['k'] == key]])\n"
+    "    return out\n",
+])
+def test_concat_rewrite_adds_no_blank_lines(code):
+    rewritten = lint_code(code).code
+    assert rewritten.endswith("\n") == code.endswith("\n")
+    assert "\n\n" not in rewritten
+    ast.parse(rewritten)
+
+
+@pytest.mark.parametrize("code", [
+    # The accumulator is read in the loop, which would see the pieces gathered so far
+    "out = df.head(0)\nfor key in keys:\n    out = pd.concat([out, df[df['k'] == key]])\n    print(len(out))\n",
+    "out = df.head(0)\nfor key in keys:\n    out = pd.concat([df[df['k'] == key], out])\n",
+    "out = df.head(0)\nfor key in keys:\n    out = pd.concat([out, df[df['k'] == key]])\nelse:\n    pass\n",
+])
+def test_concat_left_alone(code):
+    report = lint_code(code)
+    assert report.code == code
+    assert [(finding.rule, finding.fixed) for finding in report.findings] == [("concat_in_loop", False)]
+
+
+def test_chained_assignment_rewrite():
+    report = lint_code("df[df['a'] > 0]['b'] = 1\n", frames={"df"})
+    assert report.code == "df.loc[df['a'] > 0, 'b'] = 1\n"
+    assert [(finding.rule, finding.fixed) for finding in report.findings] == [("chained_assignment", True)]
+
+
+@pytest.mark.parametrize("code", [
+    # A numpy array, which has no `.loc`
+    "arr[arr > 2][0] = 1\n",
+    # A dataframe the code binds to something else first
+    "df = df.to_numpy()\ndf[df > 2][0] = 1\n",
+    "df.loc[df['a'] > 0, 'b']['c'] = 1\n",
+    "df.iloc[0:5]['b'] = 1\n",
+])
+def test_chained_assignment_left_alone(code):
+    report = lint_code(code, frames={"df"})
+    assert report.code == code
+    assert [(finding.rule, finding.fixed) for finding in report.findings] == [("chained_assignment", False)]
+
+
+def test_lint_feedback():
+    code = "df['c'] = df.apply(lambda row: row['a'], axis=1)\ndf[df['a'] > 0]['b'] = 1\n"
+    report = lint_code(code, fix=False)
+    feedback = lint_feedback("add column c", code, report)
+    assert "Line 1: Calls `apply` with `axis=1`" in feedback
+    # Only the findings worth another LLM call are sent back
+    assert "chained" not in feedback
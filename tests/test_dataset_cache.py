@@ -0,0 +1,82 @@
+import os
+
+import pandas as pd
+import pytest
+
+from toolsets.dataset_cache import DatasetCache
+
+HEADERS = {"ETag": '"abc"', "Last-Modified": "Mon, 05 Oct 2026 10:00:00 GMT", "Content-Length": "100"}
+
+
+def frame(rows=1000):
+    return pd.DataFrame({"id": range(rows), "name": [f"row {idx}" for idx in range(rows)]})
+
+
+def test_key_changes_with_validators():
+    cache = DatasetCache()
+    key = cache.key(1, "data.csv", HEADERS)
+    assert key == cache.key(1, "data.csv", dict(HEADERS))
+    assert key != cache.key(1, "data.csv", dict(HEADERS, ETag='"def"'))
+    assert key != cache.key(1, "data.csv", dict(HEADERS, **{"Last-Modified": "Tue, 06 Oct 2026 10:00:00 GMT"}))
+    assert key != cache.key(2, "data.csv", HEADERS)
+    assert key != cache.key(1, "other.csv", HEADERS)
+    assert key != cache.key(1, "data.csv", HEADERS, variant="optimized-v2")
+
+
+def test_no_key_without_etag_or_last_modified():
+    cache = DatasetCache()
+    assert cache.key(1, "data.csv", {"Content-Length": "100"}) is None
+    assert cache.key(1, "data.csv", {"ETag": '"abc"'}) is not None
+    assert cache.key(1, "data.csv", {"Last-Modified": HEADERS["Last-Modified"]}) is not None
+
+
+def test_put_and_get(tmp_path):
+    pytest.importorskip("pyarrow")
+    cache = DatasetCache(str(tmp_path))
+    key = cache.key(1, "data.csv", HEADERS)
+    assert cache.get(key) is None
+    cache.put(key, frame())
+    pd.testing.assert_frame_equal(cache.get(key), frame())
+    assert cache.stats() == {"hits": 1, "misses": 1}
+
+
+def test_changed_file_is_not_served(tmp_path):
+    pytest.importorskip("pyarrow")
+    cache = DatasetCache(str(tmp_path))
+    cache.put(cache.key(1, "data.csv", HEADERS), frame())
+    assert cache.get(cache.key(1, "data.csv", dict(HEADERS, ETag='"def"'))) is None
+
+
+def test_disabled(tmp_path):
+    cache = DatasetCache(str(tmp_path / "cache"), max_bytes=0)
+    key = cache.key(1, "data.csv", HEADERS)
+    cache.put(key, frame())
+    assert cache.get(key) is None
+    assert not os.path.exists(tmp_path / "cache")
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    pytest.importorskip("pyarrow")
+    cache = DatasetCache(str(tmp_path))
+    keys = [cache.key(dataset_id, "data.csv", HEADERS) for dataset_id in range(3)]
+    for idx, key in enumerate(keys[:2]):
+        cache.put(key, frame())
+        os.utime(cache.entry_path(key), (idx, idx))
+    # Reading the oldest entry makes it the most recently used
+    assert cache.get(keys[0]) is not None
+    entry_bytes = os.path.getsize(cache.entry_path(keys[0]))
+    cache.max_bytes = 2 * entry_bytes
+    cache.put(keys[2], frame())
+    assert os.path.exists(cache.entry_path(keys[0]))
+    assert not os.path.exists(cache.entry_path(keys[1]))
+    assert os.path.exists(cache.entry_path(keys[2]))
+
+
+def test_unreadable_entry_is_discarded(tmp_path):
+    pytest.importorskip("pyarrow")
+    cache = DatasetCache(str(tmp_path))
+    key = cache.key(1, "data.csv", HEADERS)
+    with open(cache.entry_path(key), "wb") as file:
+        file.write(b"not a feather file")
+    assert cache.get(key) is None
+    assert not os.path.exists(cache.entry_path(key))
@@ -0,0 +1,159 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from toolsets.dry_run import (
+    SCALE_STEP, DryRun, run_isolated, sample_frames, scaling_exponent, stratified_positions,
+)
+
+
+def frame(rows=1000):
+    return pd.DataFrame({
+        "value": np.arange(rows),
+        # One rare group, which a plain random sample would likely miss
+        "group": pd.Series(["rare" if idx == 7 else "a" if idx % 2 else "b" for idx in range(rows)], dtype=object),
+    })
+
+
+def test_random_positions():
+    positions = stratified_positions(frame(), 0.1)
+    assert len(positions) == 100
+    assert (np.diff(positions) > 0).all()
+    assert (positions == stratified_positions(frame(), 0.1)).all()
+
+
+def test_stratified_positions_keep_every_group():
+    df = frame()
+    positions = stratified_positions(df, 0.1, "group")
+    counts = df["group"].iloc[positions].value_counts()
+    assert counts["rare"] == 1
+    assert abs(counts["a"] - 50) <= 1 and abs(counts["b"] - 50) <= 1
+    assert (np.diff(positions) > 0).all()
+
+
+def test_sample_frames():
+    df = frame()
+    samples = sample_frames({"df": df, "same": df, "other": frame(10)}, 0.5, {"group"})
+    assert samples["df"] is samples["same"]
+    # The rare group is kept on top of half of each of the others
+    assert len(samples["df"]) == 501
+    assert "rare" in set(samples["df"]["group"])
+    assert len(samples["other"]) == 5
+
+
+def test_full_samples_are_copies():
+    df = frame(10)
+    sample = sample_frames({"df": df}, 1.0, set())["df"]
+    sample.loc[0, "value"] = -1
+    assert df.loc[0, "value"] == 0
+
+
+@pytest.mark.parametrize("small, large, expected", [
+    (1.0, SCALE_STEP * 1.0, 1.0),
+    (1.0, SCALE_STEP ** 2 * 1.0, 2.0),
+    (1.0, SCALE_STEP ** 3 * 1.0, 2.0),
+    (1.0, 0.5, 1.0),
+    # Below the floor, runs are mostly fixed overhead
+    (0.001, 0.002 * SCALE_STEP, 1.0),
+    (0.0, 1.0, 1.0),
+])
+def test_scaling_exponent(small, large, expected):
+    assert scaling_exponent(small, large, floor=0.01) == pytest.approx(expected)
+
+
+def test_run_isolated():
+    seconds, peak_bytes, error = run_isolated(
+        "total = df['value'].sum()\nroot = math.sqrt(total)\ncopy = df.copy()", {"df": frame()}, {"math": "math"},
+        timeout=30,
+    )
+    assert error is None
+    assert seconds >= 0
+    assert peak_bytes > 0
+
+
+def test_errors_are_reported():
+    _, _, error = run_isolated("df['missing']", {"df": frame(10)}, {}, timeout=30)
+    assert error.startswith("KeyError")
+
+
+def test_timeout():
+    seconds, _, error = run_isolated("while True:\n    pass", {}, {}, timeout=0.5)
+    assert error == "Timed out after 0.5s on the sample"
+    assert seconds == 0.5
+
+
+def test_memory_limit():
+    _, _, error = run_isolated("data = bytearray(2 * 1024 ** 3)", {}, {}, timeout=30, memory_limit=64 * 1024 ** 2)
+    assert error.startswith("MemoryError")
+
+
+@pytest.mark.parametrize("code", [
+    "open({path!r}, 'w').write('data')",
+    "import os\nos.close(os.open({path!r}, os.O_WRONLY | os.O_CREAT))",
+    "df.to_csv({path!r})",
+])
+def test_file_writes_are_refused(tmp_path, code):
+    path = str(tmp_path / "written.csv")
+    _, _, error = run_isolated(code.format(path=path), {"df": frame(10)}, {}, timeout=30)
+    assert error is not None
+    assert not (tmp_path / "written.csv").exists()
+
+
+def test_removing_files_is_refused(tmp_path):
+    path = tmp_path / "kept.txt"
+    path.write_text("data")
+    _, _, error = run_isolated(f"import os\nos.remove({str(path)!r})", {}, {}, timeout=30)
+    assert error.startswith("PermissionError")
+    assert path.exists()
+
+
+def test_estimate():
+    estimate = DryRun(sample_rows=400).estimate("df.groupby('group').size()", {"df": frame(), "n": 3})
+    assert estimate["error"] is None
+    assert estimate["sample_rows"] == 400
+    assert estimate["rows"] == 1000
+    assert not estimate["exceeds_limits"]
+
+
+def test_nothing_to_sample():
+    assert DryRun().estimate("n + 1", {"n": 3}) is None
+
+
+class FailingAgent:
+    """Writes code once, and fails to when asked to revise it."""
+
+    model = "stub"
+
+    def oneshot(self, prompt, query):
+        if "too expensive" in query:
+            raise ValueError("No code block in the response")
+        return "```\ndf.apply(lambda row: row['value'], axis=1)\n```"
+
+
+class StubLoop:
+    STOP_SUCCESS = "success"
+
+    def set_state(self, state):
+        self.state = state
+
+
+def test_failed_revisions_keep_the_code():
+    pytest.importorskip("archytas")
+    from toolsets.dataset_toolset import DatasetToolset
+
+    toolset = DatasetToolset()
+    toolset.use_code_cache = False
+    toolset.kernel = None
+    toolset.dataset_id = 1
+    toolset.dataset = {"name": "Values", "description": "Values in groups"}
+    toolset.df = frame(10)
+    toolset.dry_run_mode = "revise"
+    toolset.estimate_code = lambda code: {
+        "exceeds_limits": True, "reasons": ["it is projected to run for 100s"], "sample_rows": 10, "rows": 10,
+        "time_scaling": 1.0, "memory_scaling": 1.0,
+    }
+    result = json.loads(toolset.generate_python_code("get the values", FailingAgent(), StubLoop()))
+    assert result["content"] == "df.apply(lambda row: row['value'], axis=1)"
+    assert result["estimate"]["revisions"] == 0
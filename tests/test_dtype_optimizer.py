@@ -0,0 +1,99 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from toolsets.dtype_optimizer import (
+    DtypeSchemaCache, downcast_floats, downcast_integers, optimize_dtypes, parser_dtypes,
+)
+
+
+def test_int64_that_fits_becomes_int32():
+    series = pd.Series([-5, 0, 2 ** 31 - 1], dtype=np.int64)
+    downcast = downcast_integers(series)
+    assert downcast.dtype == np.int32
+    assert (downcast == series).all()
+
+
+def test_int64_out_of_range_is_kept():
+    series = pd.Series([0, 2 ** 31], dtype=np.int64)
+    assert downcast_integers(series).dtype == np.int64
+
+
+@pytest.mark.parametrize("values", [[0, 1, 2], [0, 100, 200]])
+def test_never_narrower_than_int32_or_unsigned(values):
+    # Small non-negative values would fit in uint8, but `a - b` would wrap around
+    downcast = downcast_integers(pd.Series(values, dtype=np.int64))
+    assert downcast.dtype == np.int32
+    assert (downcast - downcast.iloc[::-1].reset_index(drop=True)).min() < 0
+
+
+def test_subtraction_and_sum_are_unchanged():
+    series = pd.Series([0, 2 ** 30, 2 ** 30], dtype=np.int64)
+    downcast = downcast_integers(series)
+    assert int(downcast.sum()) == int(series.sum())
+    assert list(downcast.diff().dropna()) == list(series.diff().dropna())
+
+
+@pytest.mark.parametrize("dtype", [np.int8, np.int16, np.int32, np.uint8, np.uint64])
+def test_narrow_and_unsigned_integers_are_kept(dtype):
+    series = pd.Series([1, 2, 3], dtype=dtype)
+    assert downcast_integers(series).dtype == dtype
+
+
+def test_nullable_integers_stay_nullable():
+    downcast = downcast_integers(pd.Series([1, None, 3], dtype="Int64"))
+    assert str(downcast.dtype) == "Int32"
+    assert downcast.isna().tolist() == [False, True, False]
+
+
+def test_floats_are_only_narrowed_without_loss():
+    exact = pd.Series([0.5, 1.25, np.nan, -2.0])
+    assert downcast_floats(exact).dtype == np.float32
+    inexact = pd.Series([0.1, 1.0])
+    assert downcast_floats(inexact).dtype == np.float64
+    huge = pd.Series([1e300])
+    assert downcast_floats(huge).dtype == np.float64
+
+
+def test_optimize_dtypes():
+    df = pd.DataFrame({
+        "id": np.arange(100, dtype=np.int64),
+        "flag": [True, False] * 50,
+        # Strings as read by the CSV parser, whatever pandas infers for them by default
+        "kind": pd.Series(["a", "b"] * 50, dtype=object),
+        "name": pd.Series([f"name {idx}" for idx in range(100)], dtype=object),
+        "date": pd.Series(["2026-10-0%d" % (idx % 9 + 1) for idx in range(100)], dtype=object),
+        "value": np.full(100, 0.5),
+    })
+    optimized, schema = optimize_dtypes(df)
+    assert optimized["id"].dtype == np.int32
+    assert optimized["flag"].dtype == bool
+    assert str(optimized["kind"].dtype) == "category"
+    assert schema["name"].startswith("string")
+    assert str(optimized["date"].dtype).startswith("datetime64")
+    assert optimized["value"].dtype == np.float32
+    for column in ("id", "kind", "name", "value"):
+        assert (optimized[column].astype(object) == df[column].astype(object)).all()
+    assert list(optimized.columns) == list(df.columns)
+
+
+def test_mixed_columns_are_kept():
+    df = pd.DataFrame({"mixed": ["a", 1, None] * 10})
+    optimized, _ = optimize_dtypes(df)
+    assert optimized["mixed"].dtype == object
+
+
+def test_schema_is_reapplied():
+    df = pd.DataFrame({"kind": pd.Series(["a", "b", "c"] * 10, dtype=object), "id": np.arange(30, dtype=np.int64)})
+    _, schema = optimize_dtypes(df)
+    _, again = optimize_dtypes(df, schema)
+    assert again == schema
+    assert parser_dtypes(schema) == {"kind": "category"}
+
+
+def test_schema_cache(tmp_path):
+    cache = DtypeSchemaCache(str(tmp_path))
+    assert cache.get(1, "data.csv") is None
+    cache.put(1, "data.csv", {"kind": "category"})
+    assert cache.get(1, "data.csv") == {"kind": "category"}
+    assert cache.get(1, "other.csv") is None
@@ -0,0 +1,119 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+pa = pytest.importorskip("pyarrow")
+
+from llmkernel import paging
+from llmkernel.paging import PageRequest, PreviewPager
+
+
+def frame(rows=20):
+    return pd.DataFrame({
+        "id": np.arange(rows),
+        "score": [float(idx % 7) if idx % 5 else None for idx in range(rows)],
+        "name": pd.Series([f"Name {idx % 3}" for idx in range(rows)], dtype=object),
+    })
+
+
+def read(stream) -> pd.DataFrame:
+    return pa.ipc.open_stream(stream).read_all().to_pandas().reset_index(drop=True)
+
+
+def page(df, generation=None, pager=None, **content):
+    description, stream = (pager or PreviewPager()).page(df, PageRequest(content), generation)
+    return description, read(stream)
+
+
+def test_window():
+    description, rows = page(frame(), offset=5, limit=3, columns=["id"])
+    assert description["rows"] == 3
+    assert description["total_rows"] == 20
+    assert rows["id"].tolist() == [5, 6, 7]
+
+
+def test_column_window():
+    description, rows = page(frame(), column_offset=1, column_limit=1)
+    assert description["columns"] == ["score"]
+    assert description["column_positions"] == [1]
+    assert description["total_columns"] == 3
+    assert list(rows.columns) == ["score"]
+
+
+@pytest.mark.parametrize("condition, expected", [
+    ({"op": "==", "column": "id", "value": 3}, [3]),
+    ({"op": ">=", "column": "id", "value": 17}, [17, 18, 19]),
+    ({"op": "in", "column": "id", "value": [1, 4]}, [1, 4]),
+    ({"op": "isnull", "column": "score"}, [0, 5, 10, 15]),
+    ({"op": "contains", "column": "name", "value": "name 2"}, [2, 5, 8, 11, 14, 17]),
+])
+def test_filters(condition, expected):
+    description, rows = page(frame(), filters=[condition])
+    assert description["total_rows"] == len(expected)
+    assert rows["id"].tolist() == expected
+
+
+def test_unsupported_filter():
+    with pytest.raises(ValueError):
+        PageRequest({"filters": [{"op": "like", "column": "name", "value": "a"}]})
+
+
+def test_sort():
+    _, rows = page(frame(10), sort=[{"column": "score", "ascending": False}, {"column": "id"}])
+    assert rows["id"].tolist() == [6, 4, 3, 2, 9, 1, 8, 7, 0, 5]
+
+
+def test_view_is_reused_while_scrolling(monkeypatch):
+    calls = []
+    view_positions = paging.view_positions
+    monkeypatch.setattr(paging, "view_positions", lambda df, request: calls.append(1) or view_positions(df, request))
+    pager = PreviewPager()
+    df = frame()
+    sort = [{"column": "id", "ascending": False}]
+    _, first = page(df, generation=1, pager=pager, sort=sort, limit=5)
+    _, second = page(df, generation=1, pager=pager, sort=sort, offset=5, limit=5)
+    assert len(calls) == 1
+    assert first["id"].tolist() + second["id"].tolist() == list(range(19, 9, -1))
+
+    # A cell has run since, which may have changed df in place
+    page(df, generation=2, pager=pager, sort=sort, limit=5)
+    assert len(calls) == 2
+    page(df, generation=2, pager=pager, sort=[{"column": "id"}], limit=5)
+    assert len(calls) == 3
+
+
+@pytest.fixture
+def relation():
+    duckdb = pytest.importorskip("duckdb")
+    df = frame()
+    return df, duckdb.connect().from_df(df)
+
+
+@pytest.mark.parametrize("content", [
+    {"offset": 3, "limit": 4},
+    {"columns": ["name", "id"]},
+    {"column_offset": 1, "column_limit": 5},
+    {"filters": [{"op": "<", "column": "score", "value": 3}], "sort": [{"column": "score"}, {"column": "id"}]},
+    {"filters": [{"op": "notnull", "column": "score"}, {"op": "!=", "column": "name", "value": "Name 0"}]},
+    {"filters": [{"op": "contains", "column": "name", "value": "NAME 1"}], "offset": 2, "limit": 2},
+    {"sort": [{"column": "score", "ascending": False}, {"column": "id"}], "limit": 8},
+    {"offset": 18, "limit": 5},
+    {"offset": 25},
+])
+def test_relation_pages_match_frame_pages(relation, content):
+    df, rel = relation
+    frame_description, frame_rows = page(df, **content)
+    relation_description, relation_rows = page(rel, **content)
+    assert relation_description == frame_description
+    pd.testing.assert_frame_equal(relation_rows, frame_rows, check_dtype=False)
+
+
+@pytest.mark.parametrize("content", [{"columns": []}, {"column_offset": 3}, {"column_limit": 0, "offset": 2, "limit": 5}])
+def test_pages_without_columns(relation, content):
+    df, rel = relation
+    frame_description, frame_rows = page(df, **content)
+    relation_description, relation_rows = page(rel, **content)
+    assert relation_description == frame_description
+    assert frame_description["columns"] == []
+    assert list(relation_rows.columns) == list(frame_rows.columns) == []
+    assert len(relation_rows) == len(frame_rows) == frame_description["rows"]
@@ -0,0 +1,59 @@
+import threading
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from toolsets.profile_sidecar import ProfileSidecar, profile_bytes
+
+
+def frame(rows=100):
+    return pd.DataFrame({"id": np.arange(rows), "score": np.linspace(0, 1, rows)})
+
+
+@pytest.fixture
+def toolset(monkeypatch):
+    pytest.importorskip("archytas")
+    from toolsets import dataset_toolset
+    from toolsets.dataset_toolset import DatasetToolset, FetchedDataframe
+
+    monkeypatch.setattr(dataset_toolset.data_service, "get_dataset", lambda dataset_id: {"name": "Scores"})
+    toolset = DatasetToolset()
+    toolset.kernel = None
+    toolset.sidecar_seen = threading.Event()
+
+    def fetch_dataframe(filename=None, nrows=None, backend="pandas", **kwargs):
+        # The data file only finishes downloading once the context has been built from the sidecar
+        assert toolset.sidecar_seen.wait(10)
+        df = frame()
+        return FetchedDataframe(df.head(nrows) if nrows else df, nrows is None)
+
+    toolset.fetch_dataframe = fetch_dataframe
+    toolset.fetch_profile_sidecar = lambda dataset_id, dataset: ProfileSidecar.from_bytes(profile_bytes(frame()))
+    return toolset
+
+
+def test_context_is_built_from_the_sidecar_before_the_data_loads(toolset):
+    contexts = []
+
+    def on_sidecar(sidecar):
+        contexts.append(toolset.sidecar_context(sidecar))
+        toolset.sidecar_seen.set()
+
+    toolset.set_dataset(1, on_sidecar=on_sidecar)
+    assert "Dataframe shape: 100 rows x 2 columns" in contexts[0]
+    assert toolset.profile_sidecar is not None
+    assert toolset.profile_sidecar.describes(toolset.df)
+
+
+def test_partial_frames_are_bound_to_the_sidecar(toolset):
+    toolset.set_dataset(1, nrows=10, on_sidecar=lambda sidecar: toolset.sidecar_seen.set())
+    assert len(toolset.df) == 10
+    assert toolset.profile_sidecar.describes(toolset.df)
+    assert "Only the first 10 rows are loaded so far" in toolset.dataset_summary()
+
+
+def test_sidecars_that_dont_fit_are_dropped(toolset):
+    toolset.fetch_profile_sidecar = lambda dataset_id, dataset: ProfileSidecar.from_bytes(profile_bytes(frame(50)))
+    toolset.set_dataset(1, on_sidecar=lambda sidecar: toolset.sidecar_seen.set())
+    assert toolset.profile_sidecar is None
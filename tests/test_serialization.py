@@ -0,0 +1,82 @@
+import gzip
+import io
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from llmkernel.serialization import FORMATS, iter_dataframe_bytes
+
+
+def frame(rows=1000):
+    return pd.DataFrame({
+        "id": np.arange(rows),
+        "value": np.linspace(0, 1, rows),
+        "name": [f"row {idx}" for idx in range(rows)],
+    })
+
+
+def serialize(df, data_format, **kwargs) -> bytes:
+    return b"".join(iter_dataframe_bytes(df, data_format, **kwargs))
+
+
+def read(data: bytes, data_format) -> pd.DataFrame:
+    if data_format == "csv":
+        return pd.read_csv(io.BytesIO(data))
+    if data_format == "csv.gz":
+        return pd.read_csv(io.BytesIO(gzip.decompress(data)))
+    import pyarrow as pa
+    if data_format == "parquet":
+        import pyarrow.parquet as pq
+        return pq.read_table(io.BytesIO(data)).to_pandas()
+    return pa.ipc.open_stream(data).read_all().to_pandas()
+
+
+def needs(data_format):
+    if data_format in ("parquet", "arrow"):
+        pytest.importorskip("pyarrow")
+
+
+@pytest.mark.parametrize("data_format", list(FORMATS))
+def test_round_trip(data_format):
+    needs(data_format)
+    df = frame()
+    # Small batches, so the frame is written in several of them
+    data = serialize(df, data_format, batch_rows=128)
+    pd.testing.assert_frame_equal(read(data, data_format), df)
+
+
+@pytest.mark.parametrize("data_format", list(FORMATS))
+def test_chunks_are_bounded(data_format):
+    needs(data_format)
+    chunks = list(iter_dataframe_bytes(frame(), data_format, chunk_size=1024, batch_rows=128))
+    assert len(chunks) > 1
+    assert all(len(chunk) == 1024 for chunk in chunks[:-1])
+    assert 0 < len(chunks[-1]) <= 1024
+
+
+@pytest.mark.parametrize("data_format", ["csv", "csv.gz"])
+def test_csv_header_is_written_once(data_format):
+    text = read(serialize(frame(), data_format, batch_rows=100), data_format)
+    assert len(text) == 1000
+
+
+@pytest.mark.parametrize("data_format", ["csv", "csv.gz"])
+def test_empty_frame_keeps_its_header(data_format):
+    data = serialize(frame(0), data_format)
+    assert list(read(data, data_format).columns) == ["id", "value", "name"]
+
+
+@pytest.mark.parametrize("data_format", list(FORMATS))
+def test_relation_matches_dataframe(data_format):
+    duckdb = pytest.importorskip("duckdb")
+    pytest.importorskip("pyarrow")
+    df = frame()
+    relation = duckdb.connect().from_df(df)
+    data = serialize(relation, data_format, batch_rows=128)
+    pd.testing.assert_frame_equal(read(data, data_format), read(serialize(df, data_format), data_format))
+
+
+def test_unknown_format():
+    with pytest.raises(ValueError):
+        serialize(frame(), "xlsx")
@@ -0,0 +1,131 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from llmkernel.snapshots import SnapshotHistory, may_change
+
+
+def frame(rows=100):
+    return pd.DataFrame({"a": np.arange(rows), "b": np.linspace(0, 1, rows)})
+
+
+def test_unchanged_frame_is_not_recorded_again():
+    history = SnapshotHistory()
+    df = frame()
+    assert history.take(df, label="first") is not None
+    assert history.take(df, label="second") is None
+    assert len(history.snapshots) == 1
+
+
+def test_unchanged_columns_are_shared():
+    history = SnapshotHistory()
+    df = frame()
+    first = history.take(df)
+    df["b"] = df["b"] * 2
+    second = history.take(df)
+    assert second is not None
+    assert second.columns[0][1] is first.columns[0][1]
+    assert second.columns[1][1] is not first.columns[1][1]
+
+
+def test_in_place_changes_are_recorded():
+    history = SnapshotHistory()
+    df = frame()
+    history.take(df)
+    df.loc[3, "a"] = -1
+    snapshot = history.take(df)
+    assert snapshot is not None
+    assert snapshot.restore().loc[3, "a"] == -1
+
+
+def test_snapshots_are_not_changed_by_later_cells():
+    history = SnapshotHistory()
+    df = frame()
+    snapshot = history.take(df)
+    df.loc[0, "a"] = 100
+    assert snapshot.restore().loc[0, "a"] == 0
+
+
+def test_undo_restores_the_latest_different_version():
+    history = SnapshotHistory()
+    df = frame()
+    history.take(df, label="df['c'] = 1")
+    df["c"] = 1
+    snapshot = history.undo(df)
+    assert snapshot is not None
+    restored = snapshot.restore()
+    pd.testing.assert_frame_equal(restored, frame())
+    assert history.snapshots == []
+
+
+def test_undo_to_a_given_snapshot():
+    history = SnapshotHistory()
+    df = frame()
+    first = history.take(df, label="first")
+    df = df[df["a"] > 10]
+    history.take(df, label="second")
+    df = df[df["a"] > 20]
+    snapshot = history.undo(df, snapshot_id=first.id)
+    assert snapshot is first
+    assert len(snapshot.restore()) == 100
+    assert history.undo(df, snapshot_id=first.id) is None
+
+
+def test_undo_without_snapshots():
+    assert SnapshotHistory().undo(frame()) is None
+
+
+def test_list():
+    history = SnapshotHistory()
+    df = frame()
+    history.take(df, label="df['c'] = 1\nprint(df)")
+    df["c"] = 1
+    history.take(df, label="df = df.head(5)")
+    described = history.describe()
+    assert [snapshot["label"] for snapshot in described["snapshots"]] == ["df['c'] = 1", "df = df.head(5)"]
+    assert [(snapshot["rows"], snapshot["columns"]) for snapshot in described["snapshots"]] == [(100, 2), (100, 3)]
+    assert described["total_bytes"] == history.total_bytes() > 0
+
+
+def test_oldest_snapshots_are_evicted():
+    history = SnapshotHistory(max_count=2)
+    df = frame()
+    for value in range(4):
+        df["a"] = value
+        history.take(df, label=str(value))
+    assert [snapshot.label for snapshot in history.snapshots] == ["2", "3"]
+
+
+def test_frames_larger_than_the_budget_are_skipped():
+    history = SnapshotHistory(max_bytes=100)
+    assert history.take(frame(1000)) is None
+    assert history.snapshots == []
+
+
+@pytest.mark.parametrize("code", [
+    "df['c'] = df['a'] * 2",
+    "df = df[df['a'] > 1]",
+    "df.loc[0, 'a'] = 5",
+    "df.drop(columns=['a'], inplace=True)",
+    "df['a'].fillna(0, inplace=True)",
+    "df.insert(0, 'c', 1)",
+    "del df['a']",
+    "df.a += 1",
+    "clean(df)",
+    "%time df.drop(columns=['a'], inplace=True)",
+])
+def test_may_change(code):
+    assert may_change(code)
+
+
+@pytest.mark.parametrize("code", [
+    "df.head()",
+    "print(df.describe())",
+    "len(df)",
+    "df.groupby('a').size()",
+    "df.drop(columns=['a'], inplace=False)",
+    "summary = df.describe()",
+    "df.plot()",
+])
+def test_may_not_change(code):
+    assert not may_change(code)
@@ -0,0 +1,170 @@
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from llmkernel import upload
+from llmkernel.upload import UploadError, put_bytes, put_resumable, put_stream
+
+
+class StubStorage(ThreadingHTTPServer):
+    """
+    Local stand-in for a storage service's presigned upload URLs.
+
+    Plain PUTs replace the object, as they do on S3, and are rejected without a Content-Length unless `chunked` is set.
+    With `resumable`, PUTs with a Content-Range are assembled into the object as resumable uploads to Google Cloud
+    Storage are, answering 308 until the final part. `failures` is a number of requests to fail with a 500 first.
+    """
+
+    def __init__(self, resumable=False, chunked=False, failures=0):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.resumable = resumable
+        self.chunked = chunked
+        self.failures = failures
+        self.object = b""
+        self.requests = []
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/bucket/dataset.csv"
+
+
+class StubHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def read_body(self) -> bytes:
+        if self.headers.get("Transfer-Encoding") == "chunked":
+            body = b""
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                chunk = self.rfile.read(size + 2)[:size]
+                if not size:
+                    return body
+                body += chunk
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def reply(self, status):
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_PUT(self):
+        server = self.server
+        body = self.read_body()
+        server.requests.append((dict(self.headers), body))
+        if server.failures:
+            server.failures -= 1
+            return self.reply(500)
+        content_range = self.headers.get("Content-Range")
+        if server.resumable and content_range:
+            start, total = re.match(r"bytes (\d+)-\d+/(\d+|\*)", content_range).groups()
+            assert int(start) == len(server.object)
+            server.object += body
+            return self.reply(200 if total != "*" else 308)
+        if "Content-Length" not in self.headers and not server.chunked:
+            return self.reply(501)
+        server.object = body
+        self.reply(200)
+
+
+@pytest.fixture
+def storage(request):
+    servers = []
+
+    def start(**kwargs):
+        server = StubStorage(**kwargs)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def no_sleep(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(upload.time, "sleep", sleeps.append)
+    return sleeps
+
+
+CHUNKS = [b"a,b\n", b"1,2\n" * 1000, b"3,4\n"]
+
+
+def test_put_stream_sends_content_length(storage):
+    server = storage()
+    progress = []
+    put_stream(server.url, iter(CHUNKS), on_progress=progress.append)
+    headers, body = server.requests[0]
+    assert body == b"".join(CHUNKS)
+    assert headers["Content-Length"] == str(len(body))
+    assert "Transfer-Encoding" not in headers
+    assert progress[-1] == len(body)
+
+
+def test_put_stream_spools_to_disk(storage, monkeypatch):
+    monkeypatch.setattr(upload, "SPOOL_MEMORY_BYTES", 16)
+    server = storage()
+    put_stream(server.url, iter(CHUNKS))
+    assert server.object == b"".join(CHUNKS)
+
+
+def test_put_stream_chunked(storage):
+    server = storage(chunked=True)
+    put_stream(server.url, iter(CHUNKS), chunked=True)
+    headers, body = server.requests[0]
+    assert headers["Transfer-Encoding"] == "chunked"
+    assert body == b"".join(CHUNKS)
+
+
+def test_put_stream_error(storage):
+    server = storage(failures=1)
+    with pytest.raises(UploadError):
+        put_stream(server.url, iter(CHUNKS))
+
+
+def test_put_bytes(storage):
+    server = storage()
+    put_bytes(server.url, b'{"version":1}')
+    assert server.requests[0][0]["Content-Length"] == "13"
+    assert server.object == b'{"version":1}'
+
+
+def test_put_resumable(storage):
+    server = storage(resumable=True)
+    progress = []
+    put_resumable(server.url, iter(CHUNKS), part_size=1024, on_progress=progress.append)
+    data = b"".join(CHUNKS)
+    assert server.object == data
+    ranges = [headers["Content-Range"] for headers, _ in server.requests]
+    assert ranges[0] == "bytes 0-1023/*"
+    assert ranges[-1] == f"bytes {1024 * (len(ranges) - 1)}-{len(data) - 1}/{len(data)}"
+    assert progress[-1] == len(data)
+
+
+def test_put_resumable_retries_parts(storage, no_sleep):
+    server = storage(resumable=True, failures=2)
+    put_resumable(server.url, iter(CHUNKS), part_size=1024)
+    assert server.object == b"".join(CHUNKS)
+    assert no_sleep == [1, 2]
+
+
+def test_put_resumable_gives_up_without_sleeping_after_last_attempt(storage, no_sleep):
+    server = storage(resumable=True, failures=3)
+    with pytest.raises(UploadError):
+        put_resumable(server.url, iter(CHUNKS), part_size=1024, retries=3)
+    assert len(server.requests) == 3
+    assert no_sleep == [1, 2]
+
+
+def test_put_resumable_rejects_plain_urls(storage):
+    # Every part would replace the object, leaving only the last one
+    server = storage()
+    with pytest.raises(UploadError):
+        put_resumable(server.url, iter(CHUNKS), part_size=1024)
+    assert len(server.requests) == 1
@@ -0,0 +1,188 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Optional
+
+import pandas as pd
+
+from .lazy_dataset import is_relation
+
+logger = logging.getLogger(__name__)
+
+CODE_CACHE_DIR = os.environ.get(
+    "CODE_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "jupyter-llm", "code")
+)
+# How long generated code is reused for, in seconds. 0 disables the cache.
+CODE_CACHE_TTL = float(os.environ.get("CODE_CACHE_TTL", 7 * 24 * 3600))
+# Number of entries kept in memory, and total size of the entries kept on disk. A max size of 0 keeps the cache in
+# memory only.
+CODE_CACHE_MAX_ENTRIES = int(os.environ.get("CODE_CACHE_MAX_ENTRIES", 256))
+CODE_CACHE_MAX_BYTES = int(os.environ.get("CODE_CACHE_MAX_BYTES", 50 * 1024 ** 2))
+
+EXTENSION = ".json"
+
+
+def normalize_query(query: str) -> str:
+    """Lowercase `query` and collapse whitespace and trailing punctuation, so trivially different phrasings match."""
+    query = re.sub(r"\s+", " ", query.strip().lower())
+    return query.rstrip(" .!?;")
+
+
+def schema_fingerprint(df: pd.DataFrame) -> str:
+    """Fingerprint of the column names and dtypes of `df`. Code generated for one frame is valid for any other frame with
+    the same fingerprint."""
+    if is_relation(df):
+        # Lazy relations have database types rather than dtypes, so never match a dataframe
+        schema = [["duckdb"]] + [[str(column), str(dtype)] for column, dtype in zip(df.columns, df.types)]
+    else:
+        schema = [[str(column), str(dtype)] for column, dtype in df.dtypes.items()]
+    return hashlib.sha256(json.dumps(schema).encode()).hexdigest()
+
+
+def generated_code(result: str) -> Optional[str]:
+    """The code of `result`, the answer to a request, if it is a generated code cell."""
+    try:
+        data = json.loads(result)
+    except (json.JSONDecodeError, TypeError):
+        return None
+    if not isinstance(data, dict) or data.get("action") != "code_cell":
+        return None
+    return data.get("content")
+
+
+class CodeCache:
+    """
+    Cache of code generated for a query against a dataset schema.
+
+    Entries are keyed by the normalized query, the schema fingerprint of the dataframe, the model that generated
+    the code and the lint mode it was checked with. Requests that may follow up on the one before, such as "same but
+    as a bar chart", are also keyed by the code generated for that one (`previous_code`). The most recently used
+    entries are kept in memory and every entry is also written to disk as a small JSON file, so the cache survives
+    kernel restarts. Entries older than `ttl` seconds are ignored and removed, and the least recently used files are
+    evicted once the cache grows beyond `max_bytes`.
+    """
+
+    def __init__(self, path: str = CODE_CACHE_DIR, ttl: float = CODE_CACHE_TTL,
+                 max_entries: int = CODE_CACHE_MAX_ENTRIES, max_bytes: int = CODE_CACHE_MAX_BYTES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+
+    def key(self, query: str, fingerprint: str, model: str = "", lint_mode: str = "", previous_code: str = "") -> str:
+        raw = "\n".join([normalize_query(query), fingerprint, model, lint_mode, previous_code])
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def entry_path(self, key: str) -> str:
+        return os.path.join(self.path, key + EXTENSION)
+
+    def expired(self, entry: dict) -> bool:
+        return time.time() - entry["created"] > self.ttl
+
+    def get(self, key: str) -> Optional[str]:
+        if not self.enabled:
+            return None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            else:
+                entry = self.read(key)
+                if entry is not None:
+                    self.remember(key, entry)
+            if entry is None or self.expired(entry):
+                if entry is not None:
+                    self.entries.pop(key, None)
+                    self.remove(self.entry_path(key))
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry["code"]
+
+    def put(self, key: str, code: str, query: str = ""):
+        if not self.enabled:
+            return
+        entry = {"created": time.time(), "query": query, "code": code}
+        with self.lock:
+            self.remember(key, entry)
+            self.write(key, entry)
+
+    def remember(self, key: str, entry: dict):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def read(self, key: str) -> Optional[dict]:
+        if self.max_bytes <= 0:
+            return None
+        path = self.entry_path(key)
+        try:
+            with open(path) as file:
+                entry = json.load(file)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            logger.exception(f"Unable to read cached code {path}, discarding it")
+            self.remove(path)
+            return None
+        os.utime(path)
+        return entry
+
+    def write(self, key: str, entry: dict):
+        if self.max_bytes <= 0:
+            return
+        path = self.entry_path(key)
+        # Written under a temporary name and renamed, so a concurrent reader never sees a partial file
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            with open(temp_path, "w") as file:
+                json.dump(entry, file)
+            os.replace(temp_path, path)
+        except OSError:
+            logger.exception("Unable to cache generated code")
+            self.remove(temp_path)
+            return
+        self.evict()
+
+    def remove(self, path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith(EXTENSION):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.path, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self.remove(os.path.join(self.path, name))
+            total -= size
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries)}
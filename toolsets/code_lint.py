@@ -0,0 +1,374 @@
+import ast
+import os
+from typing import Optional
+
+# What is done about slow pandas patterns in generated code: "off", "flag" to report them with the code cell, or "fix"
+# to also rewrite those that can be rewritten mechanically and ask the LLM to rewrite the code once if any of
+# REGENERATE_RULES are left. Can be overridden per request.
+CODE_LINT = os.environ.get("CODE_LINT", "flag")
+
+MODES = ("off", "flag", "fix")
+# Rules whose findings are slow whatever the variables involved turn out to be, which are worth another LLM call
+REGENERATE_RULES = ("row_loop", "index_loop", "row_apply", "concat_in_loop")
+CONCAT_FUNCTIONS = ("concat",)
+ROW_ITERATORS = ("iterrows", "itertuples")
+POSITIONAL_INDEXERS = ("iloc", "loc", "iat", "at")
+
+SUGGESTIONS = {
+    "row_loop": "Use vectorized column operations (e.g. `df['a'] * df['b']`, `np.where(...)`, `.str` and `.dt` "
+                "methods) or groupby aggregations instead of looping over rows.",
+    "index_loop": "Use vectorized column operations instead of looking rows up one at a time by position.",
+    "row_apply": "Use vectorized column operations, `np.where`/`np.select` or `.map` on a single column instead of "
+                 "`apply(axis=1)`, which calls Python once per row.",
+    "concat_in_loop": "Collect the pieces in a list inside the loop and call `pd.concat` once after it; concatenating "
+                      "inside the loop copies all the rows gathered so far on every iteration.",
+    "chained_assignment": "Assign with a single `.loc[rows, columns]` indexer; chained indexing assigns to a temporary "
+                          "copy and may leave the dataframe unchanged.",
+    "copy_in_loop": "Copy the dataframe once before the loop rather than on every iteration.",
+}
+MESSAGES = {
+    "row_loop": "Loops over the rows of a dataframe with `{name}()`.",
+    "index_loop": "Loops over row positions and indexes the dataframe with `.{name}` on every iteration.",
+    "row_apply": "Calls `apply` with `axis=1`, running a Python function on every row.",
+    "concat_in_loop": "Calls `{name}` inside a loop.",
+    "chained_assignment": "Assigns through chained indexing.",
+    "copy_in_loop": "Copies data with `.copy()` inside a loop.",
+}
+
+
+def check_mode(mode: str) -> str:
+    if mode not in MODES:
+        raise ValueError(f"Unsupported lint mode '{mode}'. Supported modes are: {', '.join(MODES)}")
+    return mode
+
+
+def call_name(node) -> Optional[str]:
+    """The name of the function called by `node`, e.g. "concat" for both `pd.concat(...)` and `concat(...)`."""
+    if not isinstance(node, ast.Call):
+        return None
+    if isinstance(node.func, ast.Attribute):
+        return node.func.attr
+    if isinstance(node.func, ast.Name):
+        return node.func.id
+    return None
+
+
+def is_mask(node) -> bool:
+    """Whether `node` looks like a boolean row selection, e.g. `df['a'] > 0` or `m1 & ~m2`."""
+    if isinstance(node, ast.Compare):
+        return True
+    if isinstance(node, ast.BinOp) and isinstance(node.op, (ast.BitAnd, ast.BitOr, ast.BitXor)):
+        return True
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Invert):
+        return True
+    return call_name(node) in ("isin", "isna", "isnull", "notna", "notnull", "between", "contains", "startswith")
+
+
+def names_in(node) -> set:
+    return {child.id for child in ast.walk(node) if isinstance(child, ast.Name)}
+
+
+def loop_body_nodes(loop):
+    """Nodes inside a loop's body, not counting nested function and class definitions, which don't run per iteration."""
+    pending = list(loop.body)
+    while pending:
+        node = pending.pop()
+        yield node
+        if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda, ast.ClassDef)):
+            pending.extend(ast.iter_child_nodes(node))
+
+
+class Finding:
+    def __init__(self, rule: str, node, name: str = "", fixed: bool = False):
+        self.rule = rule
+        self.line = getattr(node, "lineno", None)
+        self.message = MESSAGES[rule].format(name=name)
+        self.fixed = fixed
+
+    def to_dict(self) -> dict:
+        return {
+            "rule": self.rule,
+            "line": self.line,
+            "message": self.message,
+            "suggestion": SUGGESTIONS[self.rule],
+            "fixed": self.fixed,
+        }
+
+
+class Source:
+    """Code being edited by byte offsets, as AST column offsets are in bytes, so edits leave the rest untouched."""
+
+    def __init__(self, code: str):
+        self.code = code
+        self.data = code.encode()
+        self.line_starts = [0]
+        for idx, byte in enumerate(self.data):
+            if byte == ord("\n"):
+                self.line_starts.append(idx + 1)
+        self.edits = []
+
+    def offset(self, line: int, col: int) -> int:
+        if line > len(self.line_starts):
+            return len(self.data)
+        return self.line_starts[line - 1] + col
+
+    def segment(self, node) -> str:
+        return ast.get_source_segment(self.code, node)
+
+    def indent(self, node) -> str:
+        start = self.offset(node.lineno, 0)
+        return self.data[start:start + node.col_offset].decode()
+
+    def line_end(self, line: int) -> int:
+        """Offset just past the end of `line`, including its newline."""
+        return self.line_starts[line] if line < len(self.line_starts) else len(self.data)
+
+    def replace(self, start: int, end: int, text: str) -> bool:
+        """Queue an edit, unless it overlaps one that is already queued."""
+        for other_start, other_end, _ in self.edits:
+            if start < other_end and other_start < end or start == end == other_start:
+                return False
+        self.edits.append((start, end, text))
+        return True
+
+    def edited(self) -> str:
+        data = self.data
+        for start, end, text in sorted(self.edits, reverse=True):
+            data = data[:start] + text.encode() + data[end:]
+        return data.decode()
+
+
+class Linter(ast.NodeVisitor):
+    """
+    Finds slow pandas patterns in a module, and queues rewrites of those that can be rewritten safely. `frames` are the
+    names known to be bound to dataframes; rewrites that only work on dataframes are limited to those, as long as the
+    code doesn't bind them to something else.
+    """
+
+    def __init__(self, source: Source, tree, fix: bool, frames=()):
+        self.source = source
+        self.tree = tree
+        self.fix = fix
+        self.frames = set(frames) - {
+            node.id for node in ast.walk(tree) if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Store)
+        }
+        self.findings = []
+        self.loops = []
+        # Ids of the concat calls that were rewritten
+        self.fixed_calls = set()
+
+    def add(self, rule: str, node, name: str = "", fixed: bool = False):
+        self.findings.append(Finding(rule, node, name, fixed))
+
+    def visit_For(self, node):
+        self.check_row_iterator(node.iter, node)
+        if call_name(node.iter) == "range" and node.iter.args and call_name(node.iter.args[-1]) == "len":
+            indexer = self.positional_indexing(node)
+            if indexer:
+                self.add("index_loop", node, indexer)
+        self.visit_loop(node)
+
+    def visit_While(self, node):
+        self.visit_loop(node)
+
+    def visit_loop(self, node):
+        self.loops.append(node)
+        for stmt in node.body:
+            if isinstance(stmt, ast.Assign) and call_name(stmt.value) in CONCAT_FUNCTIONS \
+                    and self.fix and self.rewrite_concat(node, stmt):
+                self.fixed_calls.add(id(stmt.value))
+        self.generic_visit(node)
+        self.loops.pop()
+
+    def visit_comprehension(self, node):
+        self.check_row_iterator(node.iter, node.iter)
+        self.generic_visit(node)
+
+    def visit_FunctionDef(self, node):
+        # The body of a function defined in a loop doesn't run per iteration
+        loops, self.loops = self.loops, []
+        self.generic_visit(node)
+        self.loops = loops
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+    visit_Lambda = visit_FunctionDef
+
+    def visit_Call(self, node):
+        name = call_name(node)
+        if name == "apply" and self.row_axis(node):
+            self.add("row_apply", node)
+        if self.loops:
+            if name in CONCAT_FUNCTIONS:
+                self.add("concat_in_loop", node, name, fixed=id(node) in self.fixed_calls)
+            elif name == "copy" and isinstance(node.func, ast.Attribute):
+                self.add("copy_in_loop", node)
+        self.generic_visit(node)
+
+    def visit_Assign(self, node):
+        for target in node.targets:
+            self.check_chained_assignment(target)
+        self.generic_visit(node)
+
+    def visit_AugAssign(self, node):
+        self.check_chained_assignment(node.target)
+        self.generic_visit(node)
+
+    def check_row_iterator(self, iterator, node):
+        name = call_name(iterator)
+        if name in ROW_ITERATORS and isinstance(iterator.func, ast.Attribute):
+            self.add("row_loop", node, name)
+
+    @staticmethod
+    def positional_indexing(loop) -> Optional[str]:
+        index = loop.target.id if isinstance(loop.target, ast.Name) else None
+        for node in loop_body_nodes(loop):
+            if isinstance(node, ast.Subscript) and isinstance(node.value, ast.Attribute) \
+                    and node.value.attr in POSITIONAL_INDEXERS and index in names_in(node.slice):
+                return node.value.attr
+        return None
+
+    @staticmethod
+    def row_axis(node) -> bool:
+        axis = next((keyword.value for keyword in node.keywords if keyword.arg == "axis"), None)
+        if axis is None and len(node.args) > 1:
+            axis = node.args[1]
+        return isinstance(axis, ast.Constant) and axis.value in (1, "columns")
+
+    def check_chained_assignment(self, target):
+        """
+        `df[mask]['a'] = 1` or `df.loc[mask]['a'] = 1`, but not nested dicts and lists such as `d['a']['b'] = 1`.
+
+        Only assignments to a dataframe in `frames` are rewritten into a single `.loc`, with a row selection and a
+        column that can be put side by side in it: `df.loc[m, 'b']['c'] = 1` can't, and neither can the same pattern
+        on a numpy array (`arr[arr > 2][0] = 1`), which has no `.loc`.
+        """
+        if not isinstance(target, ast.Subscript) or not isinstance(target.value, ast.Subscript):
+            return
+        inner = target.value
+        indexer = inner.value.attr if isinstance(inner.value, ast.Attribute) else None
+        if indexer not in ("loc", "iloc") and not is_mask(inner.slice):
+            return
+        frame = inner.value.value if indexer == "loc" else inner.value
+        fixed = False
+        if self.fix and indexer != "iloc" and isinstance(frame, ast.Name) and frame.id in self.frames \
+                and not isinstance(inner.slice, ast.Tuple) and not isinstance(target.slice, (ast.Slice, ast.Tuple)):
+            text = f"{self.source.segment(frame)}.loc[{self.source.segment(inner.slice)}, {self.source.segment(target.slice)}]"
+            start = self.source.offset(target.lineno, target.col_offset)
+            end = self.source.offset(target.end_lineno, target.end_col_offset)
+            fixed = self.source.replace(start, end, text)
+        self.add("chained_assignment", target, fixed=fixed)
+
+    def rewrite_concat(self, loop, stmt) -> bool:
+        """
+        Rewrite `acc = pd.concat([acc, piece], ...)` in a loop into appending `piece` to a list that is concatenated
+        once after the loop. Only done if `acc` isn't used anywhere else in the loop, so no iteration can tell the
+        difference.
+        """
+        call = stmt.value
+        if len(stmt.targets) != 1 or not isinstance(stmt.targets[0], ast.Name) or loop.orelse:
+            return False
+        acc = stmt.targets[0].id
+        if not call.args or not isinstance(call.args[0], ast.List) or len(call.args[0].elts) != 2:
+            return False
+        first, piece = call.args[0].elts
+        if not isinstance(first, ast.Name) or first.id != acc or acc in names_in(piece) or len(call.args) > 1:
+            return False
+        uses = sum(1 for node in loop_body_nodes(loop) if isinstance(node, ast.Name) and node.id == acc)
+        if uses != 2 or stmt.lineno == loop.lineno or acc in names_in(loop.iter if isinstance(loop, ast.For) else loop.test):
+            return False
+
+        pieces = f"{acc}_pieces"
+        taken = names_in(self.tree)
+        while pieces in taken:
+            pieces = "_" + pieces
+        source = self.source
+        indent = source.indent(loop)
+        keywords = "".join(f", {source.segment(keyword)}" for keyword in call.keywords)
+        after = f"{indent}{acc} = {source.segment(call.func)}({pieces}{keywords})"
+        edits = [
+            (source.offset(loop.lineno, 0), source.offset(loop.lineno, 0), f"{indent}{pieces} = [{acc}]\n"),
+            (
+                source.offset(stmt.lineno, stmt.col_offset),
+                source.offset(stmt.end_lineno, stmt.end_col_offset),
+                f"{pieces}.append({source.segment(piece)})",
+            ),
+            (
+                source.line_end(loop.end_lineno),
+                source.line_end(loop.end_lineno),
+                # A loop on the last line, with no newline after it, is still ended without one
+                f"{after}\n" if loop.end_lineno < len(source.line_starts) else f"\n{after}",
+            ),
+        ]
+        applied = []
+        for edit in edits:
+            if not source.replace(*edit):
+                for other in applied:
+                    source.edits.remove(other)
+                return False
+            applied.append(edit)
+        return True
+
+
+class LintReport:
+    def __init__(self, code: str, findings: list):
+        self.code = code
+        self.findings = findings
+
+    @property
+    def remaining(self) -> list:
+        return [finding for finding in self.findings if not finding.fixed]
+
+    @property
+    def regenerable(self) -> list:
+        """Findings that are left and worth asking the LLM to rewrite the code for."""
+        return [finding for finding in self.remaining if finding.rule in REGENERATE_RULES]
+
+    def to_dict(self) -> dict:
+        return {"findings": [finding.to_dict() for finding in self.findings]}
+
+
+def lint_code(code: str, fix: bool = True, frames=()) -> LintReport:
+    """
+    Look for slow pandas patterns in `code`: loops over rows, `apply(axis=1)`, `concat` and `.copy()` in loops, and
+    chained assignments. With `fix`, concatenations of a single accumulator in a loop and chained assignments to the
+    dataframes named in `frames` are rewritten, and the report holds the rewritten code; the lines of the findings
+    that were fixed refer to the code as it was given. Code that doesn't parse is returned with no findings.
+    """
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return LintReport(code, [])
+    source = Source(code)
+    linter = Linter(source, tree, fix, frames)
+    linter.visit(tree)
+    findings = sorted(linter.findings, key=lambda finding: finding.line or 0)
+    if not source.edits:
+        return LintReport(code, findings)
+    edited = source.edited()
+    try:
+        ast.parse(edited)
+    except SyntaxError:
+        # Never hand out broken code; report everything as not fixed instead
+        for finding in findings:
+            finding.fixed = False
+        return LintReport(code, findings)
+    # What is left is reported with its lines in the rewritten code
+    remaining = lint_code(edited, fix=False).findings
+    return LintReport(edited, [finding for finding in findings if finding.fixed] + remaining)
+
+
+def lint_feedback(query: str, code: str, report: LintReport) -> str:
+    """The request sent back to the LLM for code with slow patterns that couldn't be rewritten mechanically."""
+    problems = "\n".join(
+        f"- Line {finding.line}: {finding.message} {SUGGESTIONS[finding.rule]}" for finding in report.regenerable
+    )
+    return f"""{query}
+
+This code was written for the request above:
+```
+{code}
+```
+It will be run on dataframes with millions of rows, and it has these performance problems:
+{problems}
+Rewrite it to do the same thing without them.
+"""
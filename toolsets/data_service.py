@@ -0,0 +1,119 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+DATA_SERVICE_CONNECT_TIMEOUT = float(os.environ.get("DATA_SERVICE_CONNECT_TIMEOUT", 5))
+DATA_SERVICE_READ_TIMEOUT = float(os.environ.get("DATA_SERVICE_READ_TIMEOUT", 60))
+DATA_SERVICE_RETRIES = int(os.environ.get("DATA_SERVICE_RETRIES", 3))
+DATA_SERVICE_POOL_SIZE = int(os.environ.get("DATA_SERVICE_POOL_SIZE", 10))
+
+# Collections whose member ids are collapsed in endpoint names, so latencies are grouped per endpoint
+COLLECTIONS = {"datasets"}
+
+
+class DataServiceClient:
+    """
+    Pooled HTTP client shared by everything that talks to the Terarium data service, or to the storage urls it hands
+    out.
+
+    Connections are kept alive in a pool, every request gets a connect/read timeout, idempotent requests are retried
+    with exponential backoff on connection errors and 429/5xx responses, and the latency of every request is tallied
+    per endpoint. `submit()` runs a call on the client's thread pool so that independent requests can overlap.
+    """
+
+    def __init__(self, pool_size: int = DATA_SERVICE_POOL_SIZE, retries: int = DATA_SERVICE_RETRIES,
+                 timeout: tuple = (DATA_SERVICE_CONNECT_TIMEOUT, DATA_SERVICE_READ_TIMEOUT)):
+        self.timeout = timeout
+        self.session = requests.Session()
+        retry = Retry(
+            total=retries,
+            backoff_factor=0.5,
+            status_forcelist=(429, 500, 502, 503, 504),
+            # Request bodies may be streamed from a generator, which can't be replayed, so only retry body-less methods
+            allowed_methods=frozenset({"GET", "HEAD", "OPTIONS"}),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="data-service")
+        self.lock = threading.Lock()
+        self.latencies = {}
+
+    @property
+    def base_url(self) -> str:
+        return os.environ['DATA_SERVICE_URL']
+
+    def endpoint(self, method: str, url: str) -> str:
+        parsed = urlparse(url)
+        base = urlparse(self.base_url)
+        if parsed.netloc != base.netloc:
+            # Presigned storage urls are all grouped together
+            return f"{method} storage"
+        path = parsed.path[len(base.path.rstrip("/")):]
+        segments = path.split("/")
+        for idx in range(1, len(segments)):
+            if segments[idx - 1] in COLLECTIONS:
+                segments[idx] = "{id}"
+        return f"{method} {'/'.join(segments)}"
+
+    def record(self, endpoint: str, seconds: float, error: bool):
+        with self.lock:
+            stats = self.latencies.setdefault(endpoint, {"count": 0, "errors": 0, "total_seconds": 0.0, "max_seconds": 0.0})
+            stats["count"] += 1
+            stats["errors"] += int(error)
+            stats["total_seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {endpoint: dict(stats) for endpoint, stats in self.latencies.items()}
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        endpoint = self.endpoint(method, url)
+        start = time.monotonic()
+        error = True
+        try:
+            response = self.session.request(method, url, **kwargs)
+            error = response.status_code >= 400
+            return response
+        finally:
+            # Streamed responses are timed up to the response headers
+            self.record(endpoint, time.monotonic() - start, error)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url: str, **kwargs) -> requests.Response:
+        return self.request("PUT", url, **kwargs)
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        return self.executor.submit(fn, *args, **kwargs)
+
+    def get_dataset(self, dataset_id) -> dict:
+        return self.get(f"{self.base_url}/datasets/{dataset_id}").json()
+
+    def create_dataset(self, dataset: dict) -> dict:
+        return self.post(f"{self.base_url}/datasets", json=dataset).json()
+
+    def download_url(self, dataset_id, filename: str) -> dict:
+        return self.get(f"{self.base_url}/datasets/{dataset_id}/download-url", params={"filename": filename}).json()
+
+    def upload_url(self, dataset_id, filename: str) -> dict:
+        return self.get(f"{self.base_url}/datasets/{dataset_id}/upload-url", params={"filename": filename}).json()
+
+
+data_service = DataServiceClient()
@@ -0,0 +1,115 @@
+import hashlib
+import logging
+import os
+import uuid
+from typing import Mapping, Optional
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+DATASET_CACHE_DIR = os.environ.get(
+    "DATASET_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "jupyter-llm", "datasets")
+)
+# Total size the cache may grow to before the least recently used datasets are evicted. 0 disables the cache.
+DATASET_CACHE_MAX_BYTES = int(os.environ.get("DATASET_CACHE_MAX_BYTES", 2 * 1024 ** 3))
+
+EXTENSION = ".feather"
+
+
+class DatasetCache:
+    """
+    Local, content-addressed cache of parsed datasets.
+
+    Entries are keyed by dataset id, filename and the validators (ETag / Last-Modified / Content-Length) the data
+    service returns for the file, so a changed file is never served from the cache. Frames are stored as Feather
+    (Arrow IPC) files, which are memory-mapped when read back. Reads refresh an entry's mtime, and the least
+    recently used entries are evicted once the cache grows beyond `max_bytes`.
+    """
+
+    def __init__(self, path: str = DATASET_CACHE_DIR, max_bytes: int = DATASET_CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def key(self, dataset_id, filename: str, headers: Mapping[str, str], variant: str = "") -> Optional[str]:
+        """
+        Cache key for a file, or None if the response headers don't carry anything to validate it against.
+
+        `variant` tells apart differently processed frames of the same file, e.g. with optimized dtypes.
+        """
+        validators = [headers.get(name) for name in ("ETag", "Last-Modified", "Content-Length")]
+        if not any(validators[:2]):
+            return None
+        raw = "\n".join([str(dataset_id), filename] + [value or "" for value in validators] + ([variant] if variant else []))
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def entry_path(self, key: str) -> str:
+        return os.path.join(self.path, key + EXTENSION)
+
+    def get(self, key: Optional[str]) -> Optional[pd.DataFrame]:
+        if not self.enabled or key is None:
+            return None
+        path = self.entry_path(key)
+        try:
+            import pyarrow.feather as feather
+            df = feather.read_table(path, memory_map=True).to_pandas()
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except Exception:
+            logger.exception(f"Unable to read cached dataset {path}, discarding it")
+            self.remove(path)
+            self.misses += 1
+            return None
+        os.utime(path)
+        self.hits += 1
+        return df
+
+    def put(self, key: Optional[str], df: pd.DataFrame):
+        if not self.enabled or key is None:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        path = self.entry_path(key)
+        # Written under a temporary name and renamed, so a concurrent reader never sees a partial file
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            df.to_feather(temp_path)
+            os.replace(temp_path, path)
+        except Exception:
+            # Not every frame can be stored as Feather (e.g. non-string column names or mixed-type columns)
+            logger.exception("Unable to cache dataset")
+            self.remove(temp_path)
+            return
+        self.evict()
+
+    def remove(self, path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith(EXTENSION):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.path, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self.remove(os.path.join(self.path, name))
+            total -= size
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses}
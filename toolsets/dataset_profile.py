@@ -0,0 +1,168 @@
+import hashlib
+import os
+from dataclasses import dataclass, field
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+# Number of rows of each column that are hashed to tell whether a dataframe changed. Columns of up to this many rows
+# are hashed whole.
+DATASET_FINGERPRINT_ROWS = int(os.environ.get("DATASET_FINGERPRINT_ROWS", 4096))
+
+
+def buffer_key(series: pd.Series):
+    """
+    Where the values of `series` are stored, or None if that can't be told cheaply. Two columns with different keys
+    were not the same column when they were taken, while a column with the same key as before may have been changed
+    in place since.
+    """
+    if not isinstance(series.dtype, np.dtype):
+        return None
+    values = np.asarray(series.array)
+    return values.__array_interface__["data"][0], values.shape, values.strides, values.dtype.str
+
+
+def sample_positions(rows: int, size: int = DATASET_FINGERPRINT_ROWS) -> np.ndarray:
+    """
+    The same `size` row positions for any frame of `rows` rows: the first and last rows and evenly spaced ones in
+    between, or every row of smaller frames.
+    """
+    if rows <= size:
+        return np.arange(rows)
+    return np.unique(np.linspace(0, rows - 1, size).astype(np.int64))
+
+
+def column_checksum(series: pd.Series) -> Optional[int]:
+    """
+    Checksum of a fixed sample of the values of a column (see `sample_positions`). Returns None if the values can't
+    be hashed.
+
+    Hashing is vectorized and the row hashes are digested in order, so it costs the same however long the column is.
+    Any in-place change to the rows of smaller columns is noticed, while on longer ones only changes to the sampled
+    rows, or ones that move the column to new storage (see `buffer_key`), are.
+    """
+    try:
+        sample = series.iloc[sample_positions(len(series))]
+        hashes = pd.util.hash_pandas_object(sample, index=False).to_numpy()
+    except TypeError:
+        # Unhashable values (lists, dicts, ...) in an object column
+        return None
+    return int.from_bytes(hashlib.blake2b(hashes.tobytes(), digest_size=8).digest(), "little")
+
+
+def column_fingerprint(series: pd.Series) -> Optional[tuple]:
+    checksum = column_checksum(series)
+    if checksum is None:
+        return None
+    return (str(series.dtype), len(series), buffer_key(series), checksum)
+
+
+def frame_fingerprint(df: pd.DataFrame) -> Optional[tuple]:
+    """
+    Identity, column names, shape, dtypes and per-column storage and sampled checksums of `df` (see `column_checksum`),
+    which change with any change to its structure, and most changes to its data. Returns None if some column can't be
+    hashed, in which case there is no telling whether it changed.
+    """
+    columns = tuple(column_fingerprint(df.iloc[:, position]) for position in range(df.shape[1]))
+    if None in columns:
+        return None
+    return (id(df), tuple(str(column) for column in df.columns), df.shape, tuple(str(dtype) for dtype in df.dtypes), columns)
+
+
+def describe_columns(df: pd.DataFrame) -> list:
+    """The columns `df.describe()` reports on by default."""
+    columns = df.select_dtypes(include=[np.number, "datetime"]).columns
+    if len(columns) == 0:
+        columns = df.columns
+    return list(columns)
+
+
+def combine_statistics(stats: list) -> pd.DataFrame:
+    """Per-column `describe()` results as a single frame, one column each."""
+    if not stats:
+        return pd.DataFrame()
+    # Same row layout as `describe()`: statistic names in first-seen order, shortest set of statistics first
+    ordered = sorted((stat.index for stat in stats), key=len)
+    index = list(dict.fromkeys(name for names in ordered for name in names))
+    return pd.concat([stat.reindex(index) for stat in stats], axis=1, sort=False)
+
+
+@dataclass
+class DatasetProfile:
+    """Statistics for a single version of a dataframe."""
+    version: int
+    fingerprint: tuple
+    column_fingerprints: dict = field(default_factory=dict)
+    column_stats: dict = field(default_factory=dict)
+
+    def statistics(self, columns: list) -> pd.DataFrame:
+        return combine_statistics([self.column_stats[column] for column in columns])
+
+
+class DatasetProfileCache:
+    """
+    Caches the statistics used to describe a dataframe.
+
+    Each call to `profile()` fingerprints the dataframe (identity, shape, dtypes and a `column_fingerprint` per column)
+    and only recomputes `describe()` statistics for columns whose fingerprint changed since the previous call. Every
+    change to the fingerprint bumps the profile version.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.current: Optional[DatasetProfile] = None
+        self.hits = 0
+        self.misses = 0
+        self.column_hits = 0
+        self.column_misses = 0
+
+    @property
+    def version(self) -> int:
+        return self.current.version if self.current else 0
+
+    def stats(self) -> dict:
+        return {
+            "version": self.version,
+            "hits": self.hits,
+            "misses": self.misses,
+            "column_hits": self.column_hits,
+            "column_misses": self.column_misses,
+        }
+
+    def profile(self, df: pd.DataFrame) -> DatasetProfile:
+        column_fingerprints = {column: column_fingerprint(df[column]) for column in df.columns}
+        fingerprint = (
+            id(df),
+            df.shape,
+            tuple(str(dtype) for dtype in df.dtypes),
+            tuple(column_fingerprints.values()),
+        )
+        previous = self.current
+        if previous is not None and previous.fingerprint == fingerprint and None not in column_fingerprints.values():
+            self.hits += 1
+            return previous
+
+        self.misses += 1
+        profile = DatasetProfile(
+            version=self.version + 1,
+            fingerprint=fingerprint,
+            column_fingerprints=column_fingerprints,
+        )
+        for column in describe_columns(df):
+            column_fp = column_fingerprints[column]
+            if (
+                previous is not None
+                and column_fp is not None
+                and previous.column_fingerprints.get(column) == column_fp
+                and column in previous.column_stats
+            ):
+                self.column_hits += 1
+                profile.column_stats[column] = previous.column_stats[column]
+            else:
+                self.column_misses += 1
+                profile.column_stats[column] = df[column].describe().rename(column)
+        self.current = profile
+        return profile
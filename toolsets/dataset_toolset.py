@@ -1,17 +1,110 @@
+import difflib
+import hashlib
+import io
 import json
+import keyword
 import logging
 import os
 import re
-import requests
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from dataclasses import dataclass
 from typing import Optional
 
 import pandas as pd
 
 from archytas.tool_utils import tool, toolset, AgentRef, LoopControllerRef
 
+from .code_cache import CodeCache, generated_code, schema_fingerprint
+from .data_service import data_service
+from .dataset_cache import DatasetCache
+from .code_lint import CODE_LINT, lint_code, lint_feedback
+from .dataset_profile import DatasetProfileCache, describe_columns
+from .dry_run import CODE_DRY_RUN, DRY_RUN_MAX_REVISIONS, DryRun, revision_request
+from .dtype_optimizer import DATASET_OPTIMIZE_DTYPES, DtypeSchemaCache, memory_bytes, optimize_dtypes, parser_dtypes
+from .lazy_dataset import (
+    DATASET_BACKEND, DuckDBDataset, is_relation, relation_column_info, summarize_relation, use_lazy_backend,
+)
+from .profile_sidecar import ProfileSidecar, data_file_name, sidecar_file_name
+from .schema_summary import DATASET_INFO_TOKEN_BUDGET, TOKENS_PER_COLUMN, estimate_tokens, summarize_dataframe
+
 logging.disable(logging.WARNING)  # Disable warnings
 logger = logging.Logger(__name__)
 
+# Number of datasets fetched and parsed at once when several are loaded together
+DATASET_LOAD_WORKERS = int(os.environ.get("DATASET_LOAD_WORKERS", 8))
+
+
+@dataclass
+class FetchedDataframe:
+    """
+    A dataset file fetched by `fetch_dataframe`. Fetches run on worker threads, so what they produce besides the
+    dataframe is handed back here for the caller to keep, rather than set on the toolset.
+    """
+    df: object
+    complete: bool
+    dtype_report: Optional[dict] = None
+    lazy_dataset: Optional[DuckDBDataset] = None
+
+
+def combine_reports(reports: list) -> Optional[dict]:
+    """One dtype optimization report for frames that were optimized at the same time."""
+    reports = [report for report in reports if report is not None]
+    if not reports:
+        return None
+    return {
+        "memory_before": sum(report["memory_before"] for report in reports),
+        "memory_after": sum(report["memory_after"] for report in reports),
+        "seconds": max(report["seconds"] for report in reports),
+    }
+
+
+class ProgressReader(io.RawIOBase):
+    """Wraps a readable stream, reporting the number of bytes read through it at most every `interval` seconds."""
+
+    def __init__(self, raw, on_progress, interval=1.0):
+        super().__init__()
+        self.raw = raw
+        self.on_progress = on_progress
+        self.interval = interval
+        self.bytes_read = 0
+        self.bytes_reported = 0
+        self.last_report = time.monotonic()
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.raw.read(len(buffer))
+        size = len(data)
+        buffer[:size] = data
+        self.bytes_read += size
+        now = time.monotonic()
+        if (now - self.last_report >= self.interval or size == 0) and self.bytes_read != self.bytes_reported:
+            self.last_report = now
+            self.bytes_reported = self.bytes_read
+            self.on_progress(self.bytes_read)
+        return size
+
+
+def code_block(llm_response: str) -> str:
+    preamble, code, coda = re.split("```\w*", llm_response)
+    return code.strip()
+
+
+def variable_name(name: str, idx: int, taken: set) -> str:
+    """A variable name for a dataset, e.g. `df_population` for a dataset named "Population", unique within `taken`."""
+    slug = re.sub(r"\W+", "_", name.lower()).strip("_")[:40]
+    base = f"df_{slug}" if slug else f"df_{idx + 1}"
+    if not base.isidentifier():
+        base = f"df_{idx + 1}"
+    variable = base
+    suffix = 2
+    while variable in taken:
+        variable = f"{base}_{suffix}"
+        suffix += 1
+    return variable
+
 
 @toolset()
 class DatasetToolset:
@@ -22,33 +115,244 @@ class DatasetToolset:
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self.dataset_cache = DatasetCache()
+        self.code_cache = CodeCache()
+        self.dtype_schemas = DtypeSchemaCache()
+        self.dry_run = DryRun()
+        # Set by the kernel: runs a function on the kernel thread, which the shell's namespace and the dataframes in it
+        # may only be read from, and returns its result
+        self.call_on_kernel = None
+        # Set by the kernel for the duration of each request, so a request can opt out of the code cache or choose
+        # how its code is linted and tried out before it is returned.
+        self.use_code_cache = True
+        self.lint_mode = CODE_LINT
+        self.dry_run_mode = CODE_DRY_RUN
         self.reset()
 
-    def set_dataset(self, dataset_id, agent=None):
+    def set_dataset(self, dataset_id, agent=None, nrows=None, backend=DATASET_BACKEND,
+                    optimize_dtypes=DATASET_OPTIMIZE_DTYPES, on_sidecar=None):
+        """
+        Load a dataset into `df`. If it was saved with a profile sidecar, `on_sidecar(sidecar)` is called with it as soon
+        as it is in, while the data file may still be downloading, so a context can be built from it right away (see
+        `sidecar_context`).
+        """
         self.dataset_id = dataset_id
-        meta_url = f"{os.environ['DATA_SERVICE_URL']}/datasets/{self.dataset_id}"
-        self.dataset = requests.get(meta_url).json()
+        self.optimize_dtypes = optimize_dtypes
+        self.datasets = []
+        self.profile_sidecar = None
+        self.dataset = data_service.get_dataset(self.dataset_id)
         if self.dataset:
-            self.load_dataframe()
+            # The profile sidecar is small, so it is fetched while the data file downloads. Once it is in, the context
+            # is built from it rather than by profiling the dataframe, which may only hold the first rows, and it is
+            # bound to the dataframe once that has loaded.
+            fetched = data_service.submit(self.fetch_dataframe, nrows=nrows, backend=backend)
+            sidecar = self.fetch_profile_sidecar(dataset_id, self.dataset)
+            if sidecar is not None and on_sidecar is not None:
+                on_sidecar(sidecar)
+            self.use_dataframe(fetched.result())
+            self.profile_sidecar = self.bind_sidecar(sidecar, self.df, self.df_complete)
         else:
             raise Exception(f"Dataset '{dataset_id}' not found.")
 
-    def load_dataframe(self, filename=None):
+    def set_datasets(self, dataset_ids, variables=None, optimize_dtypes=DATASET_OPTIMIZE_DTYPES):
+        """
+        Load several datasets at once, each into its own dataframe.
+
+        The datasets are fetched and parsed concurrently, so loading them takes about as long as loading the slowest
+        one. Each is described by an entry of `self.datasets` with the variable it is bound to in the shell, which is
+        taken from `variables` (a mapping of dataset id to variable name) or derived from the dataset name. The first
+        dataset is also the primary one: `df`, `dataset` and `dataset_id` refer to it.
+        """
+        if not dataset_ids:
+            raise Exception("No datasets given.")
+        variables = variables or {}
+        self.optimize_dtypes = optimize_dtypes
+        self.dtype_report = None
+        self.profile_sidecar = None
+        if self.lazy_dataset is not None:
+            self.lazy_dataset.close()
+            self.lazy_dataset = None
+
+        def load(dataset_id):
+            dataset = data_service.get_dataset(dataset_id)
+            if not dataset:
+                raise Exception(f"Dataset '{dataset_id}' not found.")
+            # Loaded into memory, so that frames can be joined and compared with each other directly
+            fetched = self.fetch_dataframe(dataset_id=dataset_id, dataset=dataset, backend="pandas")
+            return dataset, fetched, self.fetch_profile_sidecar(dataset_id, dataset)
+
+        with ThreadPoolExecutor(max_workers=max(min(len(dataset_ids), DATASET_LOAD_WORKERS), 1)) as pool:
+            loaded = list(pool.map(load, dataset_ids))
+        self.dtype_report = combine_reports([fetched.dtype_report for _, fetched, _ in loaded])
+
+        self.datasets = []
+        taken = set()
+        for idx, (dataset_id, (dataset, fetched, sidecar)) in enumerate(zip(dataset_ids, loaded)):
+            variable = variables.get(dataset_id) or variable_name(dataset.get("name") or "", idx, taken)
+            if not variable.isidentifier() or keyword.iskeyword(variable) or variable == "df" or variable in taken:
+                raise Exception(f"'{variable}' can't be used as the variable name of dataset '{dataset_id}'.")
+            taken.add(variable)
+            self.datasets.append({
+                "id": dataset_id,
+                "dataset": dataset,
+                "variable": variable,
+                "df": fetched.df,
+                "profile_cache": DatasetProfileCache(),
+                "profile_sidecar": self.bind_sidecar(sidecar, fetched.df, fetched.complete),
+            })
+        primary = self.datasets[0]
+        self.dataset_id = primary["id"]
+        self.dataset = primary["dataset"]
+        self.df = primary["df"]
+        self.df_complete = True
+
+    def load_dataframe(self, filename=None, nrows=None, backend=DATASET_BACKEND):
+        self.use_dataframe(self.fetch_dataframe(filename, nrows=nrows, backend=backend))
+
+    def use_dataframe(self, fetched: FetchedDataframe):
+        self.df, self.df_complete, self.dtype_report = fetched.df, fetched.complete, fetched.dtype_report
+        if self.lazy_dataset is not None:
+            self.lazy_dataset.close()
+        self.lazy_dataset = fetched.lazy_dataset
+
+    def fetch_dataframe(self, filename=None, nrows=None, on_progress=None, backend="pandas", dataset_id=None,
+                        dataset=None) -> FetchedDataframe:
+        """
+        Fetch the dataset file as a dataframe, reading at most `nrows` rows if given.
+
+        Returns the dataframe and whether it holds the complete dataset. `on_progress(bytes_read, total_bytes)` is
+        called periodically while a file is being downloaded.
+
+        With the "duckdb" backend (or "auto", for large files) the file is stored on disk instead, and the dataframe
+        returned is a lazy DuckDB relation over it, which is always complete. The `DuckDBDataset` it belongs to is
+        returned with it, and is the caller's to close.
+
+        If `optimize_dtypes` is set, the columns of the dataframe are converted to compact dtypes (see
+        `optimize_dtypes`), with the string dtypes a previous load settled on passed straight to the parser, and the
+        memory saved is reported in the result's `dtype_report`.
+
+        The current dataset is fetched unless another one is given with `dataset_id` and its metadata `dataset`.
+        """
+        if dataset_id is None:
+            dataset_id = self.dataset_id
+            dataset = self.dataset
         if filename is None:
-            filename = self.dataset.get('file_names', [])[0]
-        meta_url = f"{os.environ['DATA_SERVICE_URL']}/datasets/{self.dataset_id}"
-        data_url_req = requests.get(f'{meta_url}/download-url?filename={filename}')
-        data_url = data_url_req.json().get('url', None)
+            filename = data_file_name(dataset.get('file_names', []))
+            if filename is None:
+                raise Exception('Unable to open dataset.')
+        if filename.endswith(".parquet"):
+            # Parquet files are read whole; there is no cheap way to take the first rows of a remote file
+            nrows = None
+        data_url = data_service.download_url(dataset_id, filename).get('url', None)
         if data_url is not None:
-            self.df = pd.read_csv(data_url)
+            # The validators in the response headers decide whether the cached copy is still current, in which case
+            # the body is never read.
+            response = data_service.get(data_url, stream=True)
+            response.raise_for_status()
+            cache_key = self.dataset_cache.key(dataset_id, filename, response.headers)
+            if use_lazy_backend(backend, response.headers):
+                with response:
+                    lazy_dataset = DuckDBDataset.from_response(response, filename, key=cache_key, on_progress=on_progress)
+                return FetchedDataframe(lazy_dataset.relation, True, lazy_dataset=lazy_dataset)
+            optimize = self.optimize_dtypes
+            if optimize:
+                # Frames cached by earlier versions may have unsigned or 8/16-bit integer columns
+                cache_key = self.dataset_cache.key(dataset_id, filename, response.headers, variant="optimized-v2")
+            schema = self.dtype_schemas.get(dataset_id, filename) if optimize else None
+            df = self.dataset_cache.get(cache_key)
+            if df is not None:
+                response.close()
+                if optimize:
+                    # Restores the string dtypes, which come back from the cache as plain pandas strings
+                    df, _ = optimize_dtypes(df, schema)
+                return FetchedDataframe(df, True)
+            with response:
+                df = self.read_dataframe(
+                    response, filename, nrows=nrows, on_progress=on_progress,
+                    dtype=parser_dtypes(schema) if schema else None,
+                )
+            complete = nrows is None or len(df) < nrows
+            report = None
+            if optimize:
+                df, report = self.optimize_dataframe(df, dataset_id, filename, schema, save_schema=complete)
+            if complete:
+                self.dataset_cache.put(cache_key, df)
+            return FetchedDataframe(df, complete, dtype_report=report)
         else:
             raise Exception('Unable to open dataset.')
 
+    def fetch_profile_sidecar(self, dataset_id, dataset) -> Optional[ProfileSidecar]:
+        """
+        The profile saved alongside the dataset file, if there is one. Datasets without one, or with one that can't
+        be read, are profiled from their data instead.
+        """
+        filename = sidecar_file_name(dataset.get('file_names', []))
+        if filename is None:
+            return None
+        try:
+            url = data_service.download_url(dataset_id, filename).get('url', None)
+            if url is None:
+                return None
+            response = data_service.get(url)
+            response.raise_for_status()
+            return ProfileSidecar.from_bytes(response.content)
+        except Exception as err:
+            logger.warning("Unable to read the profile of dataset '%s': %s", dataset_id, err)
+            return None
+
+    @staticmethod
+    def bind_sidecar(sidecar: Optional[ProfileSidecar], df, complete: bool = True) -> Optional[ProfileSidecar]:
+        """`sidecar` bound to `df`, the dataframe loaded with it, or None if there is none or it doesn't fit `df`."""
+        if sidecar is None or not sidecar.bind(df, complete):
+            return None
+        return sidecar
+
+    def optimize_dataframe(self, df, dataset_id, filename, schema=None, save_schema=True) -> tuple[pd.DataFrame, dict]:
+        start = time.monotonic()
+        memory_before = memory_bytes(df)
+        df, schema = optimize_dtypes(df, schema)
+        report = {
+            "memory_before": memory_before,
+            "memory_after": memory_bytes(df),
+            "seconds": time.monotonic() - start,
+        }
+        if save_schema:
+            self.dtype_schemas.put(dataset_id, filename, schema)
+        return df, report
+
+    def read_dataframe(self, response, filename, nrows=None, on_progress=None, dtype=None):
+        if filename.endswith(".parquet"):
+            # Parquet needs a seekable file
+            return pd.read_parquet(io.BytesIO(response.content))
+        response.raw.decode_content = True
+        source = response.raw
+        if on_progress is not None:
+            total_bytes = int(response.headers.get("Content-Length", 0)) or None
+            source = io.BufferedReader(ProgressReader(response.raw, lambda bytes_read: on_progress(bytes_read, total_bytes)))
+        # Compression can't be inferred from a raw stream, so go by the filename
+        return pd.read_csv(source, nrows=nrows, compression="gzip" if filename.endswith(".gz") else None, dtype=dtype)
+
     def reset(self):
         self.dataset_id = None
         self.df = None
+        self.datasets = []
+        self.lazy_dataset = None
+        self.df_complete = True
+        self.optimize_dtypes = DATASET_OPTIMIZE_DTYPES
+        self.dtype_report = None
+        self.profile_cache = DatasetProfileCache()
+        self.profile_sidecar = None
 
     def context(self):
+        if self.datasets:
+            return self.datasets_context()
+        return self.dataset_context(self.dataset_summary())
+
+    def sidecar_context(self, sidecar: ProfileSidecar) -> str:
+        """The context of the current dataset described from its profile sidecar alone, before its data is loaded."""
+        return self.dataset_context(sidecar.summary())
+
+    def dataset_context(self, summary: str) -> str:
         return f"""You are an analyst whose goal is to help with scientific data analysis and manipulation in Python.
 
 You are working on a dataset named: {self.dataset.get('name')}
@@ -58,25 +362,45 @@ The description of the dataset is:
 
 The dataset has the following structure:
 --- START ---
-{self.dataset_info()}
+{summary}
 --- END ---
 
 Please answer any user queries to the best of your ability, but do not guess if you are not sure of an answer.
 If you are asked to manipulate or visualize the dataset, use the generate_python_code tool.
 """
 
-    @tool()
-    def dataset_info(self) -> str:
-        """
-        Inspect the dataset and return information and metadata about it.
+    def datasets_context(self):
+        descriptions = "\n\n".join(
+            f"""Dataset named: {entry['dataset'].get('name')}, loaded as the dataframe `{entry['variable']}`
 
-        This should be used to answer questions about the dataset, including information about the columns,
-        and default parameter values and initial states.
+The description of the dataset is:
+{entry['dataset'].get('description')}"""
+            for entry in self.datasets
+        )
+        return f"""You are an analyst whose goal is to help with scientific data analysis and manipulation in Python.
 
+You are working on {len(self.datasets)} datasets, each loaded into its own dataframe.{self.df_alias_note()}
 
-        Returns:
-            str: a textual representation of the dataset
-        """
+{descriptions}
+
+The dataframes have the following structure:
+--- START ---
+{self.dataset_summary()}
+--- END ---
+
+Please answer any user queries to the best of your ability, but do not guess if you are not sure of an answer.
+If you are asked to manipulate, join, compare or visualize the datasets, use the generate_python_code tool.
+"""
+
+    def df_alias_note(self) -> str:
+        """Tells the agent that `df` is the primary dataframe, for as long as it still is."""
+        primary = self.datasets[0]
+        df = self.kernel.user_ns.get("df") if self.kernel else self.df
+        if df is not primary["df"]:
+            return ""
+        return f" `df` is the same dataframe as `{primary['variable']}`."
+
+    def sync_dataframe(self):
         # Update the local dataframe to match what's in the shell.
         # This will be factored out when we switch around to allow using multiple runtimes.
         if self.kernel:
@@ -84,25 +408,331 @@ If you are asked to manipulate or visualize the dataset, use the generate_python
                 self.df = self.kernel.ev("df")
             except:
                 pass
+            for entry in self.datasets:
+                entry["df"] = self.kernel.user_ns.get(entry["variable"], entry["df"])
+
+    def on_kernel(self, func):
+        """
+        Result of `func`, run on the kernel thread once any running cell is done, so the dataframes it reads aren't
+        changed under it. Gives up if the request driving the agent is cancelled meanwhile.
+        """
+        if self.call_on_kernel is None:
+            return func()
+        return self.call_on_kernel(func, timeout=None, cancel_event=getattr(self.agent, "cancel_event", None))
+
+    def frames(self) -> list:
+        """The dataframes being worked on, as (variable name, dataframe) pairs."""
+        if self.datasets:
+            return [(entry["variable"], entry["df"]) for entry in self.datasets]
+        return [("df", self.df)]
+
+    def frames_fingerprint(self) -> str:
+        # A single dataset keeps the plain schema fingerprint, so code cached before multiple datasets were
+        # supported stays valid
+        if not self.datasets:
+            return schema_fingerprint(self.df)
+        raw = "\n".join(f"{variable}:{schema_fingerprint(df)}" for variable, df in self.frames())
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def context_key(self) -> Optional[tuple]:
+        """
+        Identifies the structure of `df` as described by `context()`: its columns, dtypes and number of rows. The
+        context is stale once this changes.
+        """
+        self.sync_dataframe()
+        if self.df is None:
+            return None
+        key = tuple(
+            (variable, schema_fingerprint(df), None if is_relation(df) else len(df)) for variable, df in self.frames()
+        )
+        if self.datasets:
+            # Whether `df` is still the primary dataframe, which the context says
+            key += (("df", self.df is self.datasets[0]["df"]),)
+        return key
+
+    def full_dataset_info(self, df=None, profile_cache=None) -> str:
+        if df is None:
+            df = self.df
+            profile_cache = self.profile_cache
+        if df.columns.is_unique:
+            profile = profile_cache.profile(df)
+            statistics = profile.statistics(describe_columns(df))
+        else:
+            statistics = df.describe()
 
         output = f"""
 Dataframe head:
-{self.df.head(15)}
+{df.head(15)}
 
 
 Columns:
-{self.df.columns}
+{df.columns}
 
 
 dtypes:
-{self.df.dtypes}
+{df.dtypes}
 
 
 Statistics:
-{self.df.describe()}
+{statistics}
 """
         return output
 
+    def dataset_summary(self, query: Optional[str] = None, budget: int = DATASET_INFO_TOKEN_BUDGET) -> str:
+        """
+        Description of the dataframe that fits in roughly `budget` tokens.
+
+        Narrow frames get the full head/dtypes/statistics description. Wider frames are summarized, describing the
+        columns most relevant to `query` first and pointing the agent at the `column_info` tool for the rest.
+
+        When several datasets are loaded, each dataframe is described in an equal share of the budget.
+
+        Dataframes that are still as loaded from a dataset saved with a profile sidecar are described from the sidecar.
+        Once one has been rebound or changed, its sidecar is dropped and it is profiled from its data from then on.
+        """
+        self.sync_dataframe()
+        if not self.datasets:
+            if self.profile_sidecar is not None and not self.profile_sidecar.describes(self.df):
+                self.profile_sidecar = None
+            return self.frame_summary(
+                self.df, self.profile_cache, query=query, budget=budget, sidecar=self.profile_sidecar,
+            )
+        for entry in self.datasets:
+            if entry["profile_sidecar"] is not None and not entry["profile_sidecar"].describes(entry["df"]):
+                entry["profile_sidecar"] = None
+        share = budget // len(self.datasets)
+        return "\n\n".join(
+            f"Dataframe `{entry['variable']}` ({entry['dataset'].get('name')}):\n"
+            + self.frame_summary(
+                entry["df"], entry["profile_cache"], query=query, budget=share, sidecar=entry["profile_sidecar"],
+            )
+            for entry in self.datasets
+        )
+
+    def frame_summary(self, df, profile_cache, query: Optional[str] = None, budget: int = DATASET_INFO_TOKEN_BUDGET,
+                      sidecar: Optional[ProfileSidecar] = None) -> str:
+        """Description of `df`, from `sidecar` if given, which must describe it."""
+        if is_relation(df):
+            return summarize_relation(df, budget=budget, query=query, dataset=self.lazy_dataset)
+        if sidecar is not None:
+            return sidecar.summary(df, query=query, budget=budget)
+        if df.shape[1] * TOKENS_PER_COLUMN <= budget:
+            output = self.full_dataset_info(df, profile_cache)
+            if estimate_tokens(output) <= budget:
+                return output
+        return summarize_dataframe(df, budget=budget, query=query)
+
+    def code_cache_key(self, query: str, previous_code: str = "") -> Optional[str]:
+        def fingerprint():
+            self.sync_dataframe()
+            return None if self.df is None else self.frames_fingerprint()
+
+        fingerprint = self.on_kernel(fingerprint)
+        if fingerprint is None:
+            return None
+        return self.code_cache.key(
+            query, fingerprint, getattr(self.agent, "model", ""), lint_mode=self.lint_mode, previous_code=previous_code,
+        )
+
+    def cached_code(self, query: str, previous_code: str = "") -> Optional[str]:
+        """
+        Code cell previously generated for `query` against a dataframe with the current schema, if any. Queries that
+        may follow up on an earlier request are only matched after the same `previous_code`.
+        """
+        if not self.use_code_cache:
+            return None
+        key = self.code_cache_key(query, previous_code)
+        cached = self.code_cache.get(key) if key else None
+        if cached is None or self.dry_run_mode == "off":
+            return cached
+        # The data may have grown since the code was cached, so its cost is estimated afresh
+        result = json.loads(cached)
+        result.pop("estimate", None)
+        estimate = self.estimate_code(result["content"])
+        if estimate is not None:
+            result["estimate"] = estimate
+        return json.dumps(result)
+
+    def cache_code(self, query: str, result: str, previous_code: str = ""):
+        """Remember `result` as the answer to `query`, if it is a generated code cell."""
+        if not self.use_code_cache or generated_code(result) is None:
+            return
+        data = json.loads(result)
+        key = self.code_cache_key(query, previous_code)
+        if key:
+            # Estimates depend on the data at the time, not just its schema, so they aren't cached
+            data.pop("estimate", None)
+            self.code_cache.put(key, json.dumps(data), query=query)
+
+    def review_code(self, code: str, query: str, prompt: str, agent) -> tuple[str, Optional[dict]]:
+        """
+        Look for slow pandas patterns in generated code. In "fix" mode, those that can be are rewritten mechanically,
+        and if any that are slow whatever the data are left, the LLM is asked once to rewrite the code, which is kept
+        if it has fewer of them. Returns the code and the findings.
+        """
+        if self.lint_mode == "off":
+            return code, None
+        fix = self.lint_mode == "fix"
+        frames = self.on_kernel(
+            lambda: {variable for variable, df in self.frames() + [("df", self.df)] if isinstance(df, pd.DataFrame)}
+        )
+        report = lint_code(code, fix=fix, frames=frames)
+        regenerated = False
+        if fix and report.regenerable:
+            try:
+                response = agent.oneshot(prompt=prompt, query=lint_feedback(query, report.code, report))
+                retry = lint_code(code_block(response), frames=frames)
+            except Exception as err:
+                # Cancelled requests still stop here; anything else, such as a reply without exactly one code block,
+                # leaves the code as it was
+                if hasattr(agent, "check_cancelled"):
+                    agent.check_cancelled()
+                logger.warning("Unable to regenerate code with performance problems: %s", err)
+            else:
+                if len(retry.regenerable) < len(report.regenerable):
+                    report, regenerated = retry, True
+        metrics = getattr(agent, "metrics", None)
+        if metrics is not None:
+            for finding in report.findings:
+                metrics.increment("code_lint_findings_total", rule=finding.rule, fixed=finding.fixed)
+        return report.code, dict(report.to_dict(), regenerated=regenerated)
+
+    def dry_run_bindings(self) -> tuple[dict, dict]:
+        """The dataframes and modules a dry run sees, which are read from the shell on the kernel thread."""
+        self.sync_dataframe()
+        frames = dict(self.frames())
+        frames["df"] = self.df
+        return frames, DryRun.modules(self.kernel.user_ns)
+
+    def estimate_code(self, code: str) -> Optional[dict]:
+        """The projected cost of running `code` on the dataframes, from trying it out on samples of them."""
+        if self.dry_run_mode == "off" or getattr(self, "kernel", None) is None or self.call_on_kernel is None:
+            return None
+        try:
+            frames, modules = self.call_on_kernel(self.dry_run_bindings)
+        except FutureTimeoutError:
+            # The kernel is busy running a cell, which may be changing the data anyway
+            logger.warning("Kernel busy, skipping the dry run of generated code")
+            return None
+        start = time.monotonic()
+        estimate = self.dry_run.estimate(code, frames, modules)
+        metrics = getattr(getattr(self, "agent", None), "metrics", None)
+        if metrics is not None and estimate is not None:
+            outcome = "error" if estimate["error"] else "flagged" if estimate["exceeds_limits"] else "ok"
+            metrics.observe("code_dry_run_seconds", time.monotonic() - start, outcome=outcome)
+        return estimate
+
+    @tool()
+    def dataset_info(self) -> str:
+        """
+        Inspect the dataset and return information and metadata about it.
+
+        This should be used to answer questions about the dataset, including information about the columns,
+        and default parameter values and initial states.
+        For datasets with many columns only a summary is returned; use the `column_info` tool to get the details
+        of specific columns.
+
+
+        Returns:
+            str: a textual representation of the dataset
+        """
+        return self.on_kernel(self.dataset_summary)
+
+    @tool()
+    def column_info(self, columns: str) -> str:
+        """
+        Return detailed information about specific columns of the dataset.
+
+        This should be used when `dataset_info` only summarized the dataset and more details about some of its
+        columns are needed, such as their values, dtypes and statistics.
+
+        When several datasets are loaded, the columns are looked up in all of their dataframes.
+
+        Args:
+            columns (str): A comma separated list of column names, e.g. "age, height, weight".
+
+        Returns:
+            str: a textual representation of the requested columns
+        """
+        return self.on_kernel(lambda: self.describe_columns(columns))
+
+    def describe_columns(self, columns: str) -> str:
+        self.sync_dataframe()
+        names = [name.strip() for name in columns.split(",") if name.strip()]
+        frames = self.frames()
+        found = {variable: [] for variable, _ in frames}
+        missing = []
+        for name in names:
+            matched = False
+            for variable, df in frames:
+                by_name = {str(column): column for column in df.columns}
+                if name in by_name:
+                    found[variable].append(by_name[name])
+                    matched = True
+            if not matched:
+                all_names = [str(column) for _, df in frames for column in df.columns]
+                suggestions = difflib.get_close_matches(name, all_names, n=3)
+                hint = f" Did you mean: {', '.join(suggestions)}?" if suggestions else ""
+                missing.append(f"Column '{name}' does not exist.{hint}")
+
+        output = "\n".join(missing)
+        for variable, df in frames:
+            if not found[variable]:
+                continue
+            if self.datasets:
+                output += f"\n\nColumns of dataframe `{variable}`:"
+            output += self.columns_info(df, found[variable])
+        return output
+
+    def columns_info(self, df, columns: list) -> str:
+        if is_relation(df):
+            return relation_column_info(df, columns, dataset=self.lazy_dataset)
+        selected = df[columns]
+        return f"""
+Dataframe head:
+{selected.head(15)}
+
+
+dtypes:
+{selected.dtypes}
+
+
+Null counts:
+{selected.isna().sum()}
+
+
+Statistics:
+{selected.describe(include="all")}
+"""
+
+    def code_prompt_data(self, query: str) -> tuple[str, str]:
+        """The description of the dataframes given to the LLM generating code for `query`, and how to work with them."""
+        self.sync_dataframe()
+        if self.datasets:
+            data_description = f"""You have access to the following Pandas Dataframes, one for each of the datasets you are working with.{self.df_alias_note()}
+{self.dataset_summary(query=query)}"""
+            api_instructions = """
+If you are asked to modify or update a dataframe, modify it in place, keeping the updated variable to still have the same name.
+If you are asked to join or combine dataframes, assign the result to a new variable unless asked otherwise.
+"""
+        else:
+            if is_relation(self.df):
+                variable_description = "a DuckDB relation (duckdb.DuckDBPyRelation) over a dataset that is too large to load in memory"
+                api_instructions = """
+The dataset must not be loaded into memory. Work with `df` through the DuckDB relational API (e.g. `df.filter(...)`, `df.project(...)`, `df.aggregate(...)`, `df.order(...)`, `df.limit(...)`) or through SQL with `df.query("df", "SELECT ... FROM df")`.
+The DuckDB connection the relation belongs to is available as `con`.
+Only convert results to Pandas (with `.df()`) once they have been reduced to a small number of rows, e.g. aggregates or a `limit()`.
+If you are asked to modify or update the dataframe, assign the new relation to `df`.
+"""
+            else:
+                variable_description = "a Pandas Dataframe"
+                api_instructions = """
+If you are asked to modify or update the dataframe, modify the dataframe in place, keeping the updated variable to still be named `df`.
+"""
+            data_description = f"""You have access to a variable name `df` that is {variable_description} with the following structure:
+{self.dataset_summary(query=query)}"""
+        return data_description, api_instructions
+
     @tool()
     def generate_python_code(
         self, query: str, agent: AgentRef, loop: LoopControllerRef
@@ -112,7 +742,8 @@ Statistics:
 
         Input is a full grammatically correct question about or request for an action to be performed on the loaded dataframe.
 
-        Assume that the dataframe is already loaded and has the variable name `df`.
+        Assume that the dataframe is already loaded and has the variable name `df`. When several datasets are loaded,
+        each one is in its own dataframe, named as described in the context.
         Information about the dataframe can be loaded with the `dataset_info` tool.
 
         Args:
@@ -121,6 +752,13 @@ Statistics:
         Returns:
             str: A LLM prompt that should be passed evaluated.
         """
+        cached = self.cached_code(query)
+        if cached is not None:
+            loop.set_state(loop.STOP_SUCCESS)
+            return cached
+
+        data_description, api_instructions = self.on_kernel(lambda: self.code_prompt_data(query))
+
         # set up the agent
         # str: Valid and correct python code that fulfills the user's request.
         prompt = f"""
@@ -128,11 +766,8 @@ You are a programmer writing code to help with scientific data analysis and mani
 
 Please write code that satisfies the user's request below.
 
-You have access to a variable name `df` that is a Pandas Dataframe with the following structure:
-{self.dataset_info()}
-
-If you are asked to modify or update the dataframe, modify the dataframe in place, keeping the updated variable to still be named `df`.
-
+{data_description}
+{api_instructions}
 You also have access to the libraries pandas, numpy, scipy, matplotlib.
 
 Please generate the code as if you were programming inside a Jupyter Notebook and the code is to be executed inside a cell.
@@ -142,12 +777,32 @@ No addtional text is needed in the response, just the code block.
 
         llm_response = agent.oneshot(prompt=prompt, query=query)
         loop.set_state(loop.STOP_SUCCESS)
-        preamble, code, coda = re.split("```\w*", llm_response)
-        result = json.dumps(
-            {
-                "action": "code_cell",
-                "language": "python",
-                "content": code.strip(),
-            }
-        )
+        code, lint = self.review_code(code_block(llm_response), query, prompt, agent)
+        # Code projected to be too expensive to run on the full data is sent back to be rewritten, in "revise" mode
+        estimate = self.estimate_code(code)
+        revisions = 0
+        while estimate is not None and estimate["exceeds_limits"] and self.dry_run_mode == "revise" \
+                and revisions < DRY_RUN_MAX_REVISIONS:
+            try:
+                revised = code_block(agent.oneshot(prompt=prompt, query=revision_request(query, code, estimate)))
+            except Exception as err:
+                # As in `review_code`, the code is kept as it was unless the request was cancelled
+                if hasattr(agent, "check_cancelled"):
+                    agent.check_cancelled()
+                logger.warning("Unable to revise code projected to exceed the limits: %s", err)
+                break
+            code, lint = self.review_code(revised, query, prompt, agent)
+            estimate = self.estimate_code(code)
+            revisions += 1
+        result = {
+            "action": "code_cell",
+            "language": "python",
+            "content": code,
+        }
+        if lint is not None:
+            result["lint"] = lint
+        if estimate is not None:
+            result["estimate"] = dict(estimate, revisions=revisions)
+        result = json.dumps(result)
+        self.cache_code(query, result)
         return result
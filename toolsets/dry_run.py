@@ -0,0 +1,424 @@
+import ast
+import builtins
+import importlib
+import io
+import logging
+import math
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import time
+import tracemalloc
+import types
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Whether generated code is tried out on a sample of the data before it is handed to the user: "off", "flag" to attach
+# a cost estimate to the code cell, or "revise" to also send code that is projected to exceed the limits back to the
+# LLM to be rewritten. Can be overridden per request. Off by default: although dry runs happen in a separate process that
+# can't write files, remove or rename them, open connections or start processes, that is only enforced on a best
+# effort basis (see `refuse_side_effects`), and generated code is run before the user has seen it.
+CODE_DRY_RUN = os.environ.get("CODE_DRY_RUN", "off")
+# Rows each dataframe is sampled down to, and how long a run on the sample may take before it is abandoned
+DRY_RUN_SAMPLE_ROWS = int(os.environ.get("DRY_RUN_SAMPLE_ROWS", 10_000))
+DRY_RUN_TIMEOUT = float(os.environ.get("DRY_RUN_TIMEOUT", 10))
+# How long a dry run process may take to start and load the samples, which doesn't count towards DRY_RUN_TIMEOUT
+DRY_RUN_STARTUP_TIMEOUT = float(os.environ.get("DRY_RUN_STARTUP_TIMEOUT", 60))
+# Memory a run on a sample may be projected to allocate, beyond which no larger sample is tried
+DRY_RUN_MAX_SAMPLE_BYTES = int(os.environ.get("DRY_RUN_MAX_SAMPLE_BYTES", 256 * 1024 ** 2))
+# Address space a dry run may take up beyond what it has once the samples are loaded; it runs out of memory past that
+DRY_RUN_MEMORY_LIMIT = int(os.environ.get("DRY_RUN_MEMORY_LIMIT", 4 * DRY_RUN_MAX_SAMPLE_BYTES))
+# Projected run time and peak memory beyond which code is flagged. The memory limit defaults to half of the memory
+# available when the estimate is made.
+DRY_RUN_MAX_SECONDS = float(os.environ.get("DRY_RUN_MAX_SECONDS", 60))
+DRY_RUN_MAX_BYTES = int(os.environ.get("DRY_RUN_MAX_BYTES", 0))
+# Times flagged code is sent back to the LLM in "revise" mode
+DRY_RUN_MAX_REVISIONS = int(os.environ.get("DRY_RUN_MAX_REVISIONS", 1))
+
+MODES = ("off", "flag", "revise")
+# Columns with more distinct values than this aren't used to stratify the sample
+MAX_STRATA = 1000
+# Samples are tried at SAMPLE_STEPS sizes, each SCALE_STEP times larger than the one before, which tells how cost
+# grows with the number of rows
+SCALE_STEP = 4
+SAMPLE_STEPS = 3
+MIN_SAMPLE_ROWS = 100
+# Run times below this are mostly fixed overhead, and say nothing about how the code scales
+MIN_SCALING_SECONDS = 0.005
+MIN_SCALING_BYTES = 1024 ** 2
+
+
+def check_mode(mode: str) -> str:
+    if mode not in MODES:
+        raise ValueError(f"Unsupported dry run mode '{mode}'. Supported modes are: {', '.join(MODES)}")
+    return mode
+
+
+def available_bytes() -> Optional[int]:
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_AVPHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def code_strings(code: str) -> set:
+    """String literals in `code`, which is where column names used for grouping, merging or filtering show up."""
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return set()
+    return {node.value for node in ast.walk(tree) if isinstance(node, ast.Constant) and isinstance(node.value, str)}
+
+
+def strata_column(df: pd.DataFrame, names: set):
+    """The column named in the code with the fewest distinct values, if it has few enough of them to stratify by."""
+    best, best_count = None, None
+    for column in df.columns:
+        if str(column) not in names:
+            continue
+        series = df[column]
+        if isinstance(series, pd.DataFrame):
+            continue
+        if pd.api.types.is_float_dtype(series):
+            continue
+        count = series.nunique(dropna=False)
+        if 1 < count <= MAX_STRATA and (best_count is None or count < best_count):
+            best, best_count = column, count
+    return best
+
+
+def stratified_positions(df: pd.DataFrame, fraction: float, column=None, seed: int = 0) -> np.ndarray:
+    """
+    Positions of a random `fraction` of the rows of `df`, in their original order. If `column` is given, every value
+    of it keeps its share of the rows, and at least one row, so groups and join keys all make it into the sample.
+    """
+    rng = np.random.default_rng(seed)
+    shuffled = rng.permutation(len(df))
+    if column is None:
+        return np.sort(shuffled[:max(int(round(fraction * len(df))), 1)])
+    codes, _ = pd.factorize(df[column], use_na_sentinel=False)
+    codes = codes[shuffled]
+    counts = np.bincount(codes)
+    quotas = np.maximum(np.round(fraction * counts), 1)
+    order = np.argsort(codes, kind="stable")
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    ranks = np.empty(len(codes), dtype=np.int64)
+    ranks[order] = np.arange(len(codes)) - starts[codes[order]]
+    return np.sort(shuffled[ranks < quotas[codes]])
+
+
+def sample_frames(frames: dict, fraction: float, names: set) -> dict:
+    """Samples of the dataframes in `frames`. Variables bound to the same dataframe are bound to the same sample."""
+    samples = {}
+    by_id = {}
+    for variable, df in frames.items():
+        if id(df) not in by_id:
+            if fraction >= 1:
+                by_id[id(df)] = df.copy()
+            else:
+                positions = stratified_positions(df, fraction, strata_column(df, names))
+                by_id[id(df)] = df.iloc[positions].copy()
+        samples[variable] = by_id[id(df)]
+    return samples
+
+
+def refused(*args, **kwargs):
+    raise PermissionError("Not allowed in a dry run")
+
+
+def read_only_open(opener):
+    def open_file(file, mode="r", *args, **kwargs):
+        if any(flag in mode for flag in "wax+"):
+            refused()
+        return opener(file, mode, *args, **kwargs)
+    return open_file
+
+
+def read_only_os_open(opener):
+    def open_file(path, flags, *args, **kwargs):
+        if flags & (os.O_WRONLY | os.O_RDWR | os.O_CREAT | os.O_TRUNC | os.O_APPEND):
+            refused()
+        return opener(path, flags, *args, **kwargs)
+    return open_file
+
+
+def refuse_side_effects(memory_limit: Optional[int]):
+    """
+    Keep the code run in a dry run process from changing anything outside it: writing, removing or renaming files,
+    opening network connections or starting processes, and from taking more than `memory_limit` bytes of address
+    space. Files are kept from growing by the file size limit too, which also covers writes from native code. The
+    rest is enforced in Python only, so code can still get around it through native libraries.
+    """
+    import resource
+
+    signal.signal(signal.SIGXFSZ, signal.SIG_IGN)
+    resource.setrlimit(resource.RLIMIT_FSIZE, (0, 0))
+    if memory_limit:
+        # Arrow's own allocators reserve more address space up front than the limit leaves them
+        os.environ["ARROW_DEFAULT_MEMORY_POOL"] = "system"
+        pyarrow = sys.modules.get("pyarrow")
+        if pyarrow is not None:
+            pyarrow.set_memory_pool(pyarrow.system_memory_pool())
+        try:
+            with open("/proc/self/statm") as file:
+                current = int(file.read().split()[0]) * os.sysconf("SC_PAGE_SIZE")
+            resource.setrlimit(resource.RLIMIT_AS, (current + memory_limit, current + memory_limit))
+        except (OSError, ValueError):
+            logger.warning("Unable to limit the memory of dry runs")
+    builtins.open = io.open = read_only_open(io.open)
+    os.open = read_only_os_open(os.open)
+    for name in ("remove", "unlink", "rmdir", "removedirs", "rename", "renames", "replace", "truncate", "chmod",
+                 "chown", "link", "symlink", "mkdir", "makedirs", "system", "fork", "kill", "execv", "execve"):
+        if hasattr(os, name):
+            setattr(os, name, refused)
+    shutil.rmtree = shutil.move = shutil.copyfile = shutil.copy = shutil.copy2 = refused
+    socket.socket.connect = socket.socket.connect_ex = socket.socket.bind = refused
+    socket.create_connection = refused
+    subprocess.Popen = refused
+    # Plots made on the sample must not be shown
+    pyplot = sys.modules.get("matplotlib.pyplot")
+    if pyplot is not None:
+        pyplot.show = lambda *args, **kwargs: None
+
+
+def start_context():
+    """
+    Dry runs are started from the LLM worker thread, where forking the kernel could copy locks held by its other
+    threads, so they are started by a fork server, which is a separate process with a single thread, or spawned anew.
+    """
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        # Loaded once in the fork server rather than in every dry run
+        context.set_forkserver_preload(["numpy", "pandas", __name__])
+        return context
+    return multiprocessing.get_context("spawn")
+
+
+def import_modules(modules: dict) -> dict:
+    """The modules named in `modules` (see `DryRun.modules`), skipping those that can't be imported here."""
+    # The kernel's inline backend would send plots made on the sample to the notebook
+    os.environ["MPLBACKEND"] = "Agg"
+    imported = {}
+    for variable, name in modules.items():
+        try:
+            imported[variable] = importlib.import_module(name)
+        except Exception:
+            logger.debug("Unable to import module '%s' for a dry run", name)
+    return imported
+
+
+def run_child(connection, code: str, samples: dict, modules: dict, memory_limit: Optional[int]):
+    # Output of the code on the sample is kept out of the notebook
+    sys.stdout = sys.stderr = io.StringIO()
+    outcome = {}
+    try:
+        namespace = import_modules(modules)
+        refuse_side_effects(memory_limit)
+    except Exception as err:
+        connection.send({"error": f"Unable to isolate the dry run: {err}"})
+        return
+    namespace.setdefault("pd", pd)
+    namespace.setdefault("np", np)
+    namespace.update(samples)
+    namespace["print"] = lambda *args, **kwargs: None
+    namespace["display"] = lambda *args, **kwargs: None
+    # The timeout runs from here, not counting the time taken to start the process and load the samples
+    connection.send(None)
+    tracemalloc.start()
+    baseline, _ = tracemalloc.get_traced_memory()
+    start = time.perf_counter()
+    try:
+        exec(compile(code, "<dry-run>", "exec"), namespace)
+    except BaseException as err:
+        outcome["error"] = f"{type(err).__name__}: {err}"
+    outcome["seconds"] = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    outcome["peak_bytes"] = max(peak - baseline, 0)
+    connection.send(outcome)
+
+
+def run_isolated(code: str, samples: dict, modules: dict, timeout: float,
+                 memory_limit: Optional[int] = DRY_RUN_MEMORY_LIMIT) -> tuple[float, int, Optional[str]]:
+    """
+    Run `code` in a separate process, with the dataframes in `samples` and the modules named in `modules` bound.
+    Returns (seconds, peak bytes allocated, error).
+
+    Allocations are traced with tracemalloc, which sees those made by numpy and pandas too. The process is killed if
+    the code is still running after `timeout` seconds, wherever it is, and runs out of memory once it has taken up
+    `memory_limit` bytes more than it had when the samples were loaded. The kernel itself is never affected by what
+    the code does.
+    """
+    reader, writer = multiprocessing.Pipe(duplex=False)
+    process = start_context().Process(
+        target=run_child, args=(writer, code, samples, modules, memory_limit), name="dry-run", daemon=True,
+    )
+    try:
+        process.start()
+    except Exception as err:
+        # Such as samples holding objects that can't be pickled
+        reader.close()
+        return 0.0, 0, f"Unable to start the dry run: {err}"
+    finally:
+        writer.close()
+
+    start = time.perf_counter()
+    started = timed_out = False
+    outcome = None
+    try:
+        # The first message says the code is about to run, unless the process couldn't be isolated
+        if reader.poll(DRY_RUN_STARTUP_TIMEOUT):
+            started = True
+            outcome = reader.recv()
+            if outcome is None:
+                start = time.perf_counter()
+                if reader.poll(timeout):
+                    outcome = reader.recv()
+                else:
+                    timed_out = True
+    except EOFError:
+        pass
+    finally:
+        reader.close()
+        if process.is_alive():
+            process.kill()
+        process.join()
+    if not started:
+        return 0.0, 0, f"The dry run process didn't start within {DRY_RUN_STARTUP_TIMEOUT:g}s"
+    if timed_out:
+        return timeout, 0, f"Timed out after {timeout:g}s on the sample"
+    if outcome is None:
+        exitcode = process.exitcode
+        cause = f"was killed by signal {-exitcode}" if exitcode and exitcode < 0 else "exited without a result"
+        return time.perf_counter() - start, 0, f"The dry run process {cause}"
+    return outcome.get("seconds", 0.0), outcome.get("peak_bytes", 0), outcome.get("error")
+
+
+def scaling_exponent(small: float, large: float, floor: float) -> float:
+    """How cost grows with the number of rows (1 for linear, 2 for quadratic), from runs SCALE_STEP sizes apart."""
+    if large < floor or small <= 0:
+        return 1.0
+    return min(max(math.log(large / small) / math.log(SCALE_STEP), 1.0), 2.0)
+
+
+class DryRun:
+    """
+    Estimates the cost of running generated code on the full data by running it on samples of it first.
+
+    The code is run in a separate process (see `run_isolated`), in a namespace that holds only the modules imported in
+    the shell and stratified samples of the dataframes, on samples of growing size. Run time and peak allocations are
+    measured on each, and those of the largest are extrapolated to the full size with the growth rate between the last two, so code that is
+    quadratic in the number of rows (such as a merge that blows up into a cartesian product) is projected as such.
+    Samples stop growing before one is projected to go over the timeout or `max_sample_bytes`, so trying out code
+    doesn't cost much even when running it for real would.
+    """
+
+    def __init__(self, sample_rows: int = DRY_RUN_SAMPLE_ROWS, timeout: float = DRY_RUN_TIMEOUT,
+                 max_sample_bytes: int = DRY_RUN_MAX_SAMPLE_BYTES, max_seconds: float = DRY_RUN_MAX_SECONDS,
+                 max_bytes: int = DRY_RUN_MAX_BYTES, memory_limit: int = DRY_RUN_MEMORY_LIMIT):
+        self.sample_rows = sample_rows
+        self.timeout = timeout
+        self.max_sample_bytes = max_sample_bytes
+        self.max_seconds = max_seconds
+        self.max_bytes = max_bytes
+        self.memory_limit = memory_limit
+
+    @staticmethod
+    def modules(user_ns: dict) -> dict:
+        """
+        Variable name -> module name of the modules bound in the shell, which dry runs import themselves. Must be
+        called on the thread that runs the shell's code.
+        """
+        return {
+            variable: value.__name__ for variable, value in list(user_ns.items())
+            if isinstance(value, types.ModuleType) and not variable.startswith("__")
+        }
+
+    def run(self, code: str, frames: dict, fraction: float, modules: dict, names: set) -> tuple[float, int, Optional[str]]:
+        return run_isolated(code, sample_frames(frames, fraction, names), modules, self.timeout, self.memory_limit)
+
+    def estimate(self, code: str, frames: dict, modules: Optional[dict] = None) -> Optional[dict]:
+        """
+        The projected cost of running `code` against `frames` (a mapping of variable names to dataframes), with
+        `modules` (see `DryRun.modules`) bound as in the shell, or None if there is nothing to sample, such as when the
+        data is a DuckDB relation.
+        """
+        frames = {variable: df for variable, df in frames.items() if isinstance(df, pd.DataFrame)}
+        if not frames:
+            return None
+        rows = max(len(df) for df in frames.values())
+        names = code_strings(code)
+        modules = modules or {}
+        fraction = min(self.sample_rows / rows, 1.0) if rows else 1.0
+
+        # Samples grow SCALE_STEP times at a time up to `sample_rows`, and stop early once the next one is projected to
+        # take too long or too much memory itself
+        fractions = [fraction / SCALE_STEP ** step for step in reversed(range(SAMPLE_STEPS))]
+        fractions = [step for step in fractions if step * rows >= MIN_SAMPLE_ROWS] or [fraction]
+        time_exponent = memory_exponent = 1.0
+        previous = None
+        for fraction in fractions:
+            seconds, peak_bytes, error = self.run(code, frames, fraction, modules, names)
+            if error is not None:
+                break
+            if previous is not None:
+                time_exponent = scaling_exponent(previous[0], seconds, MIN_SCALING_SECONDS)
+                memory_exponent = scaling_exponent(previous[1], peak_bytes, MIN_SCALING_BYTES)
+            previous = (seconds, peak_bytes)
+            if seconds * SCALE_STEP ** time_exponent > self.timeout \
+                    or peak_bytes * SCALE_STEP ** memory_exponent > self.max_sample_bytes:
+                break
+
+        scale = 1 / fraction
+        estimate = {
+            "sample_fraction": fraction,
+            "sample_rows": int(round(fraction * rows)),
+            "rows": rows,
+            "sample_seconds": seconds,
+            "sample_peak_bytes": peak_bytes,
+            "estimated_seconds": seconds * scale ** time_exponent,
+            "estimated_peak_bytes": int(peak_bytes * scale ** memory_exponent),
+            "time_scaling": time_exponent,
+            "memory_scaling": memory_exponent,
+            "error": error,
+        }
+        max_bytes = self.max_bytes or (available_bytes() or 0) // 2
+        reasons = []
+        if error is not None and error.startswith("Timed out"):
+            reasons.append(f"it took more than {self.timeout:g}s on a {estimate['sample_rows']:,} row sample")
+        elif error is not None and error.startswith("MemoryError") and self.memory_limit:
+            reasons.append(
+                f"it ran out of the {self.memory_limit / 1024 ** 3:,.1f} GB of memory allowed on a "
+                f"{estimate['sample_rows']:,} row sample"
+            )
+        elif estimate["estimated_seconds"] > self.max_seconds:
+            reasons.append(f"it is projected to run for {estimate['estimated_seconds']:,.0f}s (limit {self.max_seconds:g}s)")
+        if max_bytes and estimate["estimated_peak_bytes"] > max_bytes:
+            reasons.append(
+                f"it is projected to use {estimate['estimated_peak_bytes'] / 1024 ** 3:,.1f} GB of memory "
+                f"(limit {max_bytes / 1024 ** 3:,.1f} GB)"
+            )
+        estimate["exceeds_limits"] = bool(reasons)
+        estimate["reasons"] = reasons
+        return estimate
+
+
+def revision_request(query: str, code: str, estimate: dict) -> str:
+    """The request sent back to the LLM for code that is projected to exceed the limits."""
+    scaling = "quadratically" if estimate["time_scaling"] > 1.5 or estimate["memory_scaling"] > 1.5 else "linearly"
+    return f"""{query}
+
+This code was written for the request above:
+```
+{code}
+```
+It was tried out on a sample of {estimate['sample_rows']:,} of the {estimate['rows']:,} rows, and it is too expensive to run on the full data: {'; '.join(estimate['reasons'])}. Its cost grows {scaling} with the number of rows.
+Rewrite it to do the same thing efficiently: use vectorized pandas operations instead of loops over rows, avoid merges that multiply rows, and filter or aggregate before combining data.
+"""
@@ -0,0 +1,193 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import uuid
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Whether datasets are converted to compact dtypes after loading. Can be overridden per dataset.
+DATASET_OPTIMIZE_DTYPES = os.environ.get("DATASET_OPTIMIZE_DTYPES", "false").lower() in ("1", "true", "yes")
+# String columns with at most this fraction of distinct values (and at most CATEGORY_MAX_VALUES of them) become
+# categoricals.
+CATEGORY_MAX_FRACTION = float(os.environ.get("DATASET_CATEGORY_MAX_FRACTION", 0.5))
+CATEGORY_MAX_VALUES = int(os.environ.get("DATASET_CATEGORY_MAX_VALUES", 10_000))
+DTYPE_SCHEMA_DIR = os.environ.get(
+    "DTYPE_SCHEMA_DIR", os.path.join(os.path.expanduser("~"), ".cache", "jupyter-llm", "schemas")
+)
+
+# Values checked before attempting to parse a whole column as dates
+DATE_SAMPLE_ROWS = 1000
+DATE_PATTERN = re.compile(r"^\s*\d{1,4}[-/.]\d{1,2}[-/.]\d{1,4}([ T]\d{1,2}:\d{2}(:\d{2}(\.\d+)?)?)?\s*(Z|[+-]\d{2}:?\d{2})?\s*$")
+# Dtypes that can be handed straight to the CSV parser
+PARSER_DTYPES = ("category", "string[pyarrow]", "string[python]")
+
+
+def memory_bytes(df: pd.DataFrame) -> int:
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+def dtype_name(dtype) -> str:
+    # str() of an Arrow-backed string dtype is just "string", which would convert back to Python-backed strings
+    if isinstance(dtype, pd.StringDtype):
+        return f"string[{dtype.storage}]"
+    return str(dtype)
+
+
+def string_dtype() -> str:
+    """Arrow-backed strings if pyarrow is available, otherwise pandas' own string dtype."""
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return "string"
+    return "string[pyarrow]"
+
+
+def downcast_integers(series: pd.Series) -> pd.Series:
+    """
+    Signed 64-bit integers to 32 bits if every value fits. Narrower or unsigned types would change the results of
+    arithmetic on the column (`a - b` wrapping around, sums overflowing), so they are never chosen.
+    """
+    dtype = series.dtype
+    if not pd.api.types.is_signed_integer_dtype(dtype) or dtype.itemsize <= 4:
+        return series
+    info = np.iinfo(np.int32)
+    if len(series) and (series.min() < info.min or series.max() > info.max):
+        return series
+    return series.astype("Int32" if isinstance(dtype, pd.api.extensions.ExtensionDtype) else np.int32)
+
+
+def downcast_floats(series: pd.Series) -> pd.Series:
+    """float32 if every value survives the round trip exactly, so no precision is lost."""
+    values = series.to_numpy()
+    with np.errstate(over="ignore"):
+        narrowed = values.astype(np.float32)
+    same = (narrowed.astype(np.float64) == values) | np.isnan(values)
+    return series.astype(np.float32) if same.all() else series
+
+
+def looks_like_dates(series: pd.Series) -> bool:
+    sample = series.dropna().head(DATE_SAMPLE_ROWS)
+    return len(sample) > 0 and all(isinstance(value, str) and DATE_PATTERN.match(value) for value in sample)
+
+
+def parse_dates(series: pd.Series) -> Optional[pd.Series]:
+    """The column parsed as datetimes, or None if any of its values isn't a date."""
+    try:
+        parsed = pd.to_datetime(series, errors="coerce")
+    except (TypeError, ValueError, OverflowError):
+        return None
+    if parsed.isna().sum() != series.isna().sum():
+        return None
+    return parsed
+
+
+def optimize_column(series: pd.Series) -> pd.Series:
+    if pd.api.types.is_bool_dtype(series):
+        return series
+    if pd.api.types.is_integer_dtype(series):
+        return downcast_integers(series)
+    if pd.api.types.is_float_dtype(series):
+        return downcast_floats(series)
+    if series.dtype != object:
+        return series
+    if looks_like_dates(series):
+        parsed = parse_dates(series)
+        if parsed is not None:
+            return parsed
+    if not all(isinstance(value, str) for value in series.dropna().head(DATE_SAMPLE_ROWS)):
+        # Mixed types don't fit a string dtype
+        return series
+    distinct = series.nunique(dropna=True)
+    if distinct <= CATEGORY_MAX_VALUES and distinct <= CATEGORY_MAX_FRACTION * len(series):
+        return series.astype("category")
+    try:
+        return series.astype(string_dtype())
+    except (TypeError, ValueError):
+        return series
+
+
+def apply_column(series: pd.Series, dtype: str) -> pd.Series:
+    """
+    Convert a column to the dtype it had after a previous load, falling back to inspecting it if it no longer fits.
+    Numeric columns are always downcast afresh, as that is cheap and their range may have changed.
+    """
+    if dtype_name(series.dtype) == dtype:
+        return series
+    if dtype.startswith("datetime64") and series.dtype == object:
+        parsed = parse_dates(series)
+        if parsed is not None:
+            return parsed
+    elif (dtype == "category" or dtype.startswith("string")) and series.dtype in (object, "string"):
+        return series.astype(dtype)
+    return optimize_column(series)
+
+
+def optimize_dtypes(df: pd.DataFrame, schema: Optional[dict] = None) -> tuple[pd.DataFrame, dict]:
+    """
+    Convert the columns of `df` to compact dtypes: low-cardinality strings to categoricals, other strings to
+    (Arrow-backed) strings, 64-bit integers that fit to int32, exactly representable floats to float32, and strings
+    that are all dates to datetimes.
+
+    `schema` maps column names to the dtypes a previous load of the same file ended up with; those columns are
+    converted directly instead of being inspected. Returns the converted frame and the schema of the result.
+    """
+    schema = schema or {}
+    columns = {}
+    for idx, column in enumerate(df.columns):
+        series = df.iloc[:, idx]
+        dtype = schema.get(str(column))
+        columns[idx] = apply_column(series, dtype) if dtype else optimize_column(series)
+    optimized = pd.DataFrame(columns, index=df.index)
+    optimized.columns = df.columns
+    return optimized, {str(column): dtype_name(dtype) for column, dtype in optimized.dtypes.items()}
+
+
+def parser_dtypes(schema: dict) -> dict:
+    """The part of `schema` that `pd.read_csv` can apply while parsing, so strings are never built as objects."""
+    return {column: dtype for column, dtype in schema.items() if dtype in PARSER_DTYPES}
+
+
+class DtypeSchemaCache:
+    """
+    Dtypes each dataset file was optimized to, stored as small JSON files keyed by dataset id and filename.
+
+    Later loads of the same file pass the string dtypes to the parser and convert the remaining columns directly,
+    skipping the inspection of every column.
+    """
+
+    def __init__(self, path: str = DTYPE_SCHEMA_DIR):
+        self.path = path
+
+    def entry_path(self, dataset_id, filename: str) -> str:
+        key = hashlib.sha256(f"{dataset_id}\n{filename}".encode()).hexdigest()
+        return os.path.join(self.path, key + ".json")
+
+    def get(self, dataset_id, filename: str) -> Optional[dict]:
+        path = self.entry_path(dataset_id, filename)
+        try:
+            with open(path) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            logger.exception(f"Unable to read cached schema {path}, discarding it")
+            return None
+
+    def put(self, dataset_id, filename: str, schema: dict):
+        path = self.entry_path(dataset_id, filename)
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            with open(temp_path, "w") as file:
+                json.dump(schema, file)
+            os.replace(temp_path, path)
+        except OSError:
+            logger.exception("Unable to cache dataset schema")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
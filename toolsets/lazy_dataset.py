@@ -0,0 +1,351 @@
+import logging
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from typing import Callable, Iterator, Mapping, Optional
+
+import pandas as pd
+
+from .schema_summary import (
+    DATASET_INFO_TOKEN_BUDGET, HEAD_COLUMNS, HEAD_ROWS, MAX_NAMES_PER_DTYPE, estimate_tokens, format_value,
+    rank_columns,
+)
+
+logger = logging.getLogger(__name__)
+
+# Which backend datasets are loaded with: "pandas" reads them into memory, "duckdb" keeps them on disk and queries them
+# through DuckDB, and "auto" picks DuckDB for files larger than DATASET_OUT_OF_CORE_BYTES.
+DATASET_BACKEND = os.environ.get("DATASET_BACKEND", "pandas")
+DATASET_OUT_OF_CORE_BYTES = int(os.environ.get("DATASET_OUT_OF_CORE_BYTES", 1024 ** 3))
+# Where datasets queried through DuckDB are stored (as Parquet), and how much memory DuckDB may use before spilling
+# to disk, e.g. "2GB". DuckDB's own default is used if not set.
+DATASET_DATA_DIR = os.environ.get(
+    "DATASET_DATA_DIR", os.path.join(os.path.expanduser("~"), ".cache", "jupyter-llm", "data")
+)
+DUCKDB_MEMORY_LIMIT = os.environ.get("DUCKDB_MEMORY_LIMIT", None)
+# Total size of the Parquet files in DATASET_DATA_DIR before the least recently used ones are evicted. Files of open
+# datasets are never evicted.
+DATASET_DATA_MAX_BYTES = int(os.environ.get("DATASET_DATA_MAX_BYTES", 20 * 1024 ** 3))
+# Number of relations whose SUMMARIZE statistics are kept per dataset
+STATISTICS_CACHE_ENTRIES = 32
+
+BACKENDS = ("pandas", "duckdb", "auto")
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+def is_relation(obj) -> bool:
+    """Whether `obj` is a DuckDB relation, without importing duckdb."""
+    return type(obj).__name__ == "DuckDBPyRelation"
+
+
+def use_lazy_backend(backend: str, headers: Mapping[str, str]) -> bool:
+    if backend not in BACKENDS:
+        raise ValueError(f"Unsupported backend '{backend}'. Supported backends are: {', '.join(BACKENDS)}")
+    if backend == "auto":
+        return int(headers.get("Content-Length", 0)) > DATASET_OUT_OF_CORE_BYTES
+    return backend == "duckdb"
+
+
+def sql_string(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+def sql_identifier(name) -> str:
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def sql_literal(value) -> str:
+    if value is None:
+        return "NULL"
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    if isinstance(value, (int, float)):
+        return repr(value)
+    return sql_string(str(value))
+
+
+def arrow_table(relation):
+    """All rows of `relation` as an Arrow table."""
+    if hasattr(relation, "to_arrow_table"):
+        return relation.to_arrow_table()
+    return relation.arrow()
+
+
+def arrow_batches(relation, batch_rows: int):
+    """Record batch reader over the rows of `relation`."""
+    if hasattr(relation, "to_arrow_reader"):
+        return relation.to_arrow_reader(batch_rows)
+    return relation.fetch_arrow_reader(batch_rows)
+
+
+def iter_relation_frames(relation, batch_rows: int) -> Iterator[pd.DataFrame]:
+    for batch in arrow_batches(relation, batch_rows):
+        yield batch.to_pandas()
+
+
+class DuckDBDataset:
+    """
+    Dataset kept on local disk as a Parquet file and queried through DuckDB, so it never has to fit in memory.
+
+    The file is exposed as the `dataset` view of a private DuckDB connection. `relation` is the whole dataset as a
+    lazy DuckDB relation; nothing is read until it is queried, and queries stream through the file, spilling to disk
+    when they need more than the memory limit.
+
+    The connection belongs to the kernel thread, which runs user code against `relation`. DuckDB connections can't be
+    used from several threads at once, so other threads `bind` relations to a cursor of their own first.
+
+    Files downloaded without a cache key are only used by this dataset, and are removed when it is closed.
+    """
+
+    # Paths of the datasets that are open, which eviction leaves alone
+    open_paths = {}
+    open_paths_lock = threading.Lock()
+
+    def __init__(self, path: str, memory_limit: Optional[str] = DUCKDB_MEMORY_LIMIT, temporary: bool = False):
+        import duckdb
+
+        self.path = path
+        self.temporary = temporary
+        with self.open_paths_lock:
+            self.open_paths[path] = self.open_paths.get(path, 0) + 1
+        self.connection = duckdb.connect()
+        if memory_limit:
+            self.connection.execute(f"SET memory_limit = {sql_string(memory_limit)}")
+        self.connection.execute(f"SET temp_directory = {sql_string(os.path.join(os.path.dirname(path), 'spill'))}")
+        self.connection.execute(f"CREATE VIEW dataset AS SELECT * FROM read_parquet({sql_string(path)})")
+        self.local = threading.local()
+        self.cursors = []
+        self.statistics_cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    @property
+    def relation(self):
+        return self.connection.table("dataset")
+
+    def cursor(self):
+        """Cursor of the calling thread on the dataset's database."""
+        cursor = getattr(self.local, "cursor", None)
+        if cursor is None:
+            cursor = self.connection.cursor()
+            self.local.cursor = cursor
+            with self.lock:
+                self.cursors.append(cursor)
+        return cursor
+
+    def bind(self, relation):
+        """
+        `relation`, bound to the calling thread's cursor so it can be queried off the kernel thread. Relations that
+        don't query this dataset's database (e.g. ones over the user's own connections) are returned as they are.
+        """
+        try:
+            return self.cursor().sql(relation.sql_query())
+        except Exception:
+            return relation
+
+    def statistics(self, relation) -> pd.DataFrame:
+        """
+        `summarize_statistics` of `relation`, which is only computed once per query, as the dataset file never changes
+        and SUMMARIZE reads all of it.
+        """
+        key = relation.sql_query()
+        with self.lock:
+            statistics = self.statistics_cache.get(key)
+            if statistics is not None:
+                self.statistics_cache.move_to_end(key)
+                return statistics
+        statistics = summarize_statistics(relation)
+        with self.lock:
+            self.statistics_cache[key] = statistics
+            while len(self.statistics_cache) > STATISTICS_CACHE_ENTRIES:
+                self.statistics_cache.popitem(last=False)
+        return statistics
+
+    @classmethod
+    def from_response(cls, response, filename: str, key: Optional[str] = None, data_dir: str = DATASET_DATA_DIR,
+                      on_progress: Optional[Callable[[int, Optional[int]], None]] = None,
+                      max_bytes: int = DATASET_DATA_MAX_BYTES) -> "DuckDBDataset":
+        """
+        Stream a dataset file download to disk and convert it to Parquet.
+
+        Files are named by `key` (see `DatasetCache.key`) when there is one, so a file that was already downloaded
+        and hasn't changed is reused without reading the response body. Reusing a file refreshes its mtime, and the
+        least recently used files are evicted once `data_dir` grows beyond `max_bytes`.
+        """
+        os.makedirs(data_dir, exist_ok=True)
+        path = os.path.join(data_dir, f"{key or uuid.uuid4().hex}.parquet")
+        if key is not None and os.path.exists(path):
+            os.utime(path)
+            return cls(path)
+
+        # The download keeps the original extension, so DuckDB can tell how it is compressed
+        extension = filename[filename.index("."):] if "." in filename else ".csv"
+        download_path = f"{path}.{uuid.uuid4().hex}{extension}"
+        total_bytes = int(response.headers.get("Content-Length", 0)) or None
+        bytes_read = 0
+        try:
+            with open(download_path, "wb") as file:
+                for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    file.write(chunk)
+                    bytes_read += len(chunk)
+                    if on_progress is not None:
+                        on_progress(bytes_read, total_bytes)
+            if extension == ".parquet":
+                os.replace(download_path, path)
+            else:
+                cls.convert_to_parquet(download_path, path)
+        finally:
+            if os.path.exists(download_path):
+                os.remove(download_path)
+        dataset = cls(path, temporary=key is None)
+        cls.evict(data_dir, max_bytes)
+        return dataset
+
+    @staticmethod
+    def convert_to_parquet(source: str, path: str, memory_limit: Optional[str] = DUCKDB_MEMORY_LIMIT):
+        import duckdb
+
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        connection = duckdb.connect()
+        try:
+            if memory_limit:
+                connection.execute(f"SET memory_limit = {sql_string(memory_limit)}")
+            connection.execute(
+                f"COPY (SELECT * FROM read_csv_auto({sql_string(source)})) TO {sql_string(temp_path)} (FORMAT PARQUET)"
+            )
+            os.replace(temp_path, path)
+        finally:
+            connection.close()
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    @classmethod
+    def evict(cls, data_dir: str, max_bytes: int):
+        entries = []
+        for name in os.listdir(data_dir):
+            if not name.endswith(".parquet"):
+                continue
+            try:
+                stat = os.stat(os.path.join(data_dir, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        with cls.open_paths_lock:
+            open_paths = set(cls.open_paths)
+        for _, size, name in sorted(entries):
+            if total <= max_bytes:
+                break
+            path = os.path.join(data_dir, name)
+            if path in open_paths:
+                continue
+            remove_file(path)
+            total -= size
+
+    def close(self):
+        with self.lock:
+            cursors, self.cursors = self.cursors, []
+            self.statistics_cache.clear()
+        for cursor in cursors:
+            cursor.close()
+        self.connection.close()
+        with self.open_paths_lock:
+            count = self.open_paths.pop(self.path, 0) - 1
+            if count > 0:
+                self.open_paths[self.path] = count
+        if self.temporary and count <= 0:
+            remove_file(self.path)
+
+
+def remove_file(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def summarize_statistics(relation) -> pd.DataFrame:
+    """Per-column statistics of `relation`, computed in a single aggregate pass by DuckDB's SUMMARIZE."""
+    return relation.query("summarized", "SUMMARIZE SELECT * FROM summarized").df().set_index("column_name")
+
+
+def relation_rows(relation) -> int:
+    return relation.aggregate("count(*)").fetchone()[0]
+
+
+def statistic_line(name, stats: pd.Series) -> str:
+    parts = [f"nulls={format_value(float(stats['null_percentage']))}%"]
+    for stat in ("avg", "std", "min", "max"):
+        value = stats.get(stat)
+        if value is not None and not pd.isna(value):
+            parts.append(f"{stat}={format_value(value)}")
+    parts.append(f"approx_unique={stats['approx_unique']}")
+    return f"- {name} ({stats['column_type']}): {', '.join(parts)}"
+
+
+def summarize_relation(relation, budget: int = DATASET_INFO_TOKEN_BUDGET, query: Optional[str] = None,
+                       dataset: Optional[DuckDBDataset] = None) -> str:
+    """
+    Describe a DuckDB relation in roughly `budget` tokens, like `summarize_dataframe` does for dataframes.
+
+    Statistics come from an aggregate query and the head from a `LIMIT` query, so the relation is never loaded. If the
+    relation is over `dataset`, it is queried through the calling thread's cursor and its statistics are cached.
+    """
+    if dataset is not None:
+        relation = dataset.bind(relation)
+    statistics = summarize_statistics(relation) if dataset is None else dataset.statistics(relation)
+    ranked = rank_columns(list(relation.columns), query)
+
+    lines = [
+        "The dataframe `df` is a DuckDB relation over a dataset that is kept on disk rather than loaded in memory.",
+        f"Shape: {relation_rows(relation):,} rows x {len(relation.columns):,} columns",
+        "",
+        "Columns by type:",
+    ]
+    groups = {}
+    for column, column_type in zip(relation.columns, relation.types):
+        groups.setdefault(str(column_type), []).append(column)
+    for column_type, names in groups.items():
+        shown = ", ".join(str(name) for name in names[:MAX_NAMES_PER_DTYPE])
+        more = f" (+{len(names) - MAX_NAMES_PER_DTYPE} more)" if len(names) > MAX_NAMES_PER_DTYPE else ""
+        lines.append(f"{column_type} ({len(names)}): {shown}{more}")
+
+    head_columns = ranked[:HEAD_COLUMNS]
+    head_rows = relation.project(", ".join(sql_identifier(column) for column in head_columns)).limit(HEAD_ROWS).df()
+    head = f"\nHead ({'most relevant ' if query else 'first '}{len(head_columns)} columns):\n{head_rows}"
+    footer = (
+        "\nOnly some of the columns are described above. "
+        "Use the column_info tool with a list of column names to get full details about specific columns."
+    )
+
+    lines += ["", "Most relevant columns:" if query else "Columns:"]
+    used = estimate_tokens("\n".join(lines) + head + footer)
+    described = 0
+    for column in ranked:
+        line = statistic_line(column, statistics.loc[column])
+        cost = estimate_tokens(line)
+        if used + cost > budget and described:
+            break
+        lines.append(line)
+        used += cost
+        described += 1
+
+    output = "\n".join(lines) + "\n" + head
+    if described < len(ranked):
+        output += "\n" + footer
+    return output
+
+
+def relation_column_info(relation, columns: list, dataset: Optional[DuckDBDataset] = None) -> str:
+    if dataset is not None:
+        relation = dataset.bind(relation)
+    selected = relation.project(", ".join(sql_identifier(column) for column in columns))
+    statistics = summarize_statistics(selected) if dataset is None else dataset.statistics(selected)
+    return f"""
+Head:
+{selected.limit(15).df()}
+
+
+Statistics:
+{statistics.transpose()}
+"""
@@ -0,0 +1,253 @@
+import json
+import math
+import os
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+from .dataset_profile import combine_statistics, frame_fingerprint
+from .lazy_dataset import is_relation
+from .schema_summary import (
+    DATASET_INFO_TOKEN_BUDGET, HEAD_COLUMNS, HEAD_ROWS, MAX_NAMES_PER_DTYPE, TOKENS_PER_COLUMN, estimate_tokens,
+    format_value, rank_columns,
+)
+
+# Whether saved datasets get a profile sidecar: a small JSON file listed after the data file, holding what is needed to
+# describe the dataset to the agent, so whoever opens it next doesn't have to profile it again. Can be overridden per
+# request.
+DATASET_PROFILE_SIDECAR = os.environ.get("DATASET_PROFILE_SIDECAR", "true").lower() in ("1", "true", "yes")
+
+SIDECAR_SUFFIX = ".profile.json"
+SIDECAR_MIMETYPE = "application/json"
+# Bumped whenever the layout changes; sidecars of any other version are ignored
+SIDECAR_VERSION = 1
+# As many rows as the full dataset description shows
+SIDECAR_HEAD_ROWS = 15
+
+
+def sidecar_name(filename: str) -> str:
+    return filename + SIDECAR_SUFFIX
+
+
+def is_sidecar(filename: str) -> bool:
+    return filename.endswith(SIDECAR_SUFFIX)
+
+
+def data_file_name(file_names: list) -> Optional[str]:
+    return next((name for name in file_names if not is_sidecar(name)), None)
+
+
+def sidecar_file_name(file_names: list) -> Optional[str]:
+    return next((name for name in file_names if is_sidecar(name)), None)
+
+
+def json_value(value):
+    """A statistic as a JSON value. Timestamps and other objects are kept as their text."""
+    if isinstance(value, np.generic):
+        value = value.item()
+    if value is None or value is pd.NaT:
+        return None
+    if isinstance(value, (bool, int, str)):
+        return value
+    if isinstance(value, float):
+        if math.isnan(value):
+            return None
+        return value if math.isfinite(value) else str(value)
+    return str(value)
+
+
+def build_profile(df: pd.DataFrame) -> Optional[dict]:
+    """
+    Profile of `df` for its sidecar: the number of rows, the name, dtype, null count and `describe()` statistics of
+    every column, and a head sample. DuckDB relations aren't profiled, as that would take another pass over the data.
+    """
+    if is_relation(df):
+        return None
+    # The columns `describe()` reports on by default (see `describe_columns`) are the ones shown in the statistics
+    selected = {str(dtype) for dtype in df.select_dtypes(include=[np.number, "datetime"]).dtypes}
+    nulls = df.isna().sum().to_numpy()
+    columns = []
+    for position, (name, dtype) in enumerate(zip(df.columns, df.dtypes)):
+        statistics = df.iloc[:, position].describe()
+        columns.append({
+            "name": str(name),
+            "dtype": str(dtype),
+            "nulls": int(nulls[position]),
+            "described": not selected or str(dtype) in selected,
+            "statistics": {str(stat): json_value(value) for stat, value in statistics.items()},
+        })
+    head = df.head(SIDECAR_HEAD_ROWS).to_json(orient="values", date_format="iso", default_handler=str)
+    return {
+        "version": SIDECAR_VERSION,
+        "rows": len(df),
+        "columns": columns,
+        "head": json.loads(head),
+    }
+
+
+def profile_bytes(df: pd.DataFrame) -> Optional[bytes]:
+    profile = build_profile(df)
+    return None if profile is None else json.dumps(profile, separators=(",", ":")).encode()
+
+
+def statistic_line(name, dtype: str, column: dict) -> str:
+    stats = column["statistics"]
+    parts = [f"nulls={column['nulls']}"]
+    if "mean" in stats:
+        parts.extend(
+            f"{stat}={format_value(stats[stat])}" for stat in ("mean", "std", "min", "max") if stats.get(stat) is not None
+        )
+    elif stats.get("top") is not None and stats.get("count"):
+        parts.append(f"unique={stats['unique']}")
+        parts.append(f"top={format_value(stats['top'])!r} ({stats['freq'] / stats['count']:.0%})")
+    return f"- {name} ({dtype}): {', '.join(parts)}"
+
+
+class ProfileSidecar:
+    """
+    Describes a dataset from the profile saved alongside it, in the same formats as `full_dataset_info` and
+    `summarize_dataframe`, without reading or profiling its data.
+
+    The dataframe loaded from the dataset, if there is one yet, is passed to the descriptions for its head and dtypes,
+    which are cheap and may differ from the saved ones once the file has been parsed again; the number of rows and the
+    statistics always come from the profile, so they are those of the whole dataset even while only its first rows
+    are loaded.
+
+    A sidecar is bound to the dataframe it was loaded with, and only describes that frame for as long as it is left as
+    it was loaded (see `describes`).
+    """
+
+    def __init__(self, profile: dict):
+        self.rows = profile["rows"]
+        self.columns = profile["columns"]
+        self.names = [column["name"] for column in self.columns]
+        self.head_rows = profile["head"]
+        self.df = None
+        self.fingerprint = None
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> Optional["ProfileSidecar"]:
+        profile = json.loads(data)
+        if profile.get("version") != SIDECAR_VERSION:
+            return None
+        return cls(profile)
+
+    def bind(self, df, complete: bool = True) -> bool:
+        """
+        Bind the profile to `df`, the dataframe just loaded from its dataset, if it fits it: it has the same columns
+        and, if it holds the complete dataset, the same number of rows. Returns whether it does.
+        """
+        self.df = self.fingerprint = None
+        if df is None or is_relation(df):
+            return False
+        if [str(column) for column in df.columns] != self.names or complete and len(df) != self.rows:
+            return False
+        self.fingerprint = frame_fingerprint(df)
+        if self.fingerprint is None:
+            return False
+        self.df = df
+        return True
+
+    def describes(self, df) -> bool:
+        """
+        Whether the profile describes `df`: it is the frame the profile was bound to, and its fingerprint (see
+        `frame_fingerprint`) shows it hasn't been changed in place since.
+        """
+        return df is not None and df is self.df and frame_fingerprint(df) == self.fingerprint
+
+    def head(self, df=None) -> pd.DataFrame:
+        if df is not None:
+            return df.head(SIDECAR_HEAD_ROWS)
+        return pd.DataFrame(self.head_rows, columns=self.names)
+
+    def dtypes(self, df=None) -> list:
+        if df is not None:
+            return [str(dtype) for dtype in df.dtypes]
+        return [column["dtype"] for column in self.columns]
+
+    def statistics(self) -> pd.DataFrame:
+        return combine_statistics([
+            pd.Series(column["statistics"], name=column["name"]) for column in self.columns if column["described"]
+        ])
+
+    def shape_lines(self, df=None) -> list:
+        lines = [f"Dataframe shape: {self.rows:,} rows x {len(self.columns):,} columns"]
+        if df is not None and len(df) < self.rows:
+            lines.append(
+                f"Only the first {len(df):,} rows are loaded so far; the statistics below are of the whole dataset."
+            )
+        return lines
+
+    def summary(self, df=None, query: Optional[str] = None, budget: int = DATASET_INFO_TOKEN_BUDGET) -> str:
+        if len(self.columns) * TOKENS_PER_COLUMN <= budget:
+            output = self.info(df)
+            if estimate_tokens(output) <= budget:
+                return output
+        return self.summarize(df, query=query, budget=budget)
+
+    def info(self, df=None) -> str:
+        columns = df.columns if df is not None else pd.Index(self.names)
+        dtypes = pd.Series(self.dtypes(df), index=columns, dtype=object)
+        shape = "\n".join(self.shape_lines(df))
+        return f"""
+{shape}
+
+Dataframe head:
+{self.head(df)}
+
+
+Columns:
+{columns}
+
+
+dtypes:
+{dtypes}
+
+
+Statistics:
+{self.statistics()}
+"""
+
+    def summarize(self, df=None, query: Optional[str] = None, budget: int = DATASET_INFO_TOKEN_BUDGET) -> str:
+        """Like `summarize_dataframe`, with the statistics of the whole dataset."""
+        positions = {}
+        for position, name in enumerate(self.names):
+            positions.setdefault(name, position)
+        ranked = rank_columns(list(positions), query)
+        dtypes = self.dtypes(df)
+
+        lines = self.shape_lines(df) + ["", "Columns by dtype:"]
+        groups = {}
+        for name in ranked:
+            groups.setdefault(dtypes[positions[name]], []).append(name)
+        for dtype, names in groups.items():
+            shown = ", ".join(names[:MAX_NAMES_PER_DTYPE])
+            more = f" (+{len(names) - MAX_NAMES_PER_DTYPE} more)" if len(names) > MAX_NAMES_PER_DTYPE else ""
+            lines.append(f"{dtype} ({len(names)}): {shown}{more}")
+
+        head_columns = ranked[:HEAD_COLUMNS]
+        head_rows = self.head(df).iloc[:HEAD_ROWS, [positions[name] for name in head_columns]]
+        head = f"\nDataframe head ({'most relevant ' if query else 'first '}{len(head_columns)} columns):\n{head_rows}"
+        footer = (
+            "\nOnly some of the columns are described above. "
+            "Use the column_info tool with a list of column names to get full details about specific columns."
+        )
+
+        lines += ["", "Most relevant columns:" if query else "Columns:"]
+        used = estimate_tokens("\n".join(lines) + head + footer)
+        described = 0
+        for name in ranked:
+            position = positions[name]
+            line = statistic_line(name, dtypes[position], self.columns[position])
+            cost = estimate_tokens(line)
+            if used + cost > budget and described:
+                break
+            lines.append(line)
+            used += cost
+            described += 1
+
+        output = "\n".join(lines) + "\n" + head
+        if described < len(ranked):
+            output += "\n" + footer
+        return output
@@ -0,0 +1,126 @@
+import os
+import re
+from typing import Optional
+
+import pandas as pd
+
+# Approximate number of prompt tokens the dataset description may use
+DATASET_INFO_TOKEN_BUDGET = int(os.environ.get("DATASET_INFO_TOKEN_BUDGET", 2000))
+# Rough cost of describing one column in the full (head, dtypes, describe) format, used to skip building the full
+# description when it clearly won't fit
+TOKENS_PER_COLUMN = 60
+# Frames longer than this have their summary statistics computed on a random sample of rows
+SAMPLE_ROWS = 100_000
+MAX_NAMES_PER_DTYPE = 25
+HEAD_ROWS = 5
+HEAD_COLUMNS = 8
+
+
+def estimate_tokens(text: str) -> int:
+    # ~4 characters per token is close enough for budgeting English text and tabular reprs
+    return len(text) // 4 + 1
+
+
+def name_tokens(name) -> set:
+    """Lowercase words in a column name or query, splitting on punctuation and camelCase."""
+    words = re.sub(r"([a-z])([A-Z])", r"\1 \2", str(name))
+    return {word for word in re.split(r"[^0-9a-zA-Z]+", words.lower()) if word}
+
+
+def rank_columns(columns: list, query: Optional[str] = None) -> list:
+    """Columns ordered by how relevant their names are to `query`, keeping the original order among equals."""
+    if not query:
+        return list(columns)
+    query_lower = query.lower()
+    query_words = name_tokens(query)
+
+    def score(item):
+        position, column = item
+        words = name_tokens(column)
+        overlap = len(words & query_words)
+        mentioned = str(column).lower() in query_lower
+        return (-(2 * int(mentioned) + overlap), position)
+
+    return [column for _, column in sorted(enumerate(columns), key=score)]
+
+
+def format_value(value) -> str:
+    if isinstance(value, float):
+        return f"{value:.4g}"
+    text = str(value)
+    return text if len(text) <= 40 else text[:37] + "..."
+
+
+def column_summary(name, series: pd.Series) -> str:
+    """One line describing a column."""
+    nulls = int(series.isna().sum())
+    parts = [f"nulls={nulls}"]
+    values = series.dropna()
+    if pd.api.types.is_bool_dtype(series):
+        parts.append(f"true={int(values.sum())}")
+    elif pd.api.types.is_numeric_dtype(series) and len(values):
+        parts.extend(f"{stat}={format_value(float(getattr(values, stat)()))}" for stat in ("mean", "std", "min", "max"))
+    elif pd.api.types.is_datetime64_any_dtype(series) and len(values):
+        parts.extend([f"min={values.min()}", f"max={values.max()}"])
+    elif len(values):
+        try:
+            counts = values.value_counts()
+        except TypeError:
+            # Unhashable values
+            counts = None
+        if counts is not None:
+            parts.append(f"unique={len(counts)}")
+            parts.append(f"top={format_value(counts.index[0])!r} ({counts.iloc[0] / len(values):.0%})")
+    return f"- {name} ({series.dtype}): {', '.join(parts)}"
+
+
+def summarize_dataframe(df: pd.DataFrame, budget: int = DATASET_INFO_TOKEN_BUDGET, query: Optional[str] = None,
+                        sample_rows: int = SAMPLE_ROWS) -> str:
+    """
+    Describe `df` in roughly `budget` tokens, however many columns it has.
+
+    Columns are grouped by dtype and the ones most relevant to `query` are described first, one line each, until the
+    budget runs out. Statistics on long frames are computed on a sample of rows.
+    """
+    if not df.columns.is_unique:
+        df = df.loc[:, ~df.columns.duplicated()]
+    sampled = len(df) > sample_rows
+    sample = df.sample(n=sample_rows, random_state=0) if sampled else df
+    ranked = rank_columns(list(df.columns), query)
+
+    lines = [f"Dataframe shape: {len(df):,} rows x {df.shape[1]:,} columns"]
+    if sampled:
+        lines.append(f"Statistics below were computed on a random sample of {sample_rows:,} rows.")
+
+    lines += ["", "Columns by dtype:"]
+    groups = {}
+    for column in ranked:
+        groups.setdefault(str(df[column].dtype), []).append(column)
+    for dtype, names in groups.items():
+        shown = ", ".join(str(name) for name in names[:MAX_NAMES_PER_DTYPE])
+        more = f" (+{len(names) - MAX_NAMES_PER_DTYPE} more)" if len(names) > MAX_NAMES_PER_DTYPE else ""
+        lines.append(f"{dtype} ({len(names)}): {shown}{more}")
+
+    head_columns = ranked[:HEAD_COLUMNS]
+    head = f"\nDataframe head ({'most relevant ' if query else 'first '}{len(head_columns)} columns):\n{df[head_columns].head(HEAD_ROWS)}"
+    footer = (
+        "\nOnly some of the columns are described above. "
+        "Use the column_info tool with a list of column names to get full details about specific columns."
+    )
+
+    lines += ["", "Most relevant columns:" if query else "Columns:"]
+    used = estimate_tokens("\n".join(lines) + head + footer)
+    described = 0
+    for column in ranked:
+        line = column_summary(column, sample[column])
+        cost = estimate_tokens(line)
+        if used + cost > budget and described:
+            break
+        lines.append(line)
+        used += cost
+        described += 1
+
+    output = "\n".join(lines) + "\n" + head
+    if described < df.shape[1]:
+        output += "\n" + footer
+    return output